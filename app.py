@@ -9,16 +9,27 @@ import re
 import hashlib
 import threading
 import functools
+import queue
+import mimetypes
+import gzip
+import zlib
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
 from pathlib import Path
-from flask import Flask, request, render_template, redirect, url_for, flash, send_from_directory, jsonify, session, g, make_response
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+from flask import Flask, request, render_template, redirect, url_for, flash, send_from_directory, jsonify, session, g, make_response, has_request_context, current_app
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import requests
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.local import LocalProxy
+from werkzeug.middleware.proxy_fix import ProxyFix
 from dotenv import load_dotenv
 import data_security
 from flask_socketio import SocketIO
+import socketio as _socketio_lib
 
 # ==================== 缓存系统实现 ====================
 
@@ -39,14 +50,35 @@ class CacheBackend:
     def clear(self):
         raise NotImplementedError
 
+    def rate_limit_hit(self, key, limit, window, cost=1):
+        raise NotImplementedError
+
+
+def _sliding_window_retry_after(prev_count, curr_count, limit, window, elapsed, cost=1):
+    """计算滑动窗口估算值降到可放行所需等待的秒数"""
+    if curr_count + cost > limit:
+        # 当前窗口已满：等到下个窗口，且上一窗口（即当前窗口）的加权计数足够衰减
+        decay = window * (1 - (limit - cost) / curr_count) if curr_count else 0
+        wait = (window - elapsed) + max(decay, 0)
+    elif prev_count:
+        wait = window * (1 - (limit - curr_count - cost) / prev_count) - elapsed
+    else:
+        wait = 1
+    return max(1, int(wait + 0.999))
+
 
 class MemoryCache(CacheBackend):
     """内存缓存实现（线程安全）"""
 
+    RATE_LIMIT_SHARDS = 16
+    RATE_LIMIT_MAX_KEYS_PER_SHARD = 5000
+
     def __init__(self):
         self._cache = {}
         self._lock = threading.Lock()
         self._stats = {'hits': 0, 'misses': 0}
+        # 限流计数按键哈希分片加锁，避免与普通缓存争用同一把锁
+        self._rate_shards = [({}, threading.Lock()) for _ in range(self.RATE_LIMIT_SHARDS)]
 
     def get(self, key):
         with self._lock:
@@ -88,18 +120,68 @@ class MemoryCache(CacheBackend):
         with self._lock:
             self._cache.clear()
 
+    def rate_limit_hit(self, key, limit, window, cost=1):
+        """
+        滑动窗口计数（当前窗口 + 上一窗口按剩余比例加权）
+
+        返回 (是否放行, 剩余次数, 需等待秒数)
+        """
+        now = time.time()
+        current = int(now // window)
+        elapsed = now - current * window
+        buckets, lock = self._rate_shards[hash(key) % len(self._rate_shards)]
+        with lock:
+            slot = buckets.get(key)
+            if slot is None or slot[0] < current - 1:
+                slot = [current, 0, 0]
+            elif slot[0] == current - 1:
+                slot = [current, slot[2], 0]
+            buckets[key] = slot
+
+            estimated = slot[1] * (1 - elapsed / window) + slot[2]
+            if estimated + cost > limit:
+                return False, 0, _sliding_window_retry_after(slot[1], slot[2], limit, window, elapsed, cost)
+            slot[2] += cost
+
+            if len(buckets) > self.RATE_LIMIT_MAX_KEYS_PER_SHARD:
+                for stale in [k for k, v in buckets.items() if v[0] < current - 1]:
+                    del buckets[stale]
+
+            return True, max(int(limit - estimated - cost), 0), 0
+
     def get_stats(self):
         total = self._stats['hits'] + self._stats['misses']
         return {
             **self._stats,
             'hit_rate': round(self._stats['hits'] / max(total, 1) * 100, 2),
-            'size': len(self._cache)
+            'size': len(self._cache),
+            'rate_limit_keys': sum(len(buckets) for buckets, _ in self._rate_shards)
         }
 
 
 class RedisCache(CacheBackend):
     """Redis缓存实现（如果可用）"""
 
+    # 滑动窗口限流：读取相邻两个窗口计数并在放行时原子递增
+    RATE_LIMIT_LUA = """
+    local window = tonumber(ARGV[1])
+    local limit = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local cost = tonumber(ARGV[4])
+    local current = math.floor(now / window)
+    local elapsed = now - current * window
+    local curr_key = KEYS[1] .. ':' .. current
+    local prev_key = KEYS[1] .. ':' .. (current - 1)
+    local curr = tonumber(redis.call('GET', curr_key) or '0')
+    local prev = tonumber(redis.call('GET', prev_key) or '0')
+    if prev * (1 - elapsed / window) + curr + cost > limit then
+        return {0, prev, curr, tostring(elapsed)}
+    end
+    redis.call('INCRBY', curr_key, cost)
+    redis.call('EXPIRE', curr_key, window * 2)
+    return {1, prev, curr + cost, tostring(elapsed)}
+    """
+
     def __init__(self, host='localhost', port=6379, db=0, password=None):
         try:
             import redis
@@ -114,6 +196,7 @@ class RedisCache(CacheBackend):
             )
             # 测试连接
             self.client.ping()
+            self._rate_limit_script = self.client.register_script(self.RATE_LIMIT_LUA)
             self._available = True
             print("[缓存] Redis连接成功")
         except Exception as e:
@@ -182,6 +265,15 @@ class RedisCache(CacheBackend):
             print(f"[Redis] FLUSH错误: {e}")
             return False
 
+    def rate_limit_hit(self, key, limit, window, cost=1):
+        allowed, prev, curr, elapsed = self._rate_limit_script(
+            keys=[key], args=[window, limit, time.time(), cost])
+        prev, curr, elapsed = int(prev), int(curr), float(elapsed)
+        if int(allowed):
+            remaining = limit - (prev * (1 - elapsed / window) + curr)
+            return True, max(int(remaining), 0), 0
+        return False, 0, _sliding_window_retry_after(prev, curr, limit, window, elapsed, cost)
+
 
 class UnifiedCache:
     """统一缓存管理器（自动选择后端）"""
@@ -193,8 +285,10 @@ class UnifiedCache:
         if cls._instance is None:
             with cls._lock:
                 if cls._instance is None:
-                    cls._instance = super().__new__(cls)
-                    cls._instance._initialize()
+                    # 初始化完成后再发布实例，避免并发首次访问拿到未初始化的对象
+                    instance = super().__new__(cls)
+                    instance._initialize()
+                    cls._instance = instance
         return cls._instance
 
     def _initialize(self):
@@ -296,6 +390,24 @@ class UnifiedCache:
                 return 0
         return 0
 
+    def rate_limit_hit(self, key, limit, window, cost=1):
+        """
+        记录一次限流计数
+
+        参数:
+            key: 限流键（规则名 + 维度标识）
+            limit: 窗口内允许的次数
+            window: 窗口长度（秒）
+            cost: 本次消耗的次数
+
+        返回 (是否放行, 剩余次数, Retry-After秒数)；后端异常时放行
+        """
+        try:
+            return self.backend.rate_limit_hit(key, limit, window, cost)
+        except Exception as e:
+            print(f"[限流] 计数错误: {e}")
+            return True, limit, 0
+
     def get_stats(self):
         """获取缓存统计信息"""
         stats = {
@@ -436,6 +548,75 @@ def cached_page(timeout=300, vary_by_user=False):
     return decorator
 
 
+# ==================== 模板片段缓存 ====================
+
+FRAGMENT_CACHE_TTL = int(os.getenv('FRAGMENT_CACHE_TTL', '600'))  # 0 表示关闭片段缓存
+
+
+class FragmentCacheExtension(Extension):
+    """
+    模板片段缓存：块内渲染结果存入 UnifiedCache，键相同时直接输出缓存的HTML
+
+    模板源码变化（重新部署）后块标识随之变化，旧片段自然失效
+
+    使用方法:
+        {% cache ['file_card', f.id, file_fragment_version(f)], 600 %}
+            ...
+        {% endcache %}
+    """
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        if parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        else:
+            args.append(nodes.Const(None))
+        args.append(nodes.Const(self._block_id(parser.name, lineno)))
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render_fragment', args), [], [], body).set_lineno(lineno)
+
+    def _block_id(self, template_name, lineno):
+        try:
+            source = self.environment.loader.get_source(self.environment, template_name)[0]
+            digest = hashlib.md5(source.encode('utf-8')).hexdigest()[:8]
+        except Exception:
+            digest = ''
+        return f"{template_name}:{lineno}:{digest}"
+
+    def _render_fragment(self, key, timeout, block_id, caller):
+        timeout = FRAGMENT_CACHE_TTL if timeout is None else timeout
+        if not timeout:
+            return caller()
+        if isinstance(key, (list, tuple)):
+            key = ':'.join(str(part) for part in key)
+        cache_key = f"frag:{block_id}:{key}"
+
+        cache = get_cache()
+        html = cache.get(cache_key)
+        if html is None:
+            html = str(caller())
+            cache.set(cache_key, html, timeout)
+        return Markup(html)
+
+
+def file_fragment_version(f):
+    """文件卡片的版本戳：由卡片展示的字段计算，任一字段变化即换新键"""
+    dkfile = f.get('dkfile')
+    dkdata = (dkfile.get('data') if isinstance(dkfile, dict) else None) or {}
+    stamp = json.dumps([
+        f.get('filename'), f.get('size'), f.get('stored_name'), f.get('view_count'),
+        f.get('like_count'), f.get('favorite_count'),
+        f.get('project_name'), f.get('project_desc'), f.get('created_at'),
+        [c.get('name') for c in f.get('categories') or []],
+        [t.get('name') for t in f.get('tags') or []],
+        dkdata.get('url'), dkdata.get('created_at'),
+    ], ensure_ascii=False, default=str)
+    return hashlib.md5(stamp.encode('utf-8')).hexdigest()[:12]
+
+
+
 # ==================== 文件预览缓存系统 ====================
 
 class FilePreviewCache:
@@ -602,15 +783,69 @@ def configure_cdn(app, cdn_url=None, static_version=None):
         print("[CDN] 未配置，使用本地静态资源")
 
 
+_static_manifest = {'mtime': None, 'data': {'files': {}, 'bundles': {}}}
+
+
+def load_static_manifest():
+    """读取 build_static.py 生成的 static/dist/manifest.json；文件更新后自动重新加载"""
+    manifest_file = Path(__file__).parent / "static" / "dist" / "manifest.json"
+    try:
+        mtime = manifest_file.stat().st_mtime
+    except OSError:
+        mtime = None
+    if mtime != _static_manifest['mtime']:
+        data = {'files': {}, 'bundles': {}}
+        if mtime is not None:
+            try:
+                data = json.loads(manifest_file.read_text(encoding='utf-8'))
+            except (OSError, ValueError) as e:
+                print(f"[静态资源] 读取构建清单失败: {e}")
+        _static_manifest.update(mtime=mtime, data=data)
+    return _static_manifest['data']
+
+
+def _hashed_static_url(path):
+    """构建产物文件名已含内容哈希，不再追加版本参数"""
+    from flask import url_for
+    cdn_url = current_app.config.get('CDN_URL', '')
+    if cdn_url:
+        return f"{cdn_url.rstrip('/')}/static/{path}"
+    return url_for('static', filename=path)
+
+
+def static_bundle(name):
+    """
+    合并包的URL列表：已构建时为单个带哈希的合并文件，否则为 static/bundles.json 中的各个源文件
+
+    使用方法:
+        {% for href in static_bundle('base.css') %}<link rel="stylesheet" href="{{ href }}">{% endfor %}
+    """
+    bundle = load_static_manifest()['bundles'].get(name)
+    if bundle:
+        return [_hashed_static_url(bundle['file'])]
+    bundles_file = Path(__file__).parent / "static" / "bundles.json"
+    try:
+        members = json.loads(bundles_file.read_text(encoding='utf-8')).get(name, [])
+    except (OSError, ValueError):
+        members = []
+    return [url_for_static(member) for member in members]
+
+
 def url_for_static(filename):
     """
     生成带版本号的静态资源URL（支持CDN）
 
+    已运行 build_static.py 时返回带内容哈希的文件名，可长期缓存
+
     使用方法:
         在模板中: {{ url_for_static('css/style.css') }}
     """
     from flask import url_for
 
+    hashed = load_static_manifest()['files'].get(filename)
+    if hashed:
+        return _hashed_static_url(hashed)
+
     # 获取版本号
     version = current_app.config.get('STATIC_VERSION', 'v1')
 
@@ -1817,74 +2052,236 @@ class DeviceManager:
 
 
 class SecurityAnalyzer:
-    """异常登录检测与分析"""
+    """异常登录检测与分析
+
+    风险评分所需的聚合（失败次数、已知IP/设备）按用户、邮箱、IP 维护在内存滚动窗口中，
+    每个键首次出现时从 security_events 预热一次；事件由后台线程批量写入 security_events 审计。
+    """
 
     MAX_LOGIN_ATTEMPTS = 5
     LOCKOUT_DURATION_MINUTES = 15
     SUSPICIOUS_THRESHOLD = 3
+    KNOWN_DEVICE_DAYS = 30
+    IP_FAILURE_THRESHOLD = int(os.getenv('SECURITY_IP_FAILURE_THRESHOLD', '20'))
+    MAX_TRACKED_KEYS = int(os.getenv('SECURITY_MAX_TRACKED_KEYS', '20000'))
+    MAX_KNOWN_PER_USER = 50
+    EVENT_BATCH_SIZE = 200
 
     def __init__(self):
         self.lock = threading.Lock()
+        # 滚动窗口状态：email -> 失败时间戳；ip -> 失败时间戳；user_id -> 登录画像
+        self._email_failures = OrderedDict()
+        self._ip_failures = OrderedDict()
+        self._user_profiles = OrderedDict()
+        self._event_queue = queue.Queue()
+        self._writer_thread = None
+        self._writer_lock = threading.Lock()
 
     @staticmethod
     def get_client_ip(request):
-        """获取客户端真实IP"""
-        forwarded = request.headers.get('X-Forwarded-For')
-        if forwarded:
-            return forwarded.split(',')[0].strip()
-        real_ip = request.headers.get('X-Real-IP')
-        if real_ip:
-            return real_ip
+        """获取客户端真实IP（经反向代理时由 ProxyFix 按 TRUSTED_PROXY_HOPS 改写 remote_addr）"""
         return request.remote_addr or '127.0.0.1'
 
+    @staticmethod
+    def _severity(risk_score):
+        if risk_score >= 70:
+            return 'high'
+        if risk_score >= 40:
+            return 'medium'
+        return 'low'
+
+    @staticmethod
+    def _parse_ts(value):
+        try:
+            return datetime.fromisoformat(value).timestamp()
+        except (TypeError, ValueError):
+            return None
+
+    def _touch(self, table, key, factory):
+        """取出（或创建）键状态并移到 LRU 末尾，超过上限时淘汰最旧的键"""
+        state = table.get(key)
+        if state is None:
+            state = factory()
+            table[key] = state
+            while len(table) > self.MAX_TRACKED_KEYS:
+                table.popitem(last=False)
+        else:
+            table.move_to_end(key)
+        return state
+
+    @staticmethod
+    def _prune(timestamps, horizon):
+        while timestamps and timestamps[0] < horizon:
+            timestamps.popleft()
+
+    # ---------- 状态预热 ----------
+
+    def _failures_for_email(self, conn, email):
+        """邮箱维度失败时间戳（锁定窗口内），首次访问时从数据库预热"""
+        with self.lock:
+            state = self._email_failures.get(email)
+            if state is not None:
+                self._email_failures.move_to_end(email)
+                return state
+
+        rows = []
+        if conn is not None and email:
+            since = (datetime.now() - timedelta(minutes=self.LOCKOUT_DURATION_MINUTES)).isoformat()
+            try:
+                rows = conn.execute('''SELECT created_at FROM security_events
+                                        WHERE email = ? AND event_type = 'login_failure'
+                                        AND created_at > ? ORDER BY created_at''',
+                                    (email, since)).fetchall()
+            except Exception as e:
+                print(f'[安全分析] 预热失败记录出错: {e}')
+
+        with self.lock:
+            state = self._email_failures.get(email)
+            if state is None:
+                state = self._touch(self._email_failures, email, deque)
+                for row in rows:
+                    ts = self._parse_ts(row[0])
+                    if ts is not None:
+                        state.append(ts)
+            return state
+
+    def _profile_for_user(self, conn, user_id):
+        """用户登录画像：已知IP/设备（最近使用时间）、最近成功登录IP、1小时内失败时间戳"""
+        with self.lock:
+            profile = self._user_profiles.get(user_id)
+            if profile is not None:
+                self._user_profiles.move_to_end(user_id)
+                return profile
+
+        rows = []
+        if conn is not None and user_id:
+            since = (datetime.now() - timedelta(days=self.KNOWN_DEVICE_DAYS)).isoformat()
+            try:
+                rows = conn.execute('''SELECT event_type, ip_address, user_agent, created_at
+                                        FROM security_events
+                                        WHERE user_id = ? AND event_type IN ('login_success', 'login_failure')
+                                        AND created_at > ? ORDER BY created_at DESC LIMIT 500''',
+                                    (user_id, since)).fetchall()
+            except Exception as e:
+                print(f'[安全分析] 预热用户画像出错: {e}')
+
+        with self.lock:
+            profile = self._user_profiles.get(user_id)
+            if profile is None:
+                profile = self._touch(self._user_profiles, user_id, lambda: {
+                    'ips': OrderedDict(),
+                    'agents': OrderedDict(),
+                    'recent_ips': deque(maxlen=10),
+                    'failures': deque(),
+                })
+                for row in reversed(rows):
+                    ts = self._parse_ts(row[3])
+                    if ts is None:
+                        continue
+                    self._apply_to_profile(profile, row[0] == 'login_success', row[1], row[2], ts)
+            return profile
+
+    def _apply_to_profile(self, profile, success, ip, user_agent, ts):
+        """把一次登录事件累加进用户画像（调用方持有 self.lock）"""
+        if success:
+            for table, key in ((profile['ips'], ip), (profile['agents'], user_agent)):
+                table[key] = ts
+                table.move_to_end(key)
+                while len(table) > self.MAX_KNOWN_PER_USER:
+                    table.popitem(last=False)
+            profile['recent_ips'].append(ip)
+        else:
+            profile['failures'].append(ts)
+            self._prune(profile['failures'], ts - 3600)
+
+    def _known_count(self, table, horizon):
+        while table:
+            oldest_key = next(iter(table))
+            if table[oldest_key] >= horizon:
+                break
+            table.popitem(last=False)
+        return len(table)
+
+    # ---------- 评分 ----------
+
     def analyze_login(self, conn, user_id, email, request, success=True):
-        """分析登录行为并记录事件"""
+        """分析登录行为并记录事件
+
+        评分只读取内存中的滚动聚合，事件异步写入 security_events，因此返回的 event_id 恒为 None。
+        """
         ip = self.get_client_ip(request)
         user_agent = request.headers.get('User-Agent', '')[:500]
 
         event_type = 'login_success' if success else 'login_failure'
 
-        risk_score = self._calculate_risk_score(conn, user_id, ip, request, success)
-
-        severity = 'low'
-        if risk_score >= 70:
-            severity = 'high'
-        elif risk_score >= 40:
-            severity = 'medium'
-
-        cursor = conn.cursor()
-        cursor.execute('''INSERT INTO security_events
-                        (user_id, email, event_type, ip_address, user_agent,
-                         risk_score, severity, details, created_at)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                       (user_id, email, event_type, ip, user_agent,
-                        risk_score, severity,
-                        json.dumps({'success': success}, ensure_ascii=False),
-                        datetime.now().isoformat()))
-        conn.commit()
+        risk_score = self._calculate_risk_score(conn, user_id, ip, request, success, email=email)
+        severity = self._severity(risk_score)
 
         anomalies = []
         if risk_score >= 70 and success:
             anomalies = self._detect_anomalies(conn, user_id, ip, request)
 
+        self._observe(conn, user_id, email, ip, user_agent, success)
+        self._enqueue_event(user_id, email, event_type, ip, user_agent, risk_score, severity,
+                            {'success': success})
+
         return {
-            'event_id': cursor.lastrowid,
+            'event_id': None,
             'risk_score': risk_score,
             'severity': severity,
             'anomalies': anomalies,
             'requires_2fa': risk_score >= 50
         }
 
-    def _calculate_risk_score(self, conn, user_id, ip, request, success):
+    def _observe(self, conn, user_id, email, ip, user_agent, success):
+        """登录事件发生后更新各维度滚动窗口"""
+        now = time.time()
+        failures = self._failures_for_email(conn, email) if (email and not success) else None
+        profile = self._profile_for_user(conn, user_id) if user_id else None
+
+        with self.lock:
+            if failures is not None:
+                failures.append(now)
+                self._prune(failures, now - self.LOCKOUT_DURATION_MINUTES * 60)
+            if not success:
+                ip_failures = self._touch(self._ip_failures, ip, deque)
+                ip_failures.append(now)
+                self._prune(ip_failures, now - self.LOCKOUT_DURATION_MINUTES * 60)
+            if profile is not None:
+                self._apply_to_profile(profile, success, ip, user_agent, now)
+
+    def _calculate_risk_score(self, conn, user_id, ip, request, success, email=None):
         """计算风险评分（0-100）"""
         score = 0
-        user_agent = request.headers.get('User-Agent', '')
+        user_agent = request.headers.get('User-Agent', '')[:500]
+        now = time.time()
+
+        if email is None and user_id and conn is not None:
+            row = conn.execute('SELECT email FROM users WHERE id = ?', (user_id,)).fetchone()
+            email = row[0] if row else None
 
-        recent_failures = conn.execute('''SELECT COUNT(*) FROM security_events
-                                        WHERE email = (SELECT email FROM users WHERE id = ?)
-                                        AND event_type = 'login_failure'
-                                        AND created_at > datetime('now', '-15 minutes')''',
-                                     (user_id,)).fetchone()[0]
+        failures = self._failures_for_email(conn, email) if email else None
+        profile = self._profile_for_user(conn, user_id) if user_id else None
+
+        with self.lock:
+            recent_failures = 0
+            if failures is not None:
+                self._prune(failures, now - self.LOCKOUT_DURATION_MINUTES * 60)
+                recent_failures = len(failures)
+
+            ip_failures = self._ip_failures.get(ip)
+            ip_failure_count = 0
+            if ip_failures is not None:
+                self._prune(ip_failures, now - self.LOCKOUT_DURATION_MINUTES * 60)
+                ip_failure_count = len(ip_failures)
+
+            ip_known = agent_known = True
+            if profile is not None:
+                horizon = now - self.KNOWN_DEVICE_DAYS * 86400
+                if self._known_count(profile['ips'], horizon):
+                    ip_known = ip in profile['ips']
+                if self._known_count(profile['agents'], horizon):
+                    agent_known = user_agent in profile['agents']
 
         if recent_failures >= 5:
             score += 30
@@ -1893,24 +2290,16 @@ class SecurityAnalyzer:
         elif recent_failures >= 1:
             score += 10
 
-        known_ips = conn.execute('''SELECT DISTINCT ip_address FROM security_events
-                                   WHERE user_id = ? AND event_type = 'login_success'
-                                   AND created_at > datetime('now', '-30 days')''',
-                                (user_id,)).fetchall()
-
-        known_ip_list = [row['ip_address'] for row in known_ips]
-        if ip not in known_ip_list and len(known_ip_list) > 0:
+        if not ip_known:
             score += 25
 
-        known_agents = conn.execute('''SELECT DISTINCT user_agent FROM security_events
-                                      WHERE user_id = ? AND event_type = 'login_success'
-                                      AND created_at > datetime('now', '-30 days') LIMIT 5''',
-                                   (user_id,)).fetchall()
-
-        agent_known = any(row['user_agent'] == user_agent for row in known_agents)
-        if not agent_known and len(known_agents) > 0:
+        if not agent_known:
             score += 15
 
+        # 同一IP在窗口内对多个账户大量失败，视为撞库
+        if ip_failure_count >= self.IP_FAILURE_THRESHOLD:
+            score += 20
+
         hour = datetime.now().hour
         if hour < 6 or hour > 23:
             score += 10
@@ -1923,25 +2312,19 @@ class SecurityAnalyzer:
     def _detect_anomalies(self, conn, user_id, ip, request):
         """检测异常情况"""
         anomalies = []
+        profile = self._profile_for_user(conn, user_id)
 
-        recent_logins = conn.execute('''SELECT ip_address, user_agent, created_at FROM security_events
-                                       WHERE user_id = ? AND event_type = 'login_success'
-                                       ORDER BY created_at DESC LIMIT 10''',
-                                    (user_id,)).fetchall()
-
-        if recent_logins:
-            locations = set(login['ip_address'] for login in recent_logins)
-            if len(locations) >= 3:
-                anomalies.append({
-                    'type': 'multiple_locations',
-                    'message': f'短时间内从{len(locations)}个不同IP地址登录',
-                    'severity': 'high'
-                })
+        with self.lock:
+            locations = set(profile['recent_ips'])
+            self._prune(profile['failures'], time.time() - 3600)
+            recent_hours = len(profile['failures'])
 
-        recent_hours = conn.execute('''SELECT COUNT(*) FROM security_events
-                                       WHERE user_id = ? AND event_type = 'login_failure'
-                                       AND created_at > datetime('now', '-1 hour')''',
-                                    (user_id,)).fetchone()[0]
+        if len(locations) >= 3:
+            anomalies.append({
+                'type': 'multiple_locations',
+                'message': f'短时间内从{len(locations)}个不同IP地址登录',
+                'severity': 'high'
+            })
 
         if recent_hours >= 10:
             anomalies.append({
@@ -1954,26 +2337,80 @@ class SecurityAnalyzer:
 
     def is_account_locked(self, conn, email):
         """检查账户是否被锁定"""
-        failures = conn.execute('''SELECT COUNT(*) FROM security_events
-                                  WHERE email = ? AND event_type = 'login_failure'
-                                  AND created_at > datetime('now', '-15 minutes')''',
-                               (email,)).fetchone()[0]
-
-        if failures >= self.MAX_LOGIN_ATTEMPTS:
-            last_failure = conn.execute('''SELECT MAX(created_at) FROM security_events
-                                         WHERE email = ? AND event_type = 'login_failure''',
-                                      (email,)).fetchone()[0]
-
-            if last_failure:
-                lock_time = datetime.fromisoformat(last_failure) + timedelta(minutes=self.LOCKOUT_DURATION_MINUTES)
-                remaining_seconds = int((lock_time - datetime.now()).total_seconds())
-                if remaining_seconds > 0:
-                    return True, remaining_seconds
+        failures = self._failures_for_email(conn, email)
+        now = time.time()
 
+        with self.lock:
+            self._prune(failures, now - self.LOCKOUT_DURATION_MINUTES * 60)
+            if len(failures) < self.MAX_LOGIN_ATTEMPTS:
+                return False, 0
+            last_failure = failures[-1]
+
+        remaining_seconds = int(last_failure + self.LOCKOUT_DURATION_MINUTES * 60 - now)
+        if remaining_seconds > 0:
+            return True, remaining_seconds
         return False, 0
 
+    def reset_failures(self, email):
+        """清除邮箱的失败计数（例如管理员手动解锁）"""
+        with self.lock:
+            self._email_failures.pop(email, None)
+
+    # ---------- 异步写入 ----------
+
+    def _enqueue_event(self, user_id, email, event_type, ip, user_agent, risk_score, severity, details):
+        self._event_queue.put((user_id, email, event_type, ip, user_agent, risk_score, severity,
+                               json.dumps(details or {}, ensure_ascii=False),
+                               datetime.now().isoformat()))
+        self._ensure_writer()
+
+    def _ensure_writer(self):
+        if self._writer_thread is not None and self._writer_thread.is_alive():
+            return
+        with self._writer_lock:
+            if self._writer_thread is not None and self._writer_thread.is_alive():
+                return
+            self._writer_thread = threading.Thread(target=self._writer_loop,
+                                                   name='security-event-writer', daemon=True)
+            self._writer_thread.start()
+
+    def _writer_loop(self):
+        """后台批量写入 security_events"""
+        while True:
+            batch = [self._event_queue.get()]
+            while len(batch) < self.EVENT_BATCH_SIZE:
+                try:
+                    batch.append(self._event_queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                conn = sqlite3.connect(str(DB_FILE), timeout=30)
+                try:
+                    conn.executemany('''INSERT INTO security_events
+                                         (user_id, email, event_type, ip_address, user_agent,
+                                          risk_score, severity, details, created_at)
+                                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''', batch)
+                    conn.commit()
+                finally:
+                    conn.close()
+            except Exception as e:
+                print(f'[安全分析] 写入安全事件失败（{len(batch)}条）: {e}')
+            finally:
+                for _ in batch:
+                    self._event_queue.task_done()
+
+    def flush_events(self, timeout=5.0):
+        """等待排队中的安全事件落库，返回是否已全部写入"""
+        deadline = time.time() + timeout
+        while self._event_queue.unfinished_tasks:
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
     def get_security_stats(self, conn, user_id, days=30):
         """获取用户安全统计"""
+        self.flush_events(timeout=1.0)
         since = (datetime.now() - timedelta(days=days)).isoformat()
 
         total_logins = conn.execute('''SELECT COUNT(*) FROM security_events
@@ -2006,26 +2443,15 @@ class SecurityAnalyzer:
         }
 
     def record_security_event(self, conn, user_id, email, event_type, details=None, risk_score=0):
-        """记录安全事件"""
+        """记录安全事件（异步写入）"""
         request = getattr(g, '_request', None)
         ip = self.get_client_ip(request) if request else 'system'
         user_agent = request.headers.get('User-Agent', '')[:500] if request else 'system'
 
-        severity = 'low'
-        if risk_score >= 70:
-            severity = 'high'
-        elif risk_score >= 40:
-            severity = 'medium'
-
-        conn.execute('''INSERT INTO security_events
-                       (user_id, email, event_type, ip_address, user_agent,
-                        risk_score, severity, details, created_at)
-                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                   (user_id, email, event_type, ip, user_agent,
-                    risk_score, severity,
-                    json.dumps(details or {}, ensure_ascii=False),
-                    datetime.now().isoformat()))
-        conn.commit()
+        if event_type in ('login_success', 'login_failure'):
+            self._observe(conn, user_id, email, ip, user_agent, event_type == 'login_success')
+        self._enqueue_event(user_id, email, event_type, ip, user_agent,
+                            risk_score, self._severity(risk_score), details)
 
 
 class PasswordStrengthChecker:
@@ -2349,6 +2775,12 @@ app.config["SECRET_KEY"] = os.getenv("SECRET_KEY", "dev")
 data_security.get_encryption().ensure_key()
 print(f"[安全] 数据加密: {'已启用' if data_security.get_encryption().available else '未配置密钥'}")
 app.config["UPLOAD_FOLDER"] = str(UPLOAD_DIR)
+app.jinja_env.add_extension(FragmentCacheExtension)
+
+# 前置反向代理的层数；为0时不信任任何 X-Forwarded-* 头，客户端无法自选来源IP
+TRUSTED_PROXY_HOPS = int(os.getenv('TRUSTED_PROXY_HOPS', '0'))
+if TRUSTED_PROXY_HOPS > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS, x_proto=TRUSTED_PROXY_HOPS)
 
 # ==================== CSRF 防护 ====================
 import hmac
@@ -2367,6 +2799,113 @@ def validate_csrf_token(token):
         return False
     return hmac.compare_digest(stored, token)
 
+# ==================== 请求限流 ====================
+
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+
+_UPLOAD_RATE_RULE = ('upload', 60, 60, 'user', ('POST',))
+
+# 声明式限流规则：endpoint -> [(规则名, 次数, 窗口秒数, 计数维度, 生效方法)]
+# 计数维度：ip / user（未登录退化为ip） / email（表单或JSON中的邮箱） / principal（API Key或令牌）
+RATE_LIMIT_RULES = {
+    'auth': [('login_ip', 20, 60, 'ip', ('POST',)),
+             ('login_email', 10, 900, 'email', ('POST',))],
+    'send_email_code': [('email_code', 5, 300, 'ip', ('POST',))],
+    'verify_2fa': [('verify_2fa', 10, 300, 'user', ('POST',))],
+    'change_password': [('change_password', 10, 900, 'user', ('POST',))],
+    'api_v1_auth_token': [('api_token_ip', 10, 60, 'ip', ('POST',)),
+                          ('api_token_email', 10, 900, 'email', ('POST',))],
+    'api_v1_auth_refresh': [('api_refresh', 30, 60, 'ip', ('POST',))],
+    'account_login': [('miniapp_login_ip', 10, 60, 'ip', ('POST',)),
+                      ('miniapp_login_email', 10, 900, 'email', ('POST',))],
+    'wx_login': [('miniapp_wx_login', 20, 60, 'ip', ('POST',))],
+    'upload_page': [_UPLOAD_RATE_RULE],
+    'upload_to_folder': [_UPLOAD_RATE_RULE],
+    'batch_upload_files': [_UPLOAD_RATE_RULE],
+    'upload_folder_to_folder': [_UPLOAD_RATE_RULE],
+    'api_storage_upload': [_UPLOAD_RATE_RULE],
+    'api_v1_upload_file': [_UPLOAD_RATE_RULE],
+    'upload_file': [_UPLOAD_RATE_RULE],
+    'chunk_init': [_UPLOAD_RATE_RULE],
+    'chunk_merge': [_UPLOAD_RATE_RULE],
+    'chunk_upload': [('upload_chunk', 1200, 60, 'user', ('POST',))],
+}
+
+# 按路径前缀生效的规则（开放API整体配额）
+RATE_LIMIT_PATH_RULES = [
+    ('/api/v1/', ('open_api', 300, 60, 'principal', None)),
+]
+
+
+def _rate_limit_identity(scope):
+    """根据计数维度取当前请求的标识，取不到时返回None（该规则不生效）"""
+    if scope == 'ip':
+        return f"ip:{request.remote_addr or 'unknown'}"
+    if scope == 'user':
+        if session.get('user_id'):
+            return f"user:{session['user_id']}"
+        return f"ip:{request.remote_addr or 'unknown'}"
+    if scope == 'email':
+        email = request.form.get('email')
+        if not email and request.is_json:
+            email = (request.get_json(silent=True) or {}).get('email')
+        if not email or not isinstance(email, str):
+            return None
+        return f"email:{email.strip().lower()}"
+    if scope == 'principal':
+        credential = request.headers.get('X-API-Key') or request.headers.get('Authorization', '')
+        if credential:
+            return f"key:{hashlib.sha256(credential.encode('utf-8')).hexdigest()[:24]}"
+        return f"ip:{request.remote_addr or 'unknown'}"
+    return None
+
+
+@app.before_request
+def enforce_rate_limits():
+    """按声明式规则限流，超限请求在任何数据库操作前返回429"""
+    if not RATE_LIMIT_ENABLED:
+        return None
+    rules = list(RATE_LIMIT_RULES.get(request.endpoint, ()))
+    for prefix, rule in RATE_LIMIT_PATH_RULES:
+        if request.path.startswith(prefix):
+            rules.append(rule)
+
+    cache = get_cache()
+    tightest = None
+    for name, limit, window, scope, methods in rules:
+        if methods and request.method not in methods:
+            continue
+        identity = _rate_limit_identity(scope)
+        if identity is None:
+            continue
+        allowed, remaining, retry_after = cache.rate_limit_hit(f"ratelimit:{name}:{identity}", limit, window)
+        if not allowed:
+            print(f"[限流] {name} 拒绝 {identity}, {retry_after}s 后可重试")
+            message = f'请求过于频繁，请 {retry_after} 秒后重试'
+            if request.path.startswith('/api/') or '/api/' in request.path or request.is_json:
+                response = jsonify({'success': False, 'message': message, 'code': 429})
+                response.status_code = 429
+            else:
+                flash(message, 'error')
+                response = redirect(request.referrer or url_for('index'))
+            response.headers['Retry-After'] = str(retry_after)
+            return response
+        if tightest is None or remaining < tightest[1]:
+            tightest = (limit, remaining)
+    if tightest:
+        g.rate_limit = tightest
+    return None
+
+
+@app.after_request
+def add_rate_limit_headers(response):
+    rate_limit = g.pop('rate_limit', None)
+    if rate_limit:
+        response.headers['X-RateLimit-Limit'] = str(rate_limit[0])
+        response.headers['X-RateLimit-Remaining'] = str(rate_limit[1])
+    return response
+
+
 # CSRF 白名单路径（不需要验证的路由）
 CSRF_EXEMPT_PREFIXES = (
     '/static/', '/api/v1/', '/open/', '/socket.io/',
@@ -2397,38 +2936,312 @@ def csrf_protect():
         flash('安全验证失败，请重新提交', 'error')
         return redirect(request.referrer or url_for('index'))
 
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet', manage_session=False)
+# ==================== 实时通信：多进程消息总线与在线状态 ====================
+# 多个 worker 共享本机的 realtime.sqlite：Socket.IO 广播经由消息表转发，在线状态按心跳 + TTL 维护
+REALTIME_DB_FILE = DATA_DIR / "realtime.sqlite"
+SOCKETIO_MESSAGE_QUEUE = os.getenv('SOCKETIO_MESSAGE_QUEUE', '')  # 空=单进程，local=SQLite 总线，其余按 URL 交给 Flask-SocketIO
+SOCKETIO_POLL_INTERVAL = float(os.getenv('SOCKETIO_POLL_INTERVAL', '0.05'))
+SOCKETIO_MESSAGE_RETENTION = int(os.getenv('SOCKETIO_MESSAGE_RETENTION', '60'))
+PRESENCE_HEARTBEAT_INTERVAL = int(os.getenv('PRESENCE_HEARTBEAT_INTERVAL', '15'))
+PRESENCE_TTL = int(os.getenv('PRESENCE_TTL', '45'))
+
+
+def _realtime_conn():
+    DATA_DIR.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(REALTIME_DB_FILE), timeout=5, isolation_level=None,
+                           check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+class SQLitePubSubManager(_socketio_lib.PubSubManager):
+    """基于本机 SQLite 的 Socket.IO 消息总线：发布即插入一行，各 worker 轮询自己未读的新行"""
+
+    name = 'sqlite'
+
+    def __init__(self, channel='socketio', write_only=False, logger=None,
+                 poll_interval=SOCKETIO_POLL_INTERVAL, retention=SOCKETIO_MESSAGE_RETENTION):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._local = threading.local()
+        self._last_prune = 0.0
+        conn = self._get_conn()
+        conn.execute('''CREATE TABLE IF NOT EXISTS socketio_messages (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            channel TEXT NOT NULL,
+                            payload TEXT NOT NULL,
+                            created_at REAL NOT NULL
+                        )''')
+
+    def _get_conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = _realtime_conn()
+            self._local.conn = conn
+        return conn
+
+    def _publish(self, data):
+        conn = self._get_conn()
+        now = time.time()
+        conn.execute("INSERT INTO socketio_messages (channel, payload, created_at) VALUES (?, ?, ?)",
+                     (self.channel, self.json.dumps(data), now))
+        if now - self._last_prune > self.retention:
+            self._last_prune = now
+            conn.execute("DELETE FROM socketio_messages WHERE created_at < ?", (now - self.retention,))
+
+    def _listen(self):
+        conn = _realtime_conn()
+        last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM socketio_messages").fetchone()[0]
+        while True:
+            rows = conn.execute(
+                "SELECT id, payload FROM socketio_messages WHERE id > ? AND channel = ? ORDER BY id LIMIT 500",
+                (last_id, self.channel)).fetchall()
+            for message_id, payload in rows:
+                last_id = message_id
+                # 消息以JSON文本存储，由 PubSubManager._thread 解码，不反序列化任意对象
+                yield payload
+            if not rows:
+                self.server.sleep(self.poll_interval)
+
+
+class PresenceRegistry:
+    """跨 worker 共享的在线状态：每个连接一行，worker 定期为自己持有的连接续期，过期即视为离线"""
+
+    def __init__(self, ttl=PRESENCE_TTL):
+        self.ttl = ttl
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._local_sids = {}
+        self._lock = threading.Lock()
+        self._ready = False
+
+    def _conn(self):
+        conn = _realtime_conn()
+        if not self._ready:
+            conn.execute('''CREATE TABLE IF NOT EXISTS presence (
+                                sid TEXT PRIMARY KEY,
+                                user_id TEXT NOT NULL,
+                                username TEXT,
+                                worker_id TEXT NOT NULL,
+                                connected_at REAL NOT NULL,
+                                last_seen REAL NOT NULL
+                            )''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_presence_user ON presence(user_id, last_seen)')
+            self._ready = True
+        return conn
+
+    def _live_sessions(self, conn, user_id, now):
+        return conn.execute("SELECT COUNT(*) FROM presence WHERE user_id = ? AND last_seen >= ?",
+                            (user_id, now - self.ttl)).fetchone()[0]
+
+    def connect(self, sid, user_id, username=''):
+        """登记连接；返回该用户是否刚从离线变为在线"""
+        now = time.time()
+        with self._lock:
+            self._local_sids[sid] = user_id
+        conn = self._conn()
+        try:
+            first = self._live_sessions(conn, user_id, now) == 0
+            conn.execute(
+                """INSERT OR REPLACE INTO presence (sid, user_id, username, worker_id, connected_at, last_seen)
+                   VALUES (?, ?, ?, ?, ?, ?)""",
+                (sid, user_id, username, self.worker_id, now, now))
+            return first
+        finally:
+            conn.close()
+
+    def disconnect(self, sid):
+        """注销连接；返回 (user_id, 是否已无其他在线连接)"""
+        with self._lock:
+            user_id = self._local_sids.pop(sid, None)
+        conn = self._conn()
+        try:
+            row = conn.execute("SELECT user_id FROM presence WHERE sid = ?", (sid,)).fetchone()
+            conn.execute("DELETE FROM presence WHERE sid = ?", (sid,))
+            user_id = user_id or (row[0] if row else None)
+            if not user_id:
+                return None, False
+            return user_id, self._live_sessions(conn, user_id, time.time()) == 0
+        finally:
+            conn.close()
+
+    def heartbeat(self):
+        """为本 worker 的连接续期，并清理过期连接；返回因过期而离线的 [(user_id, username)]"""
+        now = time.time()
+        with self._lock:
+            sids = list(self._local_sids)
+        conn = self._conn()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for i in range(0, len(sids), 500):
+                chunk = sids[i:i + 500]
+                conn.execute(f"UPDATE presence SET last_seen = ? WHERE sid IN ({','.join('?' * len(chunk))})",
+                             (now, *chunk))
+            expired = conn.execute(
+                "SELECT DISTINCT user_id, username FROM presence WHERE last_seen < ?",
+                (now - self.ttl,)).fetchall()
+            conn.execute("DELETE FROM presence WHERE last_seen < ?", (now - self.ttl,))
+            conn.execute('COMMIT')
+            return [(uid, name) for uid, name in expired if self._live_sessions(conn, uid, now) == 0]
+        finally:
+            conn.close()
+
+    def online_users(self):
+        conn = self._conn()
+        try:
+            rows = conn.execute(
+                """SELECT user_id, MAX(username), MIN(connected_at), COUNT(*) FROM presence
+                   WHERE last_seen >= ? GROUP BY user_id ORDER BY MIN(connected_at)""",
+                (time.time() - self.ttl,)).fetchall()
+        finally:
+            conn.close()
+        return [{
+            'user_id': uid,
+            'username': username or '',
+            'connected_at': datetime.fromtimestamp(connected_at).isoformat(),
+            'connections': connections,
+        } for uid, username, connected_at, connections in rows]
+
+    def online_among(self, user_ids):
+        """给定用户中当前在线的 user_id 列表"""
+        if not user_ids:
+            return []
+        conn = self._conn()
+        try:
+            online = []
+            for i in range(0, len(user_ids), 500):
+                chunk = user_ids[i:i + 500]
+                rows = conn.execute(
+                    f"""SELECT DISTINCT user_id FROM presence
+                        WHERE last_seen >= ? AND user_id IN ({','.join('?' * len(chunk))})""",
+                    (time.time() - self.ttl, *chunk)).fetchall()
+                online.extend(r[0] for r in rows)
+            return online
+        finally:
+            conn.close()
+
+    def is_online(self, user_id):
+        conn = self._conn()
+        try:
+            return self._live_sessions(conn, user_id, time.time()) > 0
+        finally:
+            conn.close()
+
+
+def _make_socketio_options():
+    options = {}
+    if SOCKETIO_MESSAGE_QUEUE == 'local':
+        options['client_manager'] = SQLitePubSubManager()
+        print(f"[实时] Socket.IO 使用本机 SQLite 消息总线: {REALTIME_DB_FILE}")
+    elif SOCKETIO_MESSAGE_QUEUE:
+        options['message_queue'] = SOCKETIO_MESSAGE_QUEUE
+    return options
+
+
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet', manage_session=False,
+                    **_make_socketio_options())
+presence_registry = PresenceRegistry()
 
 # 静态文件缓存配置
 app.config["SEND_FILE_MAX_AGE_DEFAULT"] = timedelta(days=30)  # 静态文件默认缓存30天
 
+# 当前用户快照缓存时间（秒），用户资料变更时主动失效
+USER_SNAPSHOT_TIMEOUT = int(os.getenv('USER_SNAPSHOT_TIMEOUT', '300'))
+_USER_SNAPSHOT_EXCLUDED = ('password',)
+_MISSING = object()
+
+
+def _user_snapshot_key(user_id):
+    return f'user_snapshot:{user_id}'
+
+
+def load_user_snapshot(user_id):
+    """读取用户资料快照（不含密码），优先走缓存"""
+    cache = get_cache()
+    key = _user_snapshot_key(user_id)
+    snapshot = cache.get(key)
+    if snapshot is not None:
+        return dict(snapshot)
+    conn = get_db()
+    row = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
+    if not row:
+        return None
+    snapshot = {k: row[k] for k in row.keys() if k not in _USER_SNAPSHOT_EXCLUDED}
+    cache.set(key, snapshot, USER_SNAPSHOT_TIMEOUT)
+    return dict(snapshot)
+
+
+def invalidate_user_snapshot(user_id=None):
+    """用户资料变更后清除快照；不传 user_id 时清除全部"""
+    cache = get_cache()
+    if user_id is None:
+        cache.invalidate_pattern('user_snapshot:')
+    else:
+        cache.delete(_user_snapshot_key(user_id))
+    if has_request_context() and 'user_id' in session and (user_id is None or session['user_id'] == user_id):
+        g.pop('_current_user', None)
+
+
+def get_current_user():
+    """请求内首次访问时加载当前用户并缓存在 g 中"""
+    current_user = g.get('_current_user', _MISSING)
+    if current_user is _MISSING:
+        current_user = None
+        if 'user_id' in session:
+            try:
+                current_user = load_user_snapshot(session['user_id'])
+            except Exception:
+                pass
+        g._current_user = current_user
+    return current_user
+
+
 # 注册CDN辅助函数到模板上下文
 @app.context_processor
 def inject_cdn_helpers():
-    """向模板注入CDN辅助函数"""
-    current_user = None
-    if 'user_id' in session:
-        try:
-            conn = get_db()
-            user_row = conn.execute('SELECT * FROM users WHERE id = ?', (session['user_id'],)).fetchone()
-            if user_row:
-                current_user = dict(user_row)
-        except Exception:
-            pass
+    """向模板注入CDN辅助函数（current_user 按需加载）"""
     return {
         'url_for_static': url_for_static,
+        'static_bundle': static_bundle,
         'cdn_enabled': app.config.get('USE_CDN', False),
         'cdn_url': app.config.get('CDN_URL', ''),
         'static_version': app.config.get('STATIC_VERSION', 'v1'),
-        'current_user': current_user,
+        'current_user': LocalProxy(get_current_user),
         'csrf_token': generate_csrf_token,
+        'file_fragment_version': file_fragment_version,
     }
 
+@app.before_request
+def serve_precompressed_static():
+    """构建产物优先返回预压缩的 .br/.gz 副本"""
+    if not request.path.startswith('/static/dist/') or request.method not in ('GET', 'HEAD'):
+        return None
+    rel_path = request.path[len('/static/'):]
+    suffixes = {'br': '.br', 'gzip': '.gz'}
+    available = [encoding for encoding, suffix in suffixes.items()
+                 if (Path(app.static_folder) / (rel_path + suffix)).is_file()]
+    # 按 Accept-Encoding 的 q 值挑选，q=0 的编码不会被选中
+    encoding = request.accept_encodings.best_match(available) if available else None
+    if encoding not in available:
+        return None
+    response = send_from_directory(app.static_folder, rel_path + suffixes[encoding],
+                                   mimetype=mimetypes.guess_type(rel_path)[0])
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
 # 添加缓存控制头的中间件
 @app.after_request
 def add_cache_headers(response):
+    # 构建产物文件名带内容哈希，内容永不变化（清单本身除外）
+    if request.path.startswith('/static/dist/') and not request.path.endswith('/manifest.json'):
+        response.cache_control.max_age = 31536000
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        response.vary.add('Accept-Encoding')
     # 为静态资源添加缓存头
-    if request.path.startswith('/static/'):
+    elif request.path.startswith('/static/'):
         # 对于CSS、JS、图片等静态资源，设置较长的缓存时间
         if any(ext in request.path for ext in ['.css', '.js', '.png', '.jpg', '.jpeg', '.gif', '.ico', '.svg', '.json', '.woff', '.woff2', '.ttf', '.eot']):
             # 带查询参数(缓存破坏)的请求可以长缓存，否则短缓存
@@ -2461,6 +3274,132 @@ def add_cache_headers(response):
             response.cache_control.must_revalidate = True
     return response
 
+
+SW_PRECACHE_EXTENSIONS = ('.css', '.js')
+SW_PRECACHE_EXTRA = ('icons/icon-192x192.png', 'icons/icon-512x512.png')
+
+
+def service_worker_precache():
+    """根据构建清单生成 Service Worker 的预缓存列表，清单版本变化即触发新 Worker 安装"""
+    manifest = load_static_manifest()
+    hashed = {bundle['file'] for bundle in manifest.get('bundles', {}).values()}
+    hashed.update(path for path in manifest.get('files', {}).values()
+                  if path.endswith(SW_PRECACHE_EXTENSIONS))
+    urls = [_hashed_static_url(path) for path in sorted(hashed)]
+    urls.extend(url_for('static', filename=path) for path in SW_PRECACHE_EXTRA)
+    return {'version': manifest.get('version') or 'dev', 'urls': urls}
+
+
+@app.route('/sw.js', endpoint='service_worker')
+def service_worker():
+    """站点根路径下的 Service Worker，作用域覆盖全站；预缓存清单随脚本一起下发"""
+    script = (Path(app.static_folder) / 'service-worker.js').read_text(encoding='utf-8')
+    precache = json.dumps(service_worker_precache(), ensure_ascii=False)
+    response = make_response(f"self.__PRECACHE_MANIFEST = {precache};\n{script}")
+    response.mimetype = 'application/javascript'
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['Service-Worker-Allowed'] = '/'
+    return response
+
+
+# ==================== 响应压缩 ====================
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_ENABLED = os.getenv('COMPRESS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', '6'))            # gzip 1-9
+COMPRESS_BR_LEVEL = int(os.getenv('COMPRESS_BR_LEVEL', '4'))      # brotli 0-11，动态响应取中低档兼顾CPU
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', '500'))    # 小于该字节数的响应不压缩
+# 只压缩文本类响应；图片、视频、压缩包等本身已压缩的类型直接跳过
+COMPRESS_MIMETYPES = ('text/', 'application/json', 'application/javascript', 'application/xml',
+                      'application/manifest+json', 'image/svg+xml')
+
+
+class _GzipStream:
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        # 每块同步刷新，流式响应（如SSE、导出）的内容能及时到达客户端
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class _BrotliStream:
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+def _choose_encoding():
+    offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+    encoding = request.accept_encodings.best_match(offered)
+    return encoding if encoding in offered else None
+
+
+def _compress_body(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=COMPRESS_BR_LEVEL)
+    return gzip.compress(data, compresslevel=COMPRESS_LEVEL)
+
+
+def _compress_stream(chunks, encoding):
+    """逐块压缩流式响应，结束或中断时关闭原始迭代器"""
+    stream = _BrotliStream(COMPRESS_BR_LEVEL) if encoding == 'br' else _GzipStream(COMPRESS_LEVEL)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            if chunk:
+                yield stream.compress(chunk)
+        yield stream.finish()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close:
+            close()
+
+
+@app.after_request
+def compress_response(response):
+    """按 Accept-Encoding 选择 brotli/gzip 压缩文本响应，流式响应边生成边压缩"""
+    if (not COMPRESS_ENABLED or request.method == 'HEAD' or response.status_code != 200
+            or 'Content-Encoding' in response.headers
+            or not (response.mimetype or '').startswith(COMPRESS_MIMETYPES)
+            or 'no-transform' in response.headers.get('Cache-Control', '')):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = _choose_encoding()
+    if not encoding:
+        return response
+
+    streamed = response.is_streamed or response.direct_passthrough
+    if not streamed:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        response.set_data(_compress_body(data, encoding))
+    else:
+        response.response = _compress_stream(response.response, encoding)
+        response.direct_passthrough = False
+        response.headers.pop('Content-Length', None)
+
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
 DKFILE_BASE = os.getenv("DKFILE_API_BASE", "http://dkfile.net/dkfile_api")
 DKFILE_API_KEY = os.getenv("DKFILE_API_KEY")
 DKFILE_AUTH_SCHEME = os.getenv("DKFILE_AUTH_SCHEME", "bearer")
@@ -2744,9 +3683,8 @@ def get_db():
     return g.db
 
 
-@app.teardown_appcontext
-def close_db(exception):
-    """请求结束后关闭数据库连接"""
+def release_db():
+    """提前真正关闭当前请求的数据库连接（如在慢速外部调用之前），之后 get_db() 会重新连接"""
     db = g.pop('db', None)
     if db is not None:
         if isinstance(db, SafeConnectionWrapper):
@@ -2756,6 +3694,12 @@ def close_db(exception):
             db.close()
 
 
+@app.teardown_appcontext
+def close_db(exception):
+    """请求结束后关闭数据库连接"""
+    release_db()
+
+
 # 全局监控器实例（用于API访问）
 query_monitor = QueryMonitor()
 
@@ -2880,6 +3824,8 @@ def init_db():
     # 初始化时使用直接连接（不使用Flask g对象）
     conn = sqlite3.connect(str(DB_FILE))
     conn.row_factory = sqlite3.Row
+    # 新建数据库使用增量回收模式（对已有数据库无效，需管理员确认后由后台维护任务转换）
+    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
     try:
         conn.execute('''CREATE TABLE IF NOT EXISTS users (
                         id TEXT PRIMARY KEY,
@@ -2959,6 +3905,49 @@ def init_db():
         except sqlite3.OperationalError:
             # 字段已经存在，跳过
             pass
+
+        # 文件夹闭包表：每对（祖先, 后代）一行，depth为层级差，自身depth=0
+        closure_exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'folder_closure'").fetchone()
+        conn.execute('''CREATE TABLE IF NOT EXISTS folder_closure (
+                        ancestor TEXT NOT NULL,
+                        descendant TEXT NOT NULL,
+                        depth INTEGER NOT NULL,
+                        PRIMARY KEY (ancestor, descendant)
+                    ) WITHOUT ROWID''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_folder_closure_descendant ON folder_closure(descendant, depth)')
+
+        # 闭包表触发器：所有写folders的路径（创建/移动/删除）自动维护
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_folder_closure_insert
+                        AFTER INSERT ON folders
+                        BEGIN
+                            INSERT OR IGNORE INTO folder_closure (ancestor, descendant, depth)
+                            VALUES (NEW.id, NEW.id, 0);
+                            INSERT OR IGNORE INTO folder_closure (ancestor, descendant, depth)
+                            SELECT ancestor, NEW.id, depth + 1 FROM folder_closure
+                            WHERE descendant = NEW.parent_id;
+                        END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_folder_closure_move
+                        AFTER UPDATE OF parent_id ON folders
+                        WHEN COALESCE(OLD.parent_id, '') != COALESCE(NEW.parent_id, '')
+                        BEGIN
+                            DELETE FROM folder_closure
+                            WHERE descendant IN (SELECT descendant FROM folder_closure WHERE ancestor = NEW.id)
+                              AND ancestor NOT IN (SELECT descendant FROM folder_closure WHERE ancestor = NEW.id);
+                            INSERT OR IGNORE INTO folder_closure (ancestor, descendant, depth)
+                            SELECT p.ancestor, c.descendant, p.depth + c.depth + 1
+                            FROM folder_closure p, folder_closure c
+                            WHERE p.descendant = NEW.parent_id AND c.ancestor = NEW.id;
+                        END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_folder_closure_delete
+                        AFTER DELETE ON folders
+                        BEGIN
+                            DELETE FROM folder_closure WHERE descendant = OLD.id OR ancestor = OLD.id;
+                        END''')
+
+        # 首次创建闭包表时，从parent_id回填历史层级
+        if not closure_exists:
+            rebuild_folder_closure(conn)
         
         # 检查并添加user_id列（如果不存在）
         try:
@@ -3021,7 +4010,46 @@ def init_db():
                         FOREIGN KEY (user_id) REFERENCES users (id),
                         UNIQUE(file_id, user_id)
                     )''')
-        
+
+        # 为files表添加点赞/收藏计数列（反范式化，避免列表页逐行COUNT）
+        engagement_columns_added = False
+        for column in ('like_count', 'favorite_count'):
+            try:
+                conn.execute(f'ALTER TABLE files ADD COLUMN {column} INTEGER DEFAULT 0')
+                engagement_columns_added = True
+            except sqlite3.OperationalError:
+                pass
+
+        # 点赞/收藏计数触发器：与likes/favorites的写入处于同一事务
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_likes_count_insert
+                        AFTER INSERT ON likes
+                        BEGIN
+                            UPDATE files SET like_count = COALESCE(like_count, 0) + 1
+                            WHERE id = NEW.file_id;
+                        END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_likes_count_delete
+                        AFTER DELETE ON likes
+                        BEGIN
+                            UPDATE files SET like_count = MAX(COALESCE(like_count, 0) - 1, 0)
+                            WHERE id = OLD.file_id;
+                        END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_favorites_count_insert
+                        AFTER INSERT ON favorites
+                        BEGIN
+                            UPDATE files SET favorite_count = COALESCE(favorite_count, 0) + 1
+                            WHERE id = NEW.file_id;
+                        END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS trg_favorites_count_delete
+                        AFTER DELETE ON favorites
+                        BEGIN
+                            UPDATE files SET favorite_count = MAX(COALESCE(favorite_count, 0) - 1, 0)
+                            WHERE id = OLD.file_id;
+                        END''')
+
+        # 首次添加计数列时，从明细表回填历史数据
+        if engagement_columns_added:
+            reconcile_engagement_counters(conn)
+
         # 创建文件分类表
         conn.execute('''CREATE TABLE IF NOT EXISTS categories (
                         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -3109,20 +4137,69 @@ def init_db():
                         FOREIGN KEY (user_id) REFERENCES users (id)
                     )''')
         
-        # 创建文件分享链接表
-        conn.execute('''CREATE TABLE IF NOT EXISTS file_shares (
+        # AI 任务表：记录外部 AI 调用的状态（pending/running/done/failed）
+        conn.execute('''CREATE TABLE IF NOT EXISTS ai_jobs (
                         id TEXT PRIMARY KEY,
-                        file_id TEXT NOT NULL,
                         user_id TEXT NOT NULL,
-                        token TEXT,
-                        share_url TEXT,
-                        password TEXT,
-                        download_count INTEGER DEFAULT 0,
-                        download_limit INTEGER,
-                        expires_at TIMESTAMP,
-                        created_by TEXT,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        FOREIGN KEY (file_id) REFERENCES files (id),
+                        job_type TEXT NOT NULL,
+                        status TEXT NOT NULL DEFAULT 'pending',
+                        model TEXT,
+                        prompt TEXT,
+                        target_id TEXT,
+                        content_id TEXT,
+                        response TEXT,
+                        error TEXT,
+                        created_at TIMESTAMP,
+                        started_at TIMESTAMP,
+                        finished_at TIMESTAMP,
+                        FOREIGN KEY (user_id) REFERENCES users (id)
+                    )''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_ai_jobs_user ON ai_jobs(user_id, created_at)')
+
+        # AI 多轮会话：服务端保存完整消息，旧轮次折叠为滚动摘要（summary 覆盖 seq <= summary_upto）
+        conn.execute('''CREATE TABLE IF NOT EXISTS ai_conversations (
+                        id TEXT PRIMARY KEY,
+                        user_id TEXT NOT NULL,
+                        title TEXT DEFAULT '',
+                        model TEXT,
+                        system_prompt TEXT DEFAULT '',
+                        summary TEXT DEFAULT '',
+                        summary_upto INTEGER DEFAULT 0,
+                        message_count INTEGER DEFAULT 0,
+                        created_at TIMESTAMP,
+                        updated_at TIMESTAMP,
+                        FOREIGN KEY (user_id) REFERENCES users (id)
+                    )''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_ai_conversations_user ON ai_conversations(user_id, updated_at)')
+        conn.execute('''CREATE TABLE IF NOT EXISTS ai_messages (
+                        id TEXT PRIMARY KEY,
+                        conversation_id TEXT NOT NULL,
+                        seq INTEGER NOT NULL,
+                        role TEXT NOT NULL,
+                        content TEXT NOT NULL,
+                        token_estimate INTEGER DEFAULT 0,
+                        created_at TIMESTAMP,
+                        FOREIGN KEY (conversation_id) REFERENCES ai_conversations (id)
+                    )''')
+        conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_ai_messages_seq ON ai_messages(conversation_id, seq)')
+        # 上次进程退出时未完成的任务不会再被执行
+        conn.execute("""UPDATE ai_jobs SET status = 'failed', error = '服务重启，任务中断'
+                        WHERE status IN ('pending', 'running')""")
+
+        # 创建文件分享链接表
+        conn.execute('''CREATE TABLE IF NOT EXISTS file_shares (
+                        id TEXT PRIMARY KEY,
+                        file_id TEXT NOT NULL,
+                        user_id TEXT NOT NULL,
+                        token TEXT,
+                        share_url TEXT,
+                        password TEXT,
+                        download_count INTEGER DEFAULT 0,
+                        download_limit INTEGER,
+                        expires_at TIMESTAMP,
+                        created_by TEXT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        FOREIGN KEY (file_id) REFERENCES files (id),
                         FOREIGN KEY (user_id) REFERENCES users (id)
                     )''')
         try:
@@ -3346,6 +4423,32 @@ def init_db():
                         FOREIGN KEY (uploaded_by) REFERENCES users(id)
                     )''')
 
+        # 工作空间成员/文件计数列，由触发器维护，列表页不再逐行COUNT
+        workspace_columns_added = False
+        for column in ('member_count', 'file_count'):
+            try:
+                conn.execute(f'ALTER TABLE workspaces ADD COLUMN {column} INTEGER DEFAULT 0')
+                workspace_columns_added = True
+            except sqlite3.OperationalError:
+                pass
+
+        for table, column in (('workspace_members', 'member_count'), ('workspace_files', 'file_count')):
+            conn.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_count_insert
+                            AFTER INSERT ON {table}
+                            BEGIN
+                                UPDATE workspaces SET {column} = COALESCE({column}, 0) + 1
+                                WHERE id = NEW.workspace_id;
+                            END''')
+            conn.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_count_delete
+                            AFTER DELETE ON {table}
+                            BEGIN
+                                UPDATE workspaces SET {column} = MAX(COALESCE({column}, 0) - 1, 0)
+                                WHERE id = OLD.workspace_id;
+                            END''')
+
+        if workspace_columns_added:
+            reconcile_workspace_counters(conn)
+
         conn.execute('''CREATE TABLE IF NOT EXISTS file_comments (
                         id TEXT PRIMARY KEY,
                         file_id TEXT NOT NULL,
@@ -3405,6 +4508,12 @@ def init_db():
         except sqlite3.OperationalError:
             pass
 
+        # 小程序无状态令牌版本：递增即吊销该用户已签发的全部无状态令牌
+        try:
+            conn.execute('ALTER TABLE users ADD COLUMN token_version INTEGER DEFAULT 0')
+        except sqlite3.OperationalError:
+            pass
+
         # 安全相关索引
         conn.execute('''CREATE INDEX IF NOT EXISTS idx_user_2fa_user ON user_2fa(user_id)''')
         conn.execute('''CREATE INDEX IF NOT EXISTS idx_login_devices_user ON login_devices(user_id)''')
@@ -3426,6 +4535,12 @@ def init_db():
     except Exception as e:
         print(f"[数据库] 索引创建警告: {e}")
 
+    # 日志统一视图（当前表 + 归档分区）
+    try:
+        refresh_log_views(conn)
+    except Exception as e:
+        print(f"[数据库] 日志视图创建警告: {e}")
+
     conn.close()
 
 
@@ -3445,6 +4560,8 @@ def create_database_indexes(conn):
         ("idx_files_is_deleted", "CREATE INDEX IF NOT EXISTS idx_files_is_deleted ON files(is_deleted)"),
         ("idx_files_created_at", "CREATE INDEX IF NOT EXISTS idx_files_created_at ON files(created_at)"),
         ("idx_files_user_folder", "CREATE INDEX IF NOT EXISTS idx_files_user_folder ON files(user_id, folder_id)"),
+        ("idx_files_popularity", "CREATE INDEX IF NOT EXISTS idx_files_popularity ON files(like_count DESC, favorite_count DESC)"),
+        ("idx_files_user_popularity", "CREATE INDEX IF NOT EXISTS idx_files_user_popularity ON files(user_id, like_count DESC, favorite_count DESC)"),
 
         # folders表索引
         ("idx_folders_user_id", "CREATE INDEX IF NOT EXISTS folders_user_id ON folders(user_id)"),
@@ -3495,6 +4612,11 @@ def create_database_indexes(conn):
 
         # file_versions表索引
         ("idx_versions_file_id", "CREATE INDEX IF NOT EXISTS idx_versions_file_id ON file_versions(file_id)"),
+
+        # 评论分页索引：顶层评论按文件、回复按父评论做游标翻页
+        ("idx_comments_file_thread", "CREATE INDEX IF NOT EXISTS idx_comments_file_thread ON file_comments(file_id, parent_id, created_at, id)"),
+        ("idx_comments_parent", "CREATE INDEX IF NOT EXISTS idx_comments_parent ON file_comments(parent_id, created_at, id)"),
+        ("idx_comment_reactions_comment", "CREATE INDEX IF NOT EXISTS idx_comment_reactions_comment ON comment_reactions(comment_id, emoji)"),
     ]
 
     created_count = 0
@@ -3723,8 +4845,8 @@ def get_all_files(user_id=None):
     result = []
     for row in rows:
         file_id = row["id"]
-        like_count = conn.execute('SELECT COUNT(*) as count FROM likes WHERE file_id = ?', (file_id,)).fetchone()['count']
-        favorite_count = conn.execute('SELECT COUNT(*) as count FROM favorites WHERE file_id = ?', (file_id,)).fetchone()['count']
+        like_count = row["like_count"] or 0
+        favorite_count = row["favorite_count"] or 0
 
         categories = []
         category_rows = conn.execute('''SELECT c.* FROM categories c
@@ -3783,8 +4905,8 @@ def get_file_by_id(file_id, user_id=None, check_owner=True):
     else:
         row = conn.execute('SELECT * FROM files WHERE id = ?', (file_id,)).fetchone()
     if row:
-        like_count = conn.execute('SELECT COUNT(*) as count FROM likes WHERE file_id = ?', (file_id,)).fetchone()['count']
-        favorite_count = conn.execute('SELECT COUNT(*) as count FROM favorites WHERE file_id = ?', (file_id,)).fetchone()['count']
+        like_count = row["like_count"] or 0
+        favorite_count = row["favorite_count"] or 0
 
         categories = []
         category_rows = conn.execute('''SELECT c.* FROM categories c
@@ -4016,14 +5138,175 @@ def log_access(file_id, action, request):
     conn.commit()
 
 
-def cleanup_old_logs():
-    """清理超过一周的访问记录和操作日志"""
-    conn = get_db()
-    conn.execute('''DELETE FROM access_logs
-                    WHERE access_time < datetime('now', '-7 days')''')
-    conn.execute('''DELETE FROM operation_logs
-                    WHERE created_at < datetime('now', '-7 days')''')
-    conn.commit()
+def cleanup_old_logs(days_to_keep=7):
+    """将超过一周的访问记录和操作日志移入按月分区的归档表，并删除超过保留期的分区"""
+    result = archive_old_logs(days_to_keep=days_to_keep)
+    cleanup_archive_tables(max_age_days=LOG_ARCHIVE_RETENTION_DAYS)
+    return result
+
+
+# ==================== 回收站批量引擎 ====================
+
+# 批量操作按块执行，避免 IN (...) 参数超过 SQLite 上限
+TRASH_BATCH_SIZE = int(os.getenv('TRASH_BATCH_SIZE', '500'))
+
+# 列表展示用的北京时间与剩余天数，直接在SQL中计算
+TRASH_LIST_COLUMNS = """*,
+    COALESCE(datetime(deleted_at, '+8 hours'), deleted_at) AS deleted_at_display,
+    CASE WHEN expire_at IS NULL OR julianday(expire_at) IS NULL THEN 30
+         ELSE MAX(0, CAST(julianday(expire_at) - julianday('now') AS INTEGER)) END AS days_remaining,
+    CASE WHEN expire_at IS NOT NULL AND julianday(expire_at) < julianday('now') THEN 1 ELSE 0 END AS is_expired"""
+
+
+def _chunked(items, size=None):
+    size = size or TRASH_BATCH_SIZE
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _placeholders(count):
+    return ','.join('?' * count)
+
+
+def _trash_timestamps():
+    from datetime import timezone
+    bj_tz = timezone(timedelta(hours=8))
+    now = datetime.now(bj_tz)
+    return (now.strftime('%Y-%m-%d %H:%M:%S') + '+08:00',
+            (now + timedelta(days=30)).isoformat())
+
+
+def _unlink_in_background(paths):
+    """在后台线程中删除物理文件，数据库事务不等待磁盘IO"""
+    paths = [p for p in dict.fromkeys(paths) if p]
+    if not paths:
+        return None
+
+    def _worker():
+        failed = 0
+        for path in paths:
+            try:
+                if os.path.exists(path):
+                    os.unlink(path)
+            except Exception as e:
+                failed += 1
+                print(f"[回收站] 删除文件失败: {path}, 错误: {e}")
+        if failed:
+            print(f"[回收站] {failed}/{len(paths)} 个文件删除失败")
+
+    thread = threading.Thread(target=_worker, name='trash-unlink', daemon=True)
+    thread.start()
+    return thread
+
+
+def _trash_item_paths(item):
+    paths = []
+    if item['stored_name']:
+        paths.append(os.path.join(str(UPLOAD_DIR), item['stored_name']))
+    if item['file_path']:
+        paths.append(item['file_path'])
+    return paths
+
+
+def trash_files(conn, user_id, file_ids):
+    """
+    批量将文件移入回收站（每块一条 INSERT ... SELECT 加一条 DELETE）
+
+    返回移入的文件数，调用方负责提交事务
+    """
+    deleted_at, expire_at = _trash_timestamps()
+    moved = 0
+    for chunk in _chunked([fid for fid in file_ids if fid]):
+        marks = _placeholders(len(chunk))
+        conn.execute(f'''INSERT INTO trash (id, file_id, user_id, filename, stored_name, file_path,
+                                            file_size, file_type, folder_id, deleted_at, expire_at)
+                         SELECT {SQL_UUID4}, id, user_id, filename, stored_name, COALESCE(path, ''),
+                                COALESCE(size, 0), '', folder_id, ?, ?
+                         FROM files WHERE user_id = ? AND id IN ({marks})''',
+                     (deleted_at, expire_at, user_id, *chunk))
+        moved += conn.execute(f'DELETE FROM files WHERE user_id = ? AND id IN ({marks})',
+                              (user_id, *chunk)).rowcount
+    return moved
+
+
+def restore_trash_items(conn, user_id, trash_ids):
+    """
+    批量恢复回收站项目
+
+    原文件记录仍在时只移除回收站项；原文件夹已删除的恢复到根目录。
+    返回恢复的项目列表（id, filename），调用方负责提交事务
+    """
+    restored = []
+    for chunk in _chunked([tid for tid in trash_ids if tid]):
+        marks = _placeholders(len(chunk))
+        rows = conn.execute(f'SELECT id, filename FROM trash WHERE user_id = ? AND id IN ({marks})',
+                            (user_id, *chunk)).fetchall()
+        if not rows:
+            continue
+        conn.execute(f'''INSERT OR IGNORE INTO files (id, user_id, filename, stored_name, path, size, folder_id)
+                         SELECT t.file_id, t.user_id, t.filename, t.stored_name, COALESCE(t.file_path, ''),
+                                COALESCE(t.file_size, 0),
+                                CASE WHEN t.folder_id IN (SELECT id FROM folders) THEN t.folder_id END
+                         FROM trash t
+                         WHERE COALESCE(t.file_id, '') != '' AND t.user_id = ? AND t.id IN ({marks})''',
+                     (user_id, *chunk))
+        # 点赞/收藏记录在移入回收站时保留，恢复的文件按现有记录重算冗余计数
+        conn.execute(f'''UPDATE files
+                         SET like_count = (SELECT COUNT(*) FROM likes WHERE file_id = files.id),
+                             favorite_count = (SELECT COUNT(*) FROM favorites WHERE file_id = files.id)
+                         WHERE id IN (SELECT file_id FROM trash WHERE user_id = ? AND id IN ({marks}))''',
+                     (user_id, *chunk))
+        conn.execute(f'DELETE FROM trash WHERE user_id = ? AND id IN ({marks})', (user_id, *chunk))
+        restored.extend(dict(r) for r in rows)
+    return restored
+
+
+def purge_trash_items(conn, user_id=None, trash_ids=None, expired_before=None, delete_file_rows=False):
+    """
+    批量永久删除回收站项目
+
+    参数:
+        user_id: 仅处理该用户的项目（None 表示所有用户）
+        trash_ids: 指定项目ID；为 None 时处理符合条件的全部项目
+        expired_before: 仅处理 expire_at 早于该时间的项目
+        delete_file_rows: 同时删除 files 表中残留的同ID记录
+
+    每块单独提交，物理文件在后台线程删除。返回被删除的项目列表（id, filename）
+    """
+    conditions, params = [], []
+    if user_id is not None:
+        conditions.append('user_id = ?')
+        params.append(user_id)
+    if expired_before is not None:
+        conditions.append('expire_at IS NOT NULL AND expire_at < ?')
+        params.append(expired_before)
+    where = ' AND '.join(conditions) or '1 = 1'
+
+    if trash_ids is None:
+        rows = conn.execute(f'SELECT id, file_id, filename, stored_name, file_path FROM trash WHERE {where}',
+                            params).fetchall()
+    else:
+        rows = []
+        for chunk in _chunked([tid for tid in trash_ids if tid]):
+            rows.extend(conn.execute(
+                f'''SELECT id, file_id, filename, stored_name, file_path FROM trash
+                    WHERE {where} AND id IN ({_placeholders(len(chunk))})''',
+                (*params, *chunk)).fetchall())
+
+    purged, paths = [], []
+    for chunk in _chunked(rows):
+        ids = [r['id'] for r in chunk]
+        conn.executemany('DELETE FROM trash WHERE id = ?', [(tid,) for tid in ids])
+        if delete_file_rows:
+            conn.executemany('DELETE FROM files WHERE id = ?', [(r['file_id'],) for r in chunk if r['file_id']])
+        conn.commit()
+        for r in chunk:
+            paths.extend(_trash_item_paths(r))
+            purged.append({'id': r['id'], 'filename': r['filename']})
+
+    _unlink_in_background(paths)
+    return purged
 
 
 def cleanup_expired_trash():
@@ -4031,26 +5314,10 @@ def cleanup_expired_trash():
     conn = sqlite3.connect(str(DB_FILE))
     conn.row_factory = sqlite3.Row
     try:
-        expired_items = conn.execute('''
-            SELECT * FROM trash
-            WHERE expire_at < datetime('now')
-        ''').fetchall()
-
-        deleted_count = 0
-        for item in expired_items:
-            if os.path.exists(item['file_path']):
-                try:
-                    os.unlink(item['file_path'])
-                except Exception as e:
-                    print(f"删除文件失败: {item['file_path']}, 错误: {str(e)}")
-
-            conn.execute('DELETE FROM files WHERE id = ?', (item['file_id'],))
-            conn.execute('DELETE FROM trash WHERE id = ?', (item['id'],))
-            deleted_count += 1
-
-        conn.commit()
-        if deleted_count > 0:
-            print(f"已清理 {deleted_count} 个过期回收站文件")
+        purged = purge_trash_items(conn, expired_before=datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+                                   delete_file_rows=True)
+        if purged:
+            print(f"已清理 {len(purged)} 个过期回收站文件")
     except Exception as e:
         print(f"清理回收站失败: {str(e)}")
         conn.rollback()
@@ -4060,84 +5327,158 @@ def cleanup_expired_trash():
 
 # ==================== 数据归档机制 ====================
 
-def archive_old_logs(days_to_keep=90):
+# 日志按月分区归档：access_logs/operation_logs 中的旧记录按时间所在月份
+# 批量移入 <表名>_archive_YYYYMM 分区表，过期分区整表删除
+LOG_ARCHIVE_BATCH_SIZE = int(os.getenv('LOG_ARCHIVE_BATCH_SIZE', '1000'))
+LOG_ARCHIVE_RETENTION_DAYS = int(os.getenv('LOG_ARCHIVE_RETENTION_DAYS', '365'))
+
+_LOG_PARTITION_SPECS = {
+    'access_logs': {
+        'time_column': 'access_time',
+        'columns': ('id', 'file_id', 'user_id', 'action', 'ip_address', 'user_agent', 'access_time'),
+    },
+    'operation_logs': {
+        'time_column': 'created_at',
+        'columns': ('id', 'user_id', 'action', 'target_id', 'target_type', 'message', 'details', 'created_at'),
+    },
+}
+
+_LOG_PARTITION_RE = re.compile(r'^(access_logs|operation_logs)_archive_(\d{6})$')
+
+
+def _ensure_log_partition(conn, base_table, month_key):
+    """创建（如不存在）指定月份的日志分区表，返回表名"""
+    spec = _LOG_PARTITION_SPECS[base_table]
+    table = f"{base_table}_archive_{month_key}"
+    column_defs = ', '.join(
+        'id INTEGER PRIMARY KEY' if col == 'id'
+        else f'{col} TIMESTAMP' if col == spec['time_column']
+        else f'{col} TEXT'
+        for col in spec['columns']
+    )
+    conn.execute(f'''CREATE TABLE IF NOT EXISTS {table} (
+                    {column_defs},
+                    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )''')
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_time ON {table}({spec['time_column']})")
+    return table
+
+
+def list_log_partitions(conn, base_table=None):
+    """列出已存在的日志分区表，返回 [(基础表名, 'YYYYMM', 分区表名)]，按月份升序"""
+    rows = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE '%\\_archive\\_%' ESCAPE '\\'"
+    ).fetchall()
+    partitions = []
+    for row in rows:
+        match = _LOG_PARTITION_RE.match(row[0])
+        if match and (base_table is None or match.group(1) == base_table):
+            partitions.append((match.group(1), match.group(2), row[0]))
+    partitions.sort(key=lambda p: (p[0], p[1]))
+    return partitions
+
+
+def refresh_log_views(conn):
+    """
+    重建 access_logs_all / operation_logs_all 统一视图
+
+    视图合并当前日志表、旧版归档表和全部月度分区，log_source 列标明数据来源，
+    供报表查询使用。分区增删后需重新调用。
     """
-    归档旧日志数据到归档表
+    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    for base_table, spec in _LOG_PARTITION_SPECS.items():
+        columns = ', '.join(spec['columns'])
+        selects = [f"SELECT {columns}, '{base_table}' AS log_source FROM {base_table}"]
+        legacy_table = f"{base_table}_archive"
+        if legacy_table in existing:
+            selects.append(f"SELECT {columns}, '{legacy_table}' AS log_source FROM {legacy_table}")
+        for _, _, table in list_log_partitions(conn, base_table):
+            selects.append(f"SELECT {columns}, '{table}' AS log_source FROM {table}")
+
+        conn.execute(f"DROP VIEW IF EXISTS {base_table}_all")
+        conn.execute(f"CREATE VIEW {base_table}_all AS " + ' UNION ALL '.join(selects))
+    conn.commit()
+
+
+def _next_month_start(month):
+    """'YYYY-MM' -> 下个月1日 'YYYY-MM-01'"""
+    year, mon = int(month[:4]), int(month[5:7])
+    year, mon = (year + 1, 1) if mon == 12 else (year, mon + 1)
+    return f"{year:04d}-{mon:02d}-01"
+
+
+def _move_logs_to_partitions(conn, base_table, cutoff_date, batch_size):
+    """
+    将 base_table 中早于 cutoff_date 的记录按月批量移入分区表
+
+    每批按 id 取最多 batch_size 行，用 INSERT ... SELECT 与 DELETE 两条语句
+    在同一事务中完成搬移并立即提交，避免长时间占用写锁。
+    """
+    spec = _LOG_PARTITION_SPECS[base_table]
+    time_col = spec['time_column']
+    columns = ', '.join(spec['columns'])
+
+    months = [row[0] for row in conn.execute(
+        f"SELECT DISTINCT substr({time_col}, 1, 7) FROM {base_table} WHERE {time_col} < ?",
+        (cutoff_date,)
+    ).fetchall() if row[0] and re.match(r'^\d{4}-\d{2}$', row[0])]
+
+    moved_total = 0
+    for month in sorted(months):
+        month_start = f"{month}-01"
+        upper_bound = min(_next_month_start(month), cutoff_date)
+        table = _ensure_log_partition(conn, base_table, month.replace('-', ''))
+
+        while True:
+            max_id = conn.execute(f'''
+                SELECT MAX(id) FROM (
+                    SELECT id FROM {base_table}
+                    WHERE {time_col} >= ? AND {time_col} < ?
+                    ORDER BY id LIMIT ?
+                )
+            ''', (month_start, upper_bound, batch_size)).fetchone()[0]
+            if max_id is None:
+                break
+
+            params = (month_start, upper_bound, max_id)
+            conn.execute(f'''
+                INSERT OR IGNORE INTO {table} ({columns})
+                SELECT {columns} FROM {base_table}
+                WHERE {time_col} >= ? AND {time_col} < ? AND id <= ?
+            ''', params)
+            moved = conn.execute(f'''
+                DELETE FROM {base_table}
+                WHERE {time_col} >= ? AND {time_col} < ? AND id <= ?
+            ''', params).rowcount
+            conn.commit()
+            moved_total += moved
+
+    return moved_total
+
+
+def archive_old_logs(days_to_keep=90, batch_size=None):
+    """
+    归档旧日志数据到按月分区的归档表
 
     参数:
         days_to_keep: 保留最近N天的日志，默认90天
+        batch_size: 每批搬移的行数，默认 LOG_ARCHIVE_BATCH_SIZE
     """
-    print(f"[数据归档] 开始清理 {days_to_keep} 天前的日志数据...")
+    print(f"[数据归档] 开始归档 {days_to_keep} 天前的日志数据...")
+    batch_size = batch_size or LOG_ARCHIVE_BATCH_SIZE
     conn = sqlite3.connect(str(DB_FILE))
     conn.row_factory = sqlite3.Row
-    total_archived = 0
 
     try:
-        # 创建归档表（如果不存在）
-        conn.execute('''CREATE TABLE IF NOT EXISTS access_logs_archive (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        file_id TEXT,
-                        user_id TEXT,
-                        action TEXT,
-                        ip_address TEXT,
-                        user_agent TEXT,
-                        access_time TIMESTAMP,
-                        archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )''')
+        cutoff_date = (datetime.now() - timedelta(days=days_to_keep)).strftime('%Y-%m-%d %H:%M:%S')
 
-        conn.execute('''CREATE TABLE IF NOT EXISTS operation_logs_archive (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id TEXT,
-                        action TEXT,
-                        target_id TEXT,
-                        target_type TEXT,
-                        message TEXT,
-                        details TEXT,
-                        created_at TIMESTAMP,
-                        archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )''')
+        archived_access = _move_logs_to_partitions(conn, 'access_logs', cutoff_date, batch_size)
+        if archived_access:
+            print(f"  - 访问日志：归档 {archived_access} 条")
 
-        # 归档旧的访问日志
-        cutoff_date = (datetime.now() - timedelta(days=days_to_keep)).strftime('%Y-%m-%d %H:%M:%S')
-        
-        old_access_logs = conn.execute('''
-            SELECT * FROM access_logs 
-            WHERE access_time < ?
-        ''', (cutoff_date,)).fetchall()
-
-        for log in old_access_logs:
-            conn.execute('''
-                INSERT INTO access_logs_archive 
-                (file_id, user_id, action, ip_address, user_agent, access_time)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (log['file_id'], log['user_id'], log['action'],
-                  log['ip_address'], log['user_agent'], log['access_time']))
-            total_archived += 1
-
-        # 删除已归档的访问日志
-        if old_access_logs:
-            conn.execute('DELETE FROM access_logs WHERE access_time < ?', (cutoff_date,))
-            print(f"  - 访问日志：归档 {len(old_access_logs)} 条")
-
-        # 归档旧的操作日志
-        old_op_logs = conn.execute('''
-            SELECT * FROM operation_logs 
-            WHERE created_at < ?
-        ''', (cutoff_date,)).fetchall()
-
-        for log in old_op_logs:
-            conn.execute('''
-                INSERT INTO operation_logs_archive
-                (user_id, action, target_id, target_type, message, details, created_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (log['user_id'], log['action'], log['target_id'],
-                  log['target_type'], log['message'], log['details'], log['created_at']))
-            total_archived += 1
-
-        # 删除已归档的操作日志
-        if old_op_logs:
-            conn.execute('DELETE FROM operation_logs WHERE created_at < ?', (cutoff_date,))
-            print(f"  - 操作日志：归档 {len(old_op_logs)} 条")
+        archived_ops = _move_logs_to_partitions(conn, 'operation_logs', cutoff_date, batch_size)
+        if archived_ops:
+            print(f"  - 操作日志：归档 {archived_ops} 条")
 
         # 清理过期的验证码（超过24小时）
         conn.execute('''
@@ -4152,13 +5493,17 @@ def archive_old_logs(days_to_keep=90):
         ''')
 
         conn.commit()
+        refresh_log_views(conn)
+
+        total_archived = archived_access + archived_ops
         print(f"[数据归档] 完成！共归档 {total_archived} 条记录")
 
         return {
             'success': True,
             'archived_count': total_archived,
-            'access_logs': len(old_access_logs) if 'old_access_logs' in dir() else 0,
-            'operation_logs': len(old_op_logs) if 'old_op_logs' in dir() else 0
+            'access_logs': archived_access,
+            'operation_logs': archived_ops,
+            'partitions': [p[2] for p in list_log_partitions(conn)]
         }
 
     except Exception as e:
@@ -4172,41 +5517,71 @@ def archive_old_logs(days_to_keep=90):
         conn.close()
 
 
-def cleanup_archive_tables(max_age_days=365):
+def cleanup_archive_tables(max_age_days=365, batch_size=None):
     """
-    清理归档表中超过指定时间的数据
+    清理超过指定时间的归档数据
+
+    整月早于保留期的分区直接 DROP TABLE；旧版单表归档
+    （access_logs_archive/operation_logs_archive）中的数据按批删除。
 
     参数:
         max_age_days: 归档数据最大保留天数，默认1年
+        batch_size: 旧版归档表每批删除的行数，默认 LOG_ARCHIVE_BATCH_SIZE
     """
     print(f"[归档清理] 清理超过 {max_age_days} 天的归档数据...")
+    batch_size = batch_size or LOG_ARCHIVE_BATCH_SIZE
     conn = sqlite3.connect(str(DB_FILE))
     conn.row_factory = sqlite3.Row
 
     try:
-        cutoff_date = (datetime.now() - timedelta(days=max_age_days)).strftime('%Y-%m-%d %H:%M:%S')
-
-        deleted_access = conn.execute('''
-            DELETE FROM access_logs_archive WHERE access_time < ?
-        ''', (cutoff_date,)).rowcount
+        cutoff = datetime.now() - timedelta(days=max_age_days)
+        cutoff_date = cutoff.strftime('%Y-%m-%d %H:%M:%S')
+        cutoff_month = cutoff.strftime('%Y%m')
+
+        deleted = {'access_logs': 0, 'operation_logs': 0}
+        dropped_partitions = []
+        for base_table, month_key, table in list_log_partitions(conn):
+            if month_key >= cutoff_month:
+                continue
+            deleted[base_table] += conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+            conn.execute(f'DROP TABLE IF EXISTS {table}')
+            conn.commit()
+            dropped_partitions.append(table)
+
+        existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        for base_table, spec in _LOG_PARTITION_SPECS.items():
+            legacy_table = f"{base_table}_archive"
+            if legacy_table not in existing:
+                continue
+            while True:
+                removed = conn.execute(f'''
+                    DELETE FROM {legacy_table} WHERE rowid IN (
+                        SELECT rowid FROM {legacy_table} WHERE {spec['time_column']} < ? LIMIT ?
+                    )
+                ''', (cutoff_date, batch_size)).rowcount
+                conn.commit()
+                deleted[base_table] += removed
+                if removed < batch_size:
+                    break
 
-        deleted_ops = conn.execute('''
-            DELETE FROM operation_logs_archive WHERE created_at < ?
-        ''', (cutoff_date,)).rowcount
+        refresh_log_views(conn)
 
-        conn.commit()
+        deleted_access = deleted['access_logs']
+        deleted_ops = deleted['operation_logs']
         total_deleted = deleted_access + deleted_ops
 
-        if total_deleted > 0:
+        if total_deleted > 0 or dropped_partitions:
             print(f"[归档清理] 已删除 {total_deleted} 条过期归档数据")
             print(f"  - 访问日志归档：{deleted_access} 条")
             print(f"  - 操作日志归档：{deleted_ops} 条")
+            print(f"  - 删除分区：{len(dropped_partitions)} 个")
 
         return {
             'success': True,
             'deleted_access_logs': deleted_access,
             'deleted_operation_logs': deleted_ops,
-            'total_deleted': total_deleted
+            'total_deleted': total_deleted,
+            'dropped_partitions': dropped_partitions
         }
 
     except Exception as e:
@@ -4220,6 +5595,274 @@ def cleanup_archive_tables(max_age_days=365):
         conn.close()
 
 
+
+# 在SQL中生成UUID4格式的字符串，供INSERT ... SELECT批量写入时生成主键
+SQL_UUID4 = ("lower(hex(randomblob(4))) || '-' || lower(hex(randomblob(2))) || '-4' || "
+             "substr(lower(hex(randomblob(2))), 2) || '-' || "
+             "substr('89ab', 1 + (abs(random()) % 4), 1) || substr(lower(hex(randomblob(2))), 2) || '-' || "
+             "lower(hex(randomblob(6)))")
+
+
+def rebuild_folder_closure(conn=None):
+    """
+    根据folders.parent_id重建文件夹闭包表
+
+    闭包表由触发器实时维护，此函数用于首次建表回填及修复漂移。
+    递归CTE一次算出所有（祖先, 后代, 深度），遇到环时由深度上限截断。
+
+    参数:
+        conn: 可选的已有连接（init_db回填时复用），默认新建独立连接
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = sqlite3.connect(str(DB_FILE))
+        conn.row_factory = sqlite3.Row
+
+    try:
+        conn.execute('DELETE FROM folder_closure')
+        conn.execute('''
+            WITH RECURSIVE paths(ancestor, descendant, depth) AS (
+                SELECT id, id, 0 FROM folders
+                UNION
+                SELECT f.parent_id, p.descendant, p.depth + 1
+                FROM paths p JOIN folders f ON f.id = p.ancestor
+                WHERE f.parent_id IS NOT NULL AND f.parent_id != '' AND p.depth < 64
+            )
+            INSERT OR IGNORE INTO folder_closure (ancestor, descendant, depth)
+            SELECT ancestor, descendant, MIN(depth) FROM paths
+            WHERE ancestor IN (SELECT id FROM folders)
+            GROUP BY ancestor, descendant
+        ''')
+        rows = conn.execute('SELECT COUNT(*) FROM folder_closure').fetchone()[0]
+        conn.commit()
+        return {'success': True, 'rows': rows}
+    except Exception as e:
+        print(f"[文件夹层级] 重建闭包表错误: {e}")
+        conn.rollback()
+        return {'success': False, 'error': str(e)}
+    finally:
+        if own_conn:
+            conn.close()
+
+
+def get_folder_breadcrumbs(conn, folder_id):
+    """一次查询取得从根到当前文件夹的路径"""
+    rows = conn.execute('''SELECT f.id, f.name FROM folder_closure c
+                           JOIN folders f ON f.id = c.ancestor
+                           WHERE c.descendant = ? ORDER BY c.depth DESC''',
+                        (folder_id,)).fetchall()
+    return [dict(r) for r in rows]
+
+
+def get_folder_tree_stats(conn, folder_id):
+    """子树汇总：文件夹数、文件数、总大小（含所有层级）"""
+    row = conn.execute('''SELECT
+                             (SELECT COUNT(*) - 1 FROM folder_closure WHERE ancestor = ?) AS folder_count,
+                             COUNT(f.id) AS file_count,
+                             COALESCE(SUM(f.size), 0) AS total_size
+                          FROM files f
+                          WHERE f.folder_id IN (SELECT descendant FROM folder_closure WHERE ancestor = ?)''',
+                       (folder_id, folder_id)).fetchone()
+    return {
+        'folder_count': max(row['folder_count'] or 0, 0),
+        'file_count': row['file_count'],
+        'total_size': row['total_size'],
+    }
+
+
+def move_folder(conn, folder_id, new_parent_id, user_id):
+    """
+    移动文件夹到新的父文件夹（new_parent_id为空表示移到根目录）
+
+    闭包表由触发器随parent_id更新，整棵子树一次完成。
+    返回 (是否成功, 提示信息)
+    """
+    if new_parent_id:
+        if new_parent_id == folder_id:
+            return False, '不能移动到自身'
+        parent = conn.execute('SELECT id FROM folders WHERE id = ? AND user_id = ?',
+                              (new_parent_id, user_id)).fetchone()
+        if not parent:
+            return False, '目标文件夹不存在或无权限'
+        cycle = conn.execute('SELECT 1 FROM folder_closure WHERE ancestor = ? AND descendant = ?',
+                             (folder_id, new_parent_id)).fetchone()
+        if cycle:
+            return False, '不能移动到自己的子文件夹中'
+
+    updated = conn.execute('UPDATE folders SET parent_id = ? WHERE id = ? AND user_id = ?',
+                           (new_parent_id or None, folder_id, user_id)).rowcount
+    if not updated:
+        return False, '文件夹不存在或无权限'
+    return True, '移动成功'
+
+
+def reconcile_engagement_counters(conn=None):
+    """
+    校正files表中的点赞/收藏计数列
+
+    计数列由触发器实时维护，此任务用于修复绕过触发器写入（如手工修库、
+    数据导入）造成的漂移。只更新与明细表不一致的行。
+
+    参数:
+        conn: 可选的已有连接（init_db回填时复用），默认新建独立连接
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = sqlite3.connect(str(DB_FILE))
+        conn.row_factory = sqlite3.Row
+
+    try:
+        fixed_likes = conn.execute('''
+            UPDATE files SET like_count = (
+                SELECT COUNT(*) FROM likes WHERE likes.file_id = files.id)
+            WHERE COALESCE(like_count, -1) != (
+                SELECT COUNT(*) FROM likes WHERE likes.file_id = files.id)
+        ''').rowcount
+
+        fixed_favorites = conn.execute('''
+            UPDATE files SET favorite_count = (
+                SELECT COUNT(*) FROM favorites WHERE favorites.file_id = files.id)
+            WHERE COALESCE(favorite_count, -1) != (
+                SELECT COUNT(*) FROM favorites WHERE favorites.file_id = files.id)
+        ''').rowcount
+
+        conn.commit()
+
+        if fixed_likes or fixed_favorites:
+            print(f"[计数校正] 点赞计数修正 {fixed_likes} 个文件，收藏计数修正 {fixed_favorites} 个文件")
+
+        return {
+            'success': True,
+            'fixed_like_counts': fixed_likes,
+            'fixed_favorite_counts': fixed_favorites
+        }
+
+    except Exception as e:
+        print(f"[计数校正] 错误: {e}")
+        conn.rollback()
+        return {
+            'success': False,
+            'error': str(e)
+        }
+    finally:
+        if own_conn:
+            conn.close()
+
+
+def reconcile_workspace_counters(conn=None):
+    """
+    校正workspaces表中的成员/文件计数列
+
+    与点赞/收藏计数相同，计数列由触发器维护，此任务修复漂移。
+
+    参数:
+        conn: 可选的已有连接（init_db回填时复用），默认新建独立连接
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = sqlite3.connect(str(DB_FILE))
+        conn.row_factory = sqlite3.Row
+
+    try:
+        fixed_members = conn.execute('''
+            UPDATE workspaces SET member_count = (
+                SELECT COUNT(*) FROM workspace_members WHERE workspace_members.workspace_id = workspaces.id)
+            WHERE COALESCE(member_count, -1) != (
+                SELECT COUNT(*) FROM workspace_members WHERE workspace_members.workspace_id = workspaces.id)
+        ''').rowcount
+
+        fixed_files = conn.execute('''
+            UPDATE workspaces SET file_count = (
+                SELECT COUNT(*) FROM workspace_files WHERE workspace_files.workspace_id = workspaces.id)
+            WHERE COALESCE(file_count, -1) != (
+                SELECT COUNT(*) FROM workspace_files WHERE workspace_files.workspace_id = workspaces.id)
+        ''').rowcount
+
+        conn.commit()
+
+        if fixed_members or fixed_files:
+            print(f"[计数校正] 工作空间成员计数修正 {fixed_members} 个，文件计数修正 {fixed_files} 个")
+
+        return {
+            'success': True,
+            'fixed_member_counts': fixed_members,
+            'fixed_file_counts': fixed_files
+        }
+
+    except Exception as e:
+        print(f"[计数校正] 错误: {e}")
+        conn.rollback()
+        return {
+            'success': False,
+            'error': str(e)
+        }
+    finally:
+        if own_conn:
+            conn.close()
+
+
+# ==================== 工作空间权限缓存 ====================
+
+# (用户, 工作空间) -> 角色 的跨请求缓存时间（秒）
+WORKSPACE_ROLE_CACHE_TIMEOUT = int(os.getenv('WORKSPACE_ROLE_CACHE_TIMEOUT', '300'))
+_NO_ROLE = ''
+
+
+def _workspace_role_version(cache, workspace_id):
+    """工作空间的缓存版本号，成员变动时更换版本即可使该空间所有角色缓存失效"""
+    key = f'ws_role_ver:{workspace_id}'
+    version = cache.get(key)
+    if version is None:
+        version = uuid.uuid4().hex[:12]
+        cache.set(key, version, WORKSPACE_ROLE_CACHE_TIMEOUT * 2)
+    return version
+
+
+def get_workspace_role(workspace_id, user_id):
+    """
+    获取用户在工作空间中的角色（owner/成员角色/None）
+
+    同一请求内的重复检查由 g 缓存，跨请求由统一缓存按版本号缓存
+    """
+    memo = g.setdefault('_workspace_roles', {}) if has_request_context() else {}
+    memo_key = (workspace_id, user_id)
+    if memo_key in memo:
+        return memo[memo_key]
+
+    cache = get_cache()
+    version = _workspace_role_version(cache, workspace_id)
+    cache_key = f'ws_role:{workspace_id}:{version}:{user_id}'
+    role = cache.get(cache_key)
+    if role is None:
+        conn = get_db()
+        row = conn.execute(
+            """SELECT w.owner_id, wm.role FROM workspaces w
+               LEFT JOIN workspace_members wm ON wm.workspace_id = w.id AND wm.user_id = ?
+               WHERE w.id = ?""",
+            (user_id, workspace_id)).fetchone()
+        if not row:
+            role = _NO_ROLE
+        elif row['owner_id'] == user_id:
+            role = 'owner'
+        else:
+            role = row['role'] or _NO_ROLE
+        cache.set(cache_key, role, WORKSPACE_ROLE_CACHE_TIMEOUT)
+
+    role = role or None
+    memo[memo_key] = role
+    return role
+
+
+def invalidate_workspace_roles(workspace_id):
+    """成员加入/移除/角色变更、工作空间删除后调用"""
+    get_cache().delete(f'ws_role_ver:{workspace_id}')
+    if has_request_context():
+        memo = g.get('_workspace_roles')
+        if memo:
+            for key in [k for k in memo if k[0] == workspace_id]:
+                del memo[key]
+
+
 def get_database_stats():
     """获取数据库统计信息"""
     conn = sqlite3.connect(str(DB_FILE))
@@ -4243,6 +5886,9 @@ def get_database_stats():
 
         stats['tables'] = table_stats
 
+        # 日志归档分区
+        stats['log_partitions'] = [p[2] for p in list_log_partitions(conn)]
+
         # 数据库文件大小
         db_size = os.path.getsize(DB_FILE) if os.path.exists(DB_FILE) else 0
         stats['db_size_bytes'] = db_size
@@ -4268,46 +5914,357 @@ def get_database_stats():
         conn.close()
 
 
-def optimize_database():
-    """执行数据库优化操作"""
-    print("[数据库优化] 开始执行VACUUM和ANALYZE...")
-    conn = sqlite3.connect(str(DB_FILE))
-    conn.row_factory = sqlite3.Row
+def optimize_database(jobs=None):
+    """
+    提交数据库优化任务到后台维护调度器
+
+    不再同步执行 VACUUM/ANALYZE（会阻塞所有写入），而是排队由
+    maintenance_scheduler 分步执行并在请求繁忙时让出写锁。
+
+    参数:
+        jobs: 任务名列表，默认全部任务
+    """
+    queued = maintenance_scheduler.trigger(jobs)
+    print(f"[数据库优化] 已提交后台任务: {', '.join(queued)}")
+    db_size = os.path.getsize(DB_FILE) if os.path.exists(DB_FILE) else 0
+    return {
+        'success': True,
+        'queued': queued,
+        'status': maintenance_scheduler.get_status(),
+        'db_size_mb': round(db_size / (1024 * 1024), 2),
+        'message': '数据库优化任务已提交后台执行'
+    }
+
+
+# ==================== 数据库后台维护调度 ====================
+
+DB_MAINTENANCE_ENABLED = os.getenv('DB_MAINTENANCE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# 低峰时段（本地小时，左闭右开），重型任务只在此时段内执行，例如 "2-6"
+DB_MAINTENANCE_WINDOW = os.getenv('DB_MAINTENANCE_WINDOW', '2-6')
+DB_MAINTENANCE_POLL_SECONDS = int(os.getenv('DB_MAINTENANCE_POLL_SECONDS', '60'))
+# 最近一次请求结束后空闲多久才视为可执行维护
+DB_MAINTENANCE_IDLE_SECONDS = float(os.getenv('DB_MAINTENANCE_IDLE_SECONDS', '2'))
+DB_WAL_CHECKPOINT_BYTES = int(os.getenv('DB_WAL_CHECKPOINT_BYTES', str(64 * 1024 * 1024)))
+DB_WAL_TRUNCATE_BYTES = int(os.getenv('DB_WAL_TRUNCATE_BYTES', str(256 * 1024 * 1024)))
+DB_INCREMENTAL_VACUUM_PAGES = int(os.getenv('DB_INCREMENTAL_VACUUM_PAGES', '512'))
+# 已有数据库转换为 auto_vacuum=INCREMENTAL 需要完整 VACUUM（整库重写，全程持有写锁），超过该大小拒绝在线转换
+DB_VACUUM_CONVERT_MAX_MB = int(os.getenv('DB_VACUUM_CONVERT_MAX_MB', '1024'))
+DB_ANALYZE_LIMIT = int(os.getenv('DB_ANALYZE_LIMIT', '1000'))
 
-    try:
-        # VACUUM - 重建数据库文件，释放空间
-        start_time = time.time()
-        conn.execute('VACUUM')
-        vacuum_time = time.time() - start_time
-        print(f"  VACUUM完成，耗时: {vacuum_time:.2f}s")
 
-        # ANALYZE - 更新统计信息以优化查询计划
+class DatabaseMaintenanceScheduler:
+    """
+    数据库后台维护调度器
+
+    在独立线程中周期性执行维护任务：
+      - checkpoint: WAL 超过阈值时执行 wal_checkpoint(PASSIVE)，空闲且超过上限时 TRUNCATE
+      - optimize: PRAGMA optimize
+      - incremental_vacuum: 分步回收空闲页（auto_vacuum=INCREMENTAL）；已有数据库的
+        模式转换需管理员确认，并在低峰时段空闲时执行
+      - analyze: 按表执行采样 ANALYZE（analysis_limit）
+      - reconcile_counters: 校正点赞/收藏计数
+
+    除 checkpoint 外的任务只在低峰时段运行；每一步之间检查请求流量，
+    有请求进行中时让出写锁，等待空闲后继续。
+    """
+
+    # 任务名 -> (执行间隔秒数, 是否仅低峰时段执行)
+    JOBS = {
+        'checkpoint': (60, False),
+        'optimize': (3600, False),
+        'incremental_vacuum': (6 * 3600, True),
+        'analyze': (24 * 3600, True),
+        'reconcile_counters': (24 * 3600, True),
+    }
+    # 手动触发也不能越过低峰时段的任务，非低峰时推迟到下一个低峰时段
+    WINDOW_ONLY_JOBS = ('incremental_vacuum',)
+
+    def __init__(self, db_path):
+        self.db_path = str(db_path)
+        self._lock = threading.Lock()
+        self._run_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._wake_event = threading.Event()
+        self._thread = None
+        self._active_requests = 0
+        self._last_request_end = 0.0
+        self._pending = []
+        self._last_run = {}
+        self._convert_requested = False
+        self._status = {'running_job': None, 'progress': None, 'history': {}}
+
+    # ---------- 请求流量跟踪 ----------
+
+    def request_started(self):
+        with self._lock:
+            self._active_requests += 1
+
+    def request_finished(self):
+        with self._lock:
+            self._active_requests = max(self._active_requests - 1, 0)
+            self._last_request_end = time.time()
+
+    def is_idle(self):
+        with self._lock:
+            return (self._active_requests == 0 and
+                    time.time() - self._last_request_end >= DB_MAINTENANCE_IDLE_SECONDS)
+
+    def _yield_to_traffic(self, max_wait=30):
+        """有请求进行中时等待空闲，返回 False 表示调度器已停止或等待超时仍繁忙"""
+        deadline = time.time() + max_wait
+        while not self.is_idle() and time.time() < deadline:
+            if self._stop_event.wait(0.2):
+                return False
+        return self.is_idle() and not self._stop_event.is_set()
+
+    @staticmethod
+    def in_off_peak_window(now=None):
+        try:
+            start, end = (int(x) for x in DB_MAINTENANCE_WINDOW.split('-', 1))
+        except ValueError:
+            return True
+        hour = (now or datetime.now()).hour
+        if start <= end:
+            return start <= hour < end
+        return hour >= start or hour < end
+
+    # ---------- 调度 ----------
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.is_running():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True, name="DbMaintenanceScheduler")
+        self._thread.start()
+        print(f"[数据库维护] 后台调度已启动，低峰时段: {DB_MAINTENANCE_WINDOW}")
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake_event.set()
+        self._thread = None
+
+    def trigger(self, jobs=None):
+        """立即排队执行指定任务（WINDOW_ONLY_JOBS 以外忽略低峰时段限制），返回已排队的任务名列表"""
+        jobs = [j for j in (jobs or self.JOBS) if j in self.JOBS]
+        off_peak = self.in_off_peak_window()
+        queued = []
+        with self._lock:
+            for job in jobs:
+                if job in self.WINDOW_ONLY_JOBS and not off_peak:
+                    # 清除上次执行时间，调度线程进入低峰时段后立即执行
+                    self._last_run.pop(job, None)
+                    continue
+                if job not in self._pending:
+                    self._pending.append(job)
+                queued.append(job)
+        if not queued:
+            return queued
+        if self.is_running():
+            self._wake_event.set()
+        else:
+            # 调度线程未启动时用一次性后台线程执行，不阻塞调用方
+            threading.Thread(target=self._run_pending, daemon=True, name="DbMaintenanceOnce").start()
+        return queued
+
+    def _db_size(self):
+        return os.path.getsize(self.db_path) if os.path.exists(self.db_path) else 0
+
+    def request_auto_vacuum_conversion(self):
+        """管理员确认后登记 auto_vacuum 转换，由低峰时段的 incremental_vacuum 任务在空闲时执行"""
+        db_size_mb = round(self._db_size() / (1024 * 1024), 2)
+        result = {'db_size_mb': db_size_mb, 'max_mb': DB_VACUUM_CONVERT_MAX_MB}
+        if db_size_mb > DB_VACUUM_CONVERT_MAX_MB:
+            result.update(success=False, message=f'数据库 {db_size_mb}MB 超过在线转换上限 {DB_VACUUM_CONVERT_MAX_MB}MB，请停机后离线执行 VACUUM')
+            return result
+        with self._lock:
+            self._convert_requested = True
+            self._last_run.pop('incremental_vacuum', None)
+        result.update(success=True, message=f'已登记，将在低峰时段 {DB_MAINTENANCE_WINDOW} 空闲时执行完整 VACUUM')
+        return result
+
+    def get_status(self):
+        with self._lock:
+            return {
+                'enabled': self.is_running(),
+                'off_peak_window': DB_MAINTENANCE_WINDOW,
+                'in_off_peak': self.in_off_peak_window(),
+                'active_requests': self._active_requests,
+                'pending': list(self._pending),
+                'auto_vacuum_conversion_requested': self._convert_requested,
+                'running_job': self._status['running_job'],
+                'progress': self._status['progress'],
+                'history': dict(self._status['history']),
+            }
+
+    def _loop(self):
+        stop = self._stop_event
+        while not stop.is_set():
+            self._wake_event.wait(DB_MAINTENANCE_POLL_SECONDS)
+            self._wake_event.clear()
+            if stop.is_set():
+                break
+            now = time.time()
+            off_peak = self.in_off_peak_window()
+            with self._lock:
+                for job, (interval, off_peak_only) in self.JOBS.items():
+                    if off_peak_only and not off_peak:
+                        continue
+                    if now - self._last_run.get(job, 0) >= interval and job not in self._pending:
+                        self._pending.append(job)
+            self._run_pending()
+
+    def _run_pending(self):
+        with self._run_lock:
+            while True:
+                with self._lock:
+                    if not self._pending:
+                        return
+                    job = self._pending.pop(0)
+                self._run_job(job)
+
+    def _set_progress(self, progress):
+        with self._lock:
+            self._status['progress'] = progress
+
+    def _run_job(self, job):
+        with self._lock:
+            self._status['running_job'] = job
+            self._status['progress'] = None
         start_time = time.time()
-        conn.execute('ANALYZE')
-        analyze_time = time.time() - start_time
-        print(f"  ANALYZE完成，耗时: {analyze_time:.2f}s")
+        conn = sqlite3.connect(self.db_path, timeout=5)
+        try:
+            result = getattr(self, f'_job_{job}')(conn)
+            result.setdefault('success', True)
+        except Exception as e:
+            print(f"[数据库维护] 任务 {job} 失败: {e}")
+            result = {'success': False, 'error': str(e)}
+        finally:
+            conn.close()
+        duration = round(time.time() - start_time, 2)
+        with self._lock:
+            self._last_run[job] = time.time()
+            self._status['running_job'] = None
+            self._status['progress'] = None
+            self._status['history'][job] = {
+                'finished_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                'duration': duration,
+                'result': result,
+            }
+        return result
 
-        conn.commit()
+    # ---------- 具体任务 ----------
 
-        # 获取优化后的数据库大小
-        db_size = os.path.getsize(DB_FILE) if os.path.exists(DB_FILE) else 0
+    def _wal_size(self):
+        wal_path = self.db_path + '-wal'
+        return os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
 
+    def _job_checkpoint(self, conn):
+        wal_size = self._wal_size()
+        if wal_size < DB_WAL_CHECKPOINT_BYTES:
+            return {'skipped': True, 'wal_bytes': wal_size}
+        mode = 'TRUNCATE' if wal_size >= DB_WAL_TRUNCATE_BYTES and self.is_idle() else 'PASSIVE'
+        busy, log_frames, checkpointed = conn.execute(f'PRAGMA wal_checkpoint({mode})').fetchone()
+        print(f"[数据库维护] WAL检查点({mode}): {wal_size // 1024}KB, 已回写 {checkpointed}/{log_frames} 帧")
         return {
-            'success': True,
-            'vacuum_time': round(vacuum_time, 2),
-            'analyze_time': round(analyze_time, 2),
-            'db_size_mb': round(db_size / (1024 * 1024), 2),
-            'message': '数据库优化完成'
+            'mode': mode,
+            'wal_bytes_before': wal_size,
+            'wal_bytes_after': self._wal_size(),
+            'busy': bool(busy),
+            'log_frames': log_frames,
+            'checkpointed_frames': checkpointed,
         }
 
-    except Exception as e:
-        print(f"[数据库优化] 错误: {e}")
-        return {
-            'success': False,
-            'error': str(e)
-        }
-    finally:
-        conn.close()
+    def _job_optimize(self, conn):
+        conn.execute('PRAGMA optimize')
+        return {}
+
+    def _job_incremental_vacuum(self, conn):
+        auto_vacuum = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+        if auto_vacuum != 2:
+            # 现有数据库切换到 INCREMENTAL 需要一次完整 VACUUM，期间无法让出写锁，
+            # 只在管理员确认后、低峰时段空闲时执行
+            with self._lock:
+                requested = self._convert_requested
+            if not requested:
+                return {'skipped': True, 'reason': 'conversion_not_requested'}
+            if not self.in_off_peak_window():
+                return {'skipped': True, 'reason': 'outside_window'}
+            if self._db_size() > DB_VACUUM_CONVERT_MAX_MB * 1024 * 1024:
+                with self._lock:
+                    self._convert_requested = False
+                return {'skipped': True, 'reason': 'too_large'}
+            if not self._yield_to_traffic():
+                return {'skipped': True, 'reason': 'busy'}
+            conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            conn.execute('VACUUM')
+            with self._lock:
+                self._convert_requested = False
+            print("[数据库维护] 已切换 auto_vacuum=INCREMENTAL")
+            return {'converted': True}
+
+        total_free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        released = 0
+        while released < total_free:
+            if not self._yield_to_traffic():
+                break
+            conn.execute(f'PRAGMA incremental_vacuum({DB_INCREMENTAL_VACUUM_PAGES})').fetchall()
+            remaining = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            if remaining >= total_free - released:
+                break
+            released = total_free - remaining
+            self._set_progress({'released_pages': released, 'total_pages': total_free})
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        if released:
+            print(f"[数据库维护] 增量回收 {released} 页 ({released * page_size // 1024}KB)")
+        return {'released_pages': released, 'freed_bytes': released * page_size}
+
+    def _job_analyze(self, conn):
+        conn.execute(f'PRAGMA analysis_limit={DB_ANALYZE_LIMIT}')
+        tables = [row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+        ).fetchall()]
+        analyzed = 0
+        for index, table in enumerate(tables, 1):
+            if not self._yield_to_traffic():
+                break
+            conn.execute(f'ANALYZE "{table}"')
+            conn.commit()
+            analyzed += 1
+            self._set_progress({'table': table, 'done': index, 'total': len(tables)})
+        return {'analyzed_tables': analyzed, 'total_tables': len(tables)}
+
+    def _job_reconcile_counters(self, conn):
+        if not self._yield_to_traffic():
+            return {'skipped': True, 'reason': 'busy'}
+        conn.row_factory = sqlite3.Row
+        result = reconcile_engagement_counters(conn)
+        result['workspaces'] = reconcile_workspace_counters(conn)
+        return result
+
+
+maintenance_scheduler = DatabaseMaintenanceScheduler(DB_FILE)
+
+
+def start_db_maintenance():
+    """启动数据库后台维护调度（DB_MAINTENANCE_ENABLED 关闭时不启动）"""
+    if DB_MAINTENANCE_ENABLED:
+        maintenance_scheduler.start()
+    return maintenance_scheduler
+
+
+@app.before_request
+def _track_request_start():
+    maintenance_scheduler.request_started()
+    g._maintenance_tracked = True
+
+
+@app.teardown_request
+def _track_request_end(exception):
+    if g.pop('_maintenance_tracked', None):
+        maintenance_scheduler.request_finished()
 
 
 def get_user_by_email(email):
@@ -4378,17 +6335,15 @@ def toggle_like(file_id, user_id):
         liked = True
     conn.commit()
 
-    count_row = conn.execute('SELECT COUNT(*) as count FROM likes WHERE file_id = ?',
-                           (file_id,)).fetchone()
-    return liked, count_row['count']
+    return liked, get_like_count(file_id)
 
 
 def get_like_count(file_id):
-    """获取文件的点赞数量"""
+    """获取文件的点赞数量（读取触发器维护的计数列）"""
     conn = get_db()
-    row = conn.execute('SELECT COUNT(*) as count FROM likes WHERE file_id = ?',
+    row = conn.execute('SELECT like_count FROM files WHERE id = ?',
                       (file_id,)).fetchone()
-    return row['count']
+    return (row['like_count'] or 0) if row else 0
 
 
 def is_liked(file_id, user_id):
@@ -4416,17 +6371,15 @@ def toggle_favorite(file_id, user_id):
         favorited = True
     conn.commit()
 
-    count_row = conn.execute('SELECT COUNT(*) as count FROM favorites WHERE file_id = ?',
-                           (file_id,)).fetchone()
-    return favorited, count_row['count']
+    return favorited, get_favorite_count(file_id)
 
 
 def get_favorite_count(file_id):
-    """获取文件的收藏数量"""
+    """获取文件的收藏数量（读取触发器维护的计数列）"""
     conn = get_db()
-    row = conn.execute('SELECT COUNT(*) as count FROM favorites WHERE file_id = ?',
+    row = conn.execute('SELECT favorite_count FROM files WHERE id = ?',
                       (file_id,)).fetchone()
-    return row['count']
+    return (row['favorite_count'] or 0) if row else 0
 
 
 def is_favorited(file_id, user_id):
@@ -4438,6 +6391,26 @@ def is_favorited(file_id, user_id):
 
 
 
+def get_user_interactions(file_ids, user_id):
+    """
+    批量获取用户对一组文件的点赞/收藏状态
+
+    返回:
+        (已点赞文件ID集合, 已收藏文件ID集合)
+    """
+    file_ids = [fid for fid in file_ids if fid]
+    if not user_id or not file_ids:
+        return set(), set()
+
+    conn = get_db()
+    placeholders = ','.join('?' * len(file_ids))
+    liked = conn.execute(f'SELECT file_id FROM likes WHERE user_id = ? AND file_id IN ({placeholders})',
+                         [user_id] + file_ids).fetchall()
+    favorited = conn.execute(f'SELECT file_id FROM favorites WHERE user_id = ? AND file_id IN ({placeholders})',
+                             [user_id] + file_ids).fetchall()
+    return {r['file_id'] for r in liked}, {r['file_id'] for r in favorited}
+
+
 def get_favorite_files(user_id):
     """获取用户收藏的文件列表，只返回HTML文件且排除项目文件夹中的文件"""
     conn = get_db()
@@ -4454,8 +6427,8 @@ def get_favorite_files(user_id):
     result = []
     for row in rows:
         file_id = row["id"]
-        like_count = conn.execute('SELECT COUNT(*) as count FROM likes WHERE file_id = ?', (file_id,)).fetchone()['count']
-        favorite_count = conn.execute('SELECT COUNT(*) as count FROM favorites WHERE file_id = ?', (file_id,)).fetchone()['count']
+        like_count = row["like_count"] or 0
+        favorite_count = row["favorite_count"] or 0
 
         categories = []
         category_rows = conn.execute('''SELECT c.* FROM categories c
@@ -4558,6 +6531,565 @@ def deepseek_chat(messages, model="deepseek-chat", temperature=0.5):
     return r.json()
 
 
+# ==================== AI 请求调度 ====================
+# 所有上游 AI 调用经由调度器：全局/单用户并发上限，交互请求优先于批量分析，
+# 同优先级下在途请求少的用户先得到名额；队列满或排队超时时立即拒绝
+AI_MAX_CONCURRENCY = int(os.getenv('AI_MAX_CONCURRENCY', '8'))
+AI_MAX_PER_USER = int(os.getenv('AI_MAX_PER_USER', '2'))
+AI_QUEUE_MAX = int(os.getenv('AI_QUEUE_MAX', '50'))
+AI_QUEUE_TIMEOUT = float(os.getenv('AI_QUEUE_TIMEOUT', '30'))
+
+AI_PRIORITY_INTERACTIVE = 0
+AI_PRIORITY_BATCH = 1
+
+
+class AIBusyError(Exception):
+    """AI 调度队列已满或排队超时"""
+
+
+class AIDispatcher:
+    """上游 AI 调用的并发闸门与公平队列"""
+
+    def __init__(self, max_concurrency=AI_MAX_CONCURRENCY, max_per_user=AI_MAX_PER_USER,
+                 queue_max=AI_QUEUE_MAX, queue_timeout=AI_QUEUE_TIMEOUT):
+        self.max_concurrency = max_concurrency
+        self.max_per_user = max_per_user
+        self.queue_max = queue_max
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._running = {}
+        self._running_total = 0
+        self._seq = 0
+        self._waits = deque(maxlen=500)
+        self._stats = {'granted': 0, 'rejected': 0, 'timeouts': 0, 'max_wait': 0.0}
+
+    def _next_ticket(self):
+        """当前可以放行的排队请求：按 (优先级, 该用户在途数, 到达顺序)，跳过已达单用户上限的"""
+        best = None
+        for ticket in self._waiting:
+            running = self._running.get(ticket['user_id'], 0)
+            if running >= self.max_per_user:
+                continue
+            key = (ticket['priority'], running, ticket['seq'])
+            if best is None or key < best[0]:
+                best = (key, ticket)
+        return best[1] if best else None
+
+    def acquire(self, user_id, priority=AI_PRIORITY_INTERACTIVE):
+        user_id = user_id or '_system'
+        start = time.time()
+        with self._cond:
+            if len(self._waiting) >= self.queue_max:
+                self._stats['rejected'] += 1
+                raise AIBusyError('AI服务繁忙，请稍后再试')
+            self._seq += 1
+            ticket = {'user_id': user_id, 'priority': priority, 'seq': self._seq}
+            self._waiting.append(ticket)
+            deadline = start + self.queue_timeout
+            try:
+                while not (self._running_total < self.max_concurrency
+                           and self._next_ticket() is ticket):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise AIBusyError('AI服务排队超时，请稍后再试')
+                    self._cond.wait(remaining)
+            finally:
+                self._waiting.remove(ticket)
+                # 自己离开队列后可能轮到别人
+                self._cond.notify_all()
+            self._running[user_id] = self._running.get(user_id, 0) + 1
+            self._running_total += 1
+            waited = time.time() - start
+            self._waits.append(waited)
+            self._stats['granted'] += 1
+            self._stats['max_wait'] = max(self._stats['max_wait'], waited)
+        return user_id
+
+    def release(self, user_id):
+        with self._cond:
+            count = self._running.get(user_id, 0) - 1
+            if count > 0:
+                self._running[user_id] = count
+            else:
+                self._running.pop(user_id, None)
+            self._running_total -= 1
+            self._cond.notify_all()
+
+    def call(self, user_id, priority, func, *args, **kwargs):
+        slot = self.acquire(user_id, priority)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.release(slot)
+
+    def get_stats(self):
+        with self._cond:
+            waits = sorted(self._waits)
+            stats = dict(self._stats)
+            stats.update({
+                'running': self._running_total,
+                'queued': len(self._waiting),
+                'queued_interactive': sum(1 for t in self._waiting if t['priority'] == AI_PRIORITY_INTERACTIVE),
+                'active_users': len(self._running),
+                'max_concurrency': self.max_concurrency,
+                'max_per_user': self.max_per_user,
+                'queue_max': self.queue_max,
+            })
+        stats['avg_wait'] = round(sum(waits) / len(waits), 3) if waits else 0.0
+        stats['p95_wait'] = round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3) if waits else 0.0
+        stats['max_wait'] = round(stats['max_wait'], 3)
+        return stats
+
+
+ai_dispatcher = AIDispatcher()
+
+
+# ==================== AI 响应缓存 ====================
+# 确定性提示词（文件分析、模板对话）按 (模型, 规范化消息, 参数) 缓存；
+# 同一提示词的并发请求只向上游发起一次
+AI_RESPONSE_CACHE_TTL = int(os.getenv('AI_RESPONSE_CACHE_TTL', '21600'))
+AI_INFLIGHT_WAIT_TIMEOUT = 70
+
+_ai_inflight = {}
+_ai_inflight_lock = threading.Lock()
+_ai_cache_stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'errors': 0,
+                   'upstream_seconds': 0.0, 'saved_seconds': 0.0}
+_ai_cache_stats_lock = threading.Lock()
+
+
+def _ai_cache_count(field, value=1):
+    with _ai_cache_stats_lock:
+        _ai_cache_stats[field] += value
+
+
+def _ai_scope_version(scope):
+    """作用域版本号（如 file_<id>），文件元数据变化后换新版本即可使旧缓存全部失效"""
+    cache = get_cache()
+    key = f'ai_resp_ver:{scope}'
+    version = cache.get(key)
+    if version is None:
+        version = uuid.uuid4().hex[:12]
+        cache.set(key, version, AI_RESPONSE_CACHE_TTL * 2)
+    return version
+
+
+def ai_cache_key(messages, model, temperature, scope=None):
+    normalized = [{'role': m.get('role', 'user'),
+                   'content': re.sub(r'\s+', ' ', str(m.get('content', ''))).strip()}
+                  for m in messages]
+    digest = hashlib.sha256(json.dumps(
+        {'model': model, 'messages': normalized, 'temperature': float(temperature)},
+        ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+    if scope:
+        return f'ai_resp:{scope}:{_ai_scope_version(scope)}:{digest}'
+    return f'ai_resp:{digest}'
+
+
+def cached_deepseek_chat(messages, model="deepseek-chat", temperature=0.5, scope=None,
+                         user_id=None, priority=AI_PRIORITY_INTERACTIVE):
+    """
+    带缓存与请求合并的 deepseek_chat
+
+    返回 (result, cached)；命中缓存或合并到进行中的相同请求时 cached=True，
+    只有真正发往上游的请求占用调度器名额
+    """
+    cache = get_cache()
+    key = ai_cache_key(messages, model, temperature, scope)
+    entry = cache.get(key)
+    if entry is not None:
+        _ai_cache_count('hits')
+        _ai_cache_count('saved_seconds', entry.get('latency', 0.0))
+        return entry['result'], True
+
+    with _ai_inflight_lock:
+        waiter = _ai_inflight.get(key)
+        if waiter is None:
+            waiter = {'event': threading.Event(), 'result': None, 'error': None, 'latency': 0.0}
+            _ai_inflight[key] = waiter
+            leader = True
+        else:
+            leader = False
+
+    if not leader:
+        if not waiter['event'].wait(AI_INFLIGHT_WAIT_TIMEOUT):
+            raise Exception('等待相同AI请求超时')
+        if waiter['error'] is not None:
+            raise waiter['error']
+        _ai_cache_count('coalesced')
+        _ai_cache_count('saved_seconds', waiter['latency'])
+        return waiter['result'], True
+
+    _ai_cache_count('misses')
+    start = time.time()
+    try:
+        result = ai_dispatcher.call(user_id, priority, deepseek_chat, messages,
+                                    model=model, temperature=temperature)
+        waiter['latency'] = time.time() - start
+        waiter['result'] = result
+        _ai_cache_count('upstream_seconds', waiter['latency'])
+        cache.set(key, {'result': result, 'latency': waiter['latency']}, AI_RESPONSE_CACHE_TTL)
+        return result, False
+    except Exception as e:
+        waiter['error'] = e
+        _ai_cache_count('errors')
+        raise
+    finally:
+        with _ai_inflight_lock:
+            _ai_inflight.pop(key, None)
+        waiter['event'].set()
+
+
+def invalidate_ai_cache(file_id):
+    """文件内容或元数据（文件名、大小、项目信息）变化后调用"""
+    get_cache().delete(f'ai_resp_ver:file_{file_id}')
+
+
+def get_ai_cache_stats():
+    with _ai_cache_stats_lock:
+        stats = dict(_ai_cache_stats)
+    lookups = stats['hits'] + stats['misses'] + stats['coalesced']
+    stats['hit_rate'] = round((stats['hits'] + stats['coalesced']) / lookups, 4) if lookups else 0.0
+    stats['upstream_seconds'] = round(stats['upstream_seconds'], 3)
+    stats['saved_seconds'] = round(stats['saved_seconds'], 3)
+    with _ai_inflight_lock:
+        stats['inflight'] = len(_ai_inflight)
+    stats['ttl'] = AI_RESPONSE_CACHE_TTL
+    return stats
+
+
+# ==================== AI 任务编排 ====================
+# 外部 AI 调用最长 60 秒：调用前释放请求连接，任务状态与结果各用一个短事务落库
+AI_JOB_WORKERS = int(os.getenv('AI_JOB_WORKERS', '4'))
+
+_ai_job_executor = None
+_ai_job_executor_lock = threading.Lock()
+
+
+def _ai_job_conn():
+    conn = sqlite3.connect(str(DB_FILE), timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _ai_job_now():
+    from datetime import timezone
+    bj_tz = timezone(timedelta(hours=8))
+    return datetime.now(bj_tz).strftime('%Y-%m-%d %H:%M:%S') + '+08:00'
+
+
+def extract_ai_text(result):
+    """从 deepseek_chat 返回值中取出回复文本"""
+    return result.get('choices', [{}])[0].get('message', {}).get('content', str(result))
+
+
+def create_ai_job(user_id, job_type, prompt, model='deepseek-chat', target_id=None):
+    """登记一条 pending 状态的 AI 任务，返回 job_id"""
+    job_id = str(uuid.uuid4())
+    conn = _ai_job_conn()
+    try:
+        conn.execute(
+            """INSERT INTO ai_jobs (id, user_id, job_type, status, model, prompt, target_id, created_at)
+               VALUES (?, ?, ?, 'pending', ?, ?, ?, ?)""",
+            (job_id, user_id, job_type, model, prompt, target_id, _ai_job_now()))
+        conn.commit()
+    finally:
+        conn.close()
+    return job_id
+
+
+def get_ai_job(job_id, user_id=None):
+    conn = _ai_job_conn()
+    try:
+        if user_id is None:
+            row = conn.execute("SELECT * FROM ai_jobs WHERE id = ?", (job_id,)).fetchone()
+        else:
+            row = conn.execute("SELECT * FROM ai_jobs WHERE id = ? AND user_id = ?",
+                               (job_id, user_id)).fetchone()
+        return dict(row) if row else None
+    finally:
+        conn.close()
+
+
+def _emit_ai_job(job):
+    if not job:
+        return
+    try:
+        socketio.emit('ai_job_update', {
+            'job_id': job['id'],
+            'job_type': job['job_type'],
+            'status': job['status'],
+            'target_id': job['target_id'],
+            'content_id': job['content_id'],
+            'response': job['response'],
+            'error': job['error'],
+        }, room=job['user_id'])
+    except Exception as e:
+        print(f"[AI任务] 推送任务状态失败: {e}")
+
+
+def run_ai_job(job_id, messages, temperature=0.5, cache_scope=None, priority=AI_PRIORITY_INTERACTIVE):
+    """
+    执行 AI 任务：pending -> running -> done/failed，外部调用期间不持有任何数据库连接
+
+    cache_scope 非空时提示词视为确定性的，走 AI 响应缓存（'file_<id>' 随文件失效）；
+    调度器拒绝时任务记为 failed，返回值带 busy=True
+    """
+    conn = _ai_job_conn()
+    try:
+        cur = conn.execute(
+            "UPDATE ai_jobs SET status = 'running', started_at = ? WHERE id = ? AND status = 'pending'",
+            (_ai_job_now(), job_id))
+        conn.commit()
+        job = conn.execute("SELECT * FROM ai_jobs WHERE id = ?", (job_id,)).fetchone()
+    finally:
+        conn.close()
+    if not job:
+        return None
+    job = dict(job)
+    if cur.rowcount == 0:
+        return job
+    _emit_ai_job(job)
+
+    response_text = None
+    error = None
+    busy = False
+    try:
+        if cache_scope is not None:
+            result, _ = cached_deepseek_chat(messages, model=job['model'], temperature=temperature,
+                                             scope=cache_scope, user_id=job['user_id'],
+                                             priority=priority)
+        else:
+            result = ai_dispatcher.call(job['user_id'], priority, deepseek_chat, messages,
+                                        model=job['model'], temperature=temperature)
+        response_text = extract_ai_text(result)
+    except AIBusyError as e:
+        error = str(e)
+        busy = True
+    except Exception as e:
+        error = str(e)
+
+    conn = _ai_job_conn()
+    try:
+        finished_at = _ai_job_now()
+        if error is None:
+            content_id = str(uuid.uuid4())
+            conn.execute(
+                """INSERT INTO ai_contents (id, user_id, ai_function, prompt, response, created_at)
+                   VALUES (?, ?, ?, ?, ?, ?)""",
+                (content_id, job['user_id'], job['job_type'], job['prompt'], response_text, finished_at))
+            conn.execute(
+                """UPDATE ai_jobs SET status = 'done', content_id = ?, response = ?, finished_at = ?
+                   WHERE id = ?""",
+                (content_id, response_text, finished_at, job_id))
+        else:
+            conn.execute(
+                "UPDATE ai_jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+                (error, finished_at, job_id))
+        conn.commit()
+        job = dict(conn.execute("SELECT * FROM ai_jobs WHERE id = ?", (job_id,)).fetchone())
+    finally:
+        conn.close()
+
+    _emit_ai_job(job)
+    job['busy'] = busy
+    return job
+
+
+def _get_ai_executor():
+    global _ai_job_executor
+    if _ai_job_executor is None:
+        with _ai_job_executor_lock:
+            if _ai_job_executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                _ai_job_executor = ThreadPoolExecutor(max_workers=AI_JOB_WORKERS,
+                                                      thread_name_prefix='ai-job')
+    return _ai_job_executor
+
+
+def submit_ai_job(job_id, messages, temperature=0.5, cache_scope=None, priority=AI_PRIORITY_BATCH):
+    """把 AI 任务放入后台线程池执行，结果通过 ai_job_update 事件推送或轮询获取"""
+    def _run():
+        try:
+            run_ai_job(job_id, messages, temperature, cache_scope, priority)
+        except Exception as e:
+            print(f"[AI任务] 任务 {job_id} 执行异常: {e}")
+
+    _get_ai_executor().submit(_run)
+
+
+# ==================== AI 多轮会话存储 ====================
+# 客户端每轮只发送新消息；服务端按 token 预算截取最近消息，更早的轮次折叠进滚动摘要
+AI_CONTEXT_TOKEN_BUDGET = int(os.getenv('AI_CONTEXT_TOKEN_BUDGET', '6000'))
+AI_CONTEXT_MAX_MESSAGES = int(os.getenv('AI_CONTEXT_MAX_MESSAGES', '40'))
+AI_SUMMARY_MAX_TOKENS = int(os.getenv('AI_SUMMARY_MAX_TOKENS', '800'))
+
+_ai_summarizing = set()
+_ai_summarizing_lock = threading.Lock()
+
+
+def estimate_tokens(text):
+    """粗略估算 token 数：中日韩字符按 1 个计，其余按 4 个字符 1 个计"""
+    if not text:
+        return 0
+    cjk = len(re.findall(r'[\u3000-\u9fff\uac00-\ud7af\uff00-\uffef]', text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def create_ai_conversation(conn, user_id, model='deepseek-chat', system_prompt='', title=''):
+    conversation_id = str(uuid.uuid4())
+    now = _ai_job_now()
+    conn.execute(
+        """INSERT INTO ai_conversations (id, user_id, title, model, system_prompt, summary,
+                                         summary_upto, message_count, created_at, updated_at)
+           VALUES (?, ?, ?, ?, ?, '', 0, 0, ?, ?)""",
+        (conversation_id, user_id, title, model, system_prompt or '', now, now))
+    return conversation_id
+
+
+def append_ai_message(conn, conversation_id, role, content):
+    """追加一条消息，返回其序号 seq（调用方负责提交事务）"""
+    seq = conn.execute(
+        "SELECT COALESCE(MAX(seq), 0) + 1 FROM ai_messages WHERE conversation_id = ?",
+        (conversation_id,)).fetchone()[0]
+    conn.execute(
+        """INSERT INTO ai_messages (id, conversation_id, seq, role, content, token_estimate, created_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?)""",
+        (str(uuid.uuid4()), conversation_id, seq, role, content, estimate_tokens(content), _ai_job_now()))
+    conn.execute(
+        """UPDATE ai_conversations SET message_count = message_count + 1, updated_at = ?,
+                  title = CASE WHEN title = '' AND ? = 'user' THEN ? ELSE title END
+           WHERE id = ?""",
+        (_ai_job_now(), role, content[:50], conversation_id))
+    return seq
+
+
+def save_ai_turn(conn, conversation_id, message, reply):
+    """
+    一轮问答在同一个写事务里落库
+
+    先取写锁再读 MAX(seq)，同一会话并发的两轮（重复提交、多个标签页）会排队写入，不会撞上唯一索引
+    """
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        append_ai_message(conn, conversation_id, 'user', message)
+        append_ai_message(conn, conversation_id, 'assistant', reply)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def build_ai_context(conn, conversation, new_message=None):
+    """
+    组装发往上游的消息列表
+
+    系统提示词 + 滚动摘要 + 预算内最近的消息 + 本轮尚未落库的用户消息；返回 (messages, info)，
+    info['summarize_upto'] 非空表示有未摘要的旧消息落在窗口之外，需要后台折叠
+    """
+    budget = AI_CONTEXT_TOKEN_BUDGET
+    head = []
+    if conversation['system_prompt']:
+        head.append({'role': 'system', 'content': conversation['system_prompt']})
+    if conversation['summary']:
+        head.append({'role': 'system', 'content': f"以下是此前对话的摘要：\n{conversation['summary']}"})
+    tail = [{'role': 'user', 'content': new_message}] if new_message else []
+    used = sum(estimate_tokens(m['content']) for m in head + tail)
+
+    rows = conn.execute(
+        """SELECT seq, role, content, token_estimate FROM ai_messages
+           WHERE conversation_id = ? AND seq > ?
+           ORDER BY seq DESC LIMIT ?""",
+        (conversation['id'], conversation['summary_upto'], AI_CONTEXT_MAX_MESSAGES)).fetchall()
+
+    kept = []
+    for row in rows:
+        if (kept or tail) and used + row['token_estimate'] > budget:
+            break
+        kept.append(row)
+        used += row['token_estimate']
+    kept.reverse()
+
+    oldest_kept = kept[0]['seq'] if kept else conversation['summary_upto'] + 1
+    summarize_upto = oldest_kept - 1 if oldest_kept - 1 > conversation['summary_upto'] else None
+    messages = head + [{'role': r['role'], 'content': r['content']} for r in kept] + tail
+    return messages, {
+        'tokens': used,
+        'messages': len(kept) + len(tail),
+        'summarized_upto': conversation['summary_upto'],
+        'summarize_upto': summarize_upto,
+    }
+
+
+def summarize_ai_conversation(conversation_id, upto_seq):
+    """把 (summary_upto, upto_seq] 的消息折叠进滚动摘要；外部调用期间不持有数据库连接"""
+    conn = _ai_job_conn()
+    try:
+        conversation = conn.execute("SELECT * FROM ai_conversations WHERE id = ?",
+                                    (conversation_id,)).fetchone()
+        if not conversation or conversation['summary_upto'] >= upto_seq:
+            return False
+        rows = conn.execute(
+            """SELECT seq, role, content, token_estimate FROM ai_messages
+               WHERE conversation_id = ? AND seq > ? AND seq <= ?
+               ORDER BY seq""",
+            (conversation_id, conversation['summary_upto'], upto_seq)).fetchall()
+    finally:
+        conn.close()
+    if not rows:
+        return False
+
+    # 单次折叠的输入同样受预算限制，剩余部分留给下一轮
+    folded, used = [], 0
+    for row in rows:
+        if folded and used + row['token_estimate'] > AI_CONTEXT_TOKEN_BUDGET:
+            break
+        folded.append(row)
+        used += row['token_estimate']
+    transcript = '\n'.join(f"{'用户' if r['role'] == 'user' else '助手'}: {r['content']}" for r in folded)
+    prompt = (f"请把下面的对话内容合并进已有摘要，保留事实、结论和未解决的问题，"
+              f"输出不超过{AI_SUMMARY_MAX_TOKENS}字的中文摘要。\n\n"
+              f"已有摘要：\n{conversation['summary'] or '（无）'}\n\n新增对话：\n{transcript}")
+
+    summary = extract_ai_text(ai_dispatcher.call(conversation['user_id'], AI_PRIORITY_BATCH,
+                                                 deepseek_chat, [{'role': 'user', 'content': prompt}],
+                                                 model=conversation['model'] or 'deepseek-chat',
+                                                 temperature=0.3))
+
+    conn = _ai_job_conn()
+    try:
+        cur = conn.execute(
+            """UPDATE ai_conversations SET summary = ?, summary_upto = ?
+               WHERE id = ? AND summary_upto = ?""",
+            (summary, folded[-1]['seq'], conversation_id, conversation['summary_upto']))
+        conn.commit()
+        return cur.rowcount > 0
+    finally:
+        conn.close()
+
+
+def schedule_ai_summary(conversation_id, upto_seq):
+    """后台折叠旧消息；同一会话同时只跑一个摘要任务"""
+    with _ai_summarizing_lock:
+        if conversation_id in _ai_summarizing:
+            return
+        _ai_summarizing.add(conversation_id)
+
+    def _run():
+        try:
+            summarize_ai_conversation(conversation_id, upto_seq)
+        except Exception as e:
+            print(f"[AI会话] 会话 {conversation_id} 摘要失败: {e}")
+        finally:
+            with _ai_summarizing_lock:
+                _ai_summarizing.discard(conversation_id)
+
+    _get_ai_executor().submit(_run)
+
+
 from blueprints import register_blueprints
 register_blueprints(app)
 
@@ -4581,38 +7113,154 @@ def require_login():
 import helpers as _helpers
 _helpers.set_db_path(str(DB_FILE))
 
-_online_users = {}
+TYPING_IDLE_SECONDS = float(os.getenv('TYPING_IDLE_SECONDS', '3'))
+PRESENCE_SNAPSHOT_INTERVAL = float(os.getenv('PRESENCE_SNAPSHOT_INTERVAL', '2'))
+REALTIME_TICK_SECONDS = 1
+
+# 正在输入：(file_id, user_id) -> {username, last}；每段连续输入只广播开始和结束两条消息
+_typing_state = {}
+# 待广播的在线状态变化：user_id -> (online, username)，同一周期内多次变化只保留最终状态
+_presence_changes = {}
+_realtime_lock = threading.Lock()
+_realtime_task_started = False
+
+
+def _user_workspace_ids(conn, user_ids):
+    """user_id -> [workspace_id]（成员或创建者）"""
+    result = {uid: [] for uid in user_ids}
+    for i in range(0, len(user_ids), 500):
+        chunk = user_ids[i:i + 500]
+        placeholders = ','.join('?' * len(chunk))
+        rows = conn.execute(
+            f"""SELECT workspace_id, user_id FROM workspace_members WHERE user_id IN ({placeholders})
+                UNION
+                SELECT id, owner_id FROM workspaces WHERE owner_id IN ({placeholders})""",
+            (*chunk, *chunk)).fetchall()
+        for workspace_id, user_id in rows:
+            result[user_id].append(workspace_id)
+    return result
+
+
+def _workspace_member_ids(conn, workspace_id):
+    rows = conn.execute(
+        """SELECT user_id FROM workspace_members WHERE workspace_id = ?
+           UNION SELECT owner_id FROM workspaces WHERE id = ?""",
+        (workspace_id, workspace_id)).fetchall()
+    return [r[0] for r in rows]
+
+
+def _queue_presence_change(user_id, online, username=''):
+    with _realtime_lock:
+        _presence_changes[user_id] = (online, username)
+
+
+def _flush_typing(now):
+    with _realtime_lock:
+        stopped = {}
+        for key, state in list(_typing_state.items()):
+            if now - state['last'] >= TYPING_IDLE_SECONDS:
+                del _typing_state[key]
+                stopped.setdefault(key[0], []).append(key[1])
+    for file_id, user_ids in stopped.items():
+        socketio.emit('user_stopped_typing', {'file_id': file_id, 'user_ids': user_ids},
+                      room=f'file_{file_id}')
+
+
+def _flush_presence():
+    """把一个周期内的上下线变化按工作空间合并成一条 presence_snapshot"""
+    with _realtime_lock:
+        if not _presence_changes:
+            return
+        changes = dict(_presence_changes)
+        _presence_changes.clear()
+    conn = sqlite3.connect(str(DB_FILE), timeout=30)
+    try:
+        memberships = _user_workspace_ids(conn, list(changes))
+    finally:
+        conn.close()
+    snapshots = {}
+    for user_id, (online, username) in changes.items():
+        entry = {'user_id': user_id, 'username': username or ''}
+        for workspace_id in memberships.get(user_id, []):
+            snapshot = snapshots.setdefault(workspace_id, {'online': [], 'offline': []})
+            snapshot['online' if online else 'offline'].append(entry)
+    for workspace_id, snapshot in snapshots.items():
+        socketio.emit('presence_snapshot', {'workspace_id': workspace_id, 'full': False, **snapshot},
+                      room=f'workspace_{workspace_id}')
+
+
+def _realtime_loop():
+    """实时事件后台循环：输入状态去抖、在线状态批量快照、在线心跳"""
+    last_snapshot = last_heartbeat = time.time()
+    while True:
+        socketio.sleep(REALTIME_TICK_SECONDS)
+        now = time.time()
+        try:
+            _flush_typing(now)
+            if now - last_heartbeat >= PRESENCE_HEARTBEAT_INTERVAL:
+                last_heartbeat = now
+                for user_id, username in presence_registry.heartbeat():
+                    _queue_presence_change(user_id, False, username)
+            if now - last_snapshot >= PRESENCE_SNAPSHOT_INTERVAL:
+                last_snapshot = now
+                _flush_presence()
+        except Exception as e:
+            print(f"[实时] 后台循环异常: {e}")
+
+
+def _ensure_realtime_task():
+    global _realtime_task_started
+    if _realtime_task_started:
+        return
+    with _realtime_lock:
+        if not _realtime_task_started:
+            _realtime_task_started = True
+            socketio.start_background_task(_realtime_loop)
+
 
 @socketio.on('connect')
 def handle_connect():
     if 'user_id' in session:
-        _online_users[session['user_id']] = {
-            'sid': request.sid,
-            'username': session.get('username', ''),
-            'connected_at': datetime.now().isoformat()
-        }
-        socketio.emit('user_online', {
-            'user_id': session['user_id'],
-            'username': session.get('username', '')
-        })
+        from flask_socketio import join_room
+        _ensure_realtime_task()
+        user_id = session['user_id']
+        # 个人房间：emit_notification / AI 任务推送按 user_id 投递
+        join_room(user_id)
+        # 在线状态只在所属工作空间内传播，连接时自动加入这些房间
+        conn = get_db()
+        for workspace_id in _user_workspace_ids(conn, [user_id])[user_id]:
+            join_room(f'workspace_{workspace_id}')
+        # 同一用户多个标签页/设备只在第一个连接上线时广播
+        if presence_registry.connect(request.sid, user_id, session.get('username', '')):
+            _queue_presence_change(user_id, True, session.get('username', ''))
 
 @socketio.on('disconnect')
 def handle_disconnect():
     if 'user_id' in session:
-        user_id = session['user_id']
-        if user_id in _online_users:
-            del _online_users[user_id]
-        socketio.emit('user_offline', {
-            'user_id': user_id,
-            'username': session.get('username', '')
-        })
+        user_id, offline = presence_registry.disconnect(request.sid)
+        with _realtime_lock:
+            for key in [k for k, v in _typing_state.items() if v['sid'] == request.sid]:
+                del _typing_state[key]
+        if offline:
+            _queue_presence_change(user_id, False, session.get('username', ''))
 
 @socketio.on('join_workspace')
 def handle_join_workspace(data):
     from flask_socketio import join_room
     workspace_id = data.get('workspace_id')
-    if workspace_id:
+    if workspace_id and 'user_id' in session:
+        if not get_workspace_role(workspace_id, session['user_id']):
+            return
         join_room(f'workspace_{workspace_id}')
+        # 加入时只给本连接发一份完整快照，之后靠增量快照更新
+        member_ids = _workspace_member_ids(get_db(), workspace_id)
+        online_ids = presence_registry.online_among(member_ids)
+        socketio.emit('presence_snapshot', {
+            'workspace_id': workspace_id,
+            'full': True,
+            'online': [{'user_id': uid} for uid in online_ids],
+            'offline': []
+        }, to=request.sid)
 
 @socketio.on('leave_workspace')
 def handle_leave_workspace(data):
@@ -4647,23 +7295,34 @@ def handle_leave_file(data):
 
 @socketio.on('typing')
 def handle_typing(data):
+    """只在一段输入开始时广播 user_typing，停顿 TYPING_IDLE_SECONDS 后由后台循环广播 user_stopped_typing"""
     file_id = data.get('file_id')
     if file_id and 'user_id' in session:
-        socketio.emit('user_typing', {
-            'user_id': session['user_id'],
-            'username': session.get('username', ''),
-            'file_id': file_id
-        }, room=f'file_{file_id}', include_self=False)
+        _ensure_realtime_task()
+        key = (file_id, session['user_id'])
+        with _realtime_lock:
+            started = key not in _typing_state
+            _typing_state[key] = {'sid': request.sid, 'last': time.time()}
+        if started:
+            socketio.emit('user_typing', {
+                'user_id': session['user_id'],
+                'username': session.get('username', ''),
+                'file_id': file_id
+            }, room=f'file_{file_id}', include_self=False)
+
+@socketio.on('stop_typing')
+def handle_stop_typing(data):
+    file_id = data.get('file_id')
+    if file_id and 'user_id' in session:
+        with _realtime_lock:
+            stopped = _typing_state.pop((file_id, session['user_id']), None)
+        if stopped:
+            socketio.emit('user_stopped_typing', {'file_id': file_id, 'user_ids': [session['user_id']]},
+                          room=f'file_{file_id}', include_self=False)
 
 @app.route('/api/online-users', methods=['GET'], endpoint='api_online_users')
 def api_online_users():
-    users = []
-    for uid, info in _online_users.items():
-        users.append({
-            'user_id': uid,
-            'username': info.get('username', ''),
-            'connected_at': info.get('connected_at', '')
-        })
+    users = presence_registry.online_users()
     return jsonify({'success': True, 'data': {'users': users, 'count': len(users)}})
 
 @app.route('/api/files/<file_id>/versions', methods=['GET'], endpoint='api_file_versions')
@@ -4720,6 +7379,7 @@ def api_version_rollback(file_id, version_id):
             (version['stored_name'], version['path'], version['size'], file_id)
         )
         conn.commit()
+        invalidate_ai_cache(file_id)
         socketio.emit('file_updated', {
             'file_id': file_id,
             'action': 'version_rollback',
@@ -4763,6 +7423,7 @@ def emit_workspace_update(workspace_id, event_type, data):
 
 def main():
     init_db()
+    start_db_maintenance()
 
     print("=" * 60)
     print("访问地址: http://localhost:9876")
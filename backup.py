@@ -3,6 +3,8 @@ import shutil
 import datetime
 from pathlib import Path
 
+from data_security import snapshot_database
+
 # 项目根目录
 BASE_DIR = Path(__file__).parent
 
@@ -30,8 +32,10 @@ def backup():
     db_file = DATA_DIR / "db.sqlite"
     if db_file.exists():
         backup_db = backup_subdir / "db.sqlite"
-        shutil.copy2(db_file, backup_db)
+        # 使用SQLite在线备份API分步复制，得到一致快照且不长时间阻塞写入
+        snapshot = snapshot_database(db_file, backup_db)
         print(f"✅ 数据库备份完成: {backup_db}")
+        print(f"   复制 {snapshot['bytes'] / (1024 * 1024):.2f} MB，耗时 {snapshot['duration_s']:.2f}s")
     else:
         print(f"⚠️  数据库文件不存在: {db_file}")
     
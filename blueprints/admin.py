@@ -56,6 +56,10 @@ def update_user_role(user_id):
         old_role = user['role']
         conn.execute("UPDATE users SET role = ? WHERE id = ?", (new_role, user_id))
         conn.commit()
+        from blueprints.openapi import invalidate_api_principals
+        from blueprints.miniapp import revoke_miniapp_tokens
+        invalidate_api_principals(user_id=user_id)
+        revoke_miniapp_tokens(user_id)
 
         _app.log_message(log_type='security', log_level='WARNING',
                    message=f'管理员修改用户角色: {user["username"]} ({old_role} -> {new_role})',
@@ -98,6 +102,10 @@ def delete_user(user_id):
 
         conn.execute("DELETE FROM users WHERE id = ?", (user_id,))
         conn.commit()
+        from blueprints.openapi import invalidate_api_principals
+        from blueprints.miniapp import revoke_miniapp_tokens
+        invalidate_api_principals(user_id=user_id)
+        revoke_miniapp_tokens(user_id)
 
         _app.log_message(log_type='security', log_level='CRITICAL',
                    message=f'管理员删除用户: {user["username"]}',
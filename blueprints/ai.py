@@ -19,7 +19,11 @@ class _LazyAppImports:
         from app import (
             get_db, get_all_files, log_message,
             page_error_response, api_response,
-            deepseek_chat,
+            deepseek_chat, extract_ai_text, release_db,
+            ai_dispatcher, AIBusyError, AI_PRIORITY_INTERACTIVE,
+            create_ai_job, run_ai_job, submit_ai_job, get_ai_job,
+            create_ai_conversation, save_ai_turn, build_ai_context,
+            schedule_ai_summary,
         )
         locals_dict = locals()
         if name in locals_dict:
@@ -31,6 +35,61 @@ _app = _LazyAppImports()
 
 ai_bp = Blueprint('ai', __name__)
 
+AI_TEMPLATES = [
+    {'id': 'code_review', 'name': '代码审查', 'icon': '🔍',
+     'system_prompt': '你是一位资深代码审查专家，请分析代码质量、安全漏洞和优化建议。',
+     'placeholder': '粘贴你的代码，我来帮你审查...'},
+    {'id': 'doc_writer', 'name': '文档写作', 'icon': '📝',
+     'system_prompt': '你是一位技术文档专家，请帮助撰写清晰、专业的技术文档。',
+     'placeholder': '描述你要写文档的功能或项目...'},
+    {'id': 'translator', 'name': '翻译助手', 'icon': '🌐',
+     'system_prompt': '你是一位专业翻译，请准确翻译并保持原文风格。如未指定语言，默认中英互译。',
+     'placeholder': '输入需要翻译的内容...'},
+    {'id': 'data_analyst', 'name': '数据分析', 'icon': '📊',
+     'system_prompt': '你是一位数据分析专家，请帮助分析数据、生成洞察和建议可视化方案。',
+     'placeholder': '描述你的数据或粘贴CSV数据...'},
+    {'id': 'debug_helper', 'name': '调试助手', 'icon': '🐛',
+     'system_prompt': '你是一位调试专家，请帮助分析错误原因并提供修复方案。',
+     'placeholder': '粘贴错误信息和相关代码...'},
+    {'id': 'general', 'name': '通用对话', 'icon': '💬',
+     'system_prompt': '',
+     'placeholder': '输入你的问题...'},
+]
+
+# 模板系统提示词：使用模板的首轮对话是确定性的，可以走 AI 响应缓存
+_TEMPLATE_PROMPTS = {t['system_prompt'] for t in AI_TEMPLATES if t['system_prompt']}
+
+
+def _run_ai_job(job_type, prompt, messages, model='deepseek-chat', target_id=None, cache_scope=None):
+    """登记并同步执行一次 AI 任务；外部调用前释放本请求持有的数据库连接"""
+    _app.release_db()
+    job_id = _app.create_ai_job(session['user_id'], job_type, prompt, model=model, target_id=target_id)
+    job = _app.run_ai_job(job_id, messages, cache_scope=cache_scope)
+    if job['busy']:
+        raise _app.AIBusyError(job['error'])
+    if job['status'] != 'done':
+        raise Exception(job['error'] or 'AI任务失败')
+    return job
+
+
+def _busy_response(error):
+    return _app.api_response(success=False, message=str(error), code=503)
+
+
+def _serialize_job(job):
+    return {
+        'job_id': job['id'],
+        'job_type': job['job_type'],
+        'status': job['status'],
+        'target_id': job['target_id'],
+        'content_id': job['content_id'],
+        'response': job['response'],
+        'error': job['error'],
+        'created_at': job['created_at'],
+        'started_at': job['started_at'],
+        'finished_at': job['finished_at'],
+    }
+
 
 def _get_saved_contents(user_id):
     conn = _app.get_db()
@@ -66,32 +125,21 @@ def ai():
             return redirect(url_for('ai'))
 
         try:
-            result = _app.deepseek_chat([{"role": "user", "content": message}], model=model)
-            response_text = result.get('choices', [{}])[0].get('message', {}).get('content', str(result))
-
-            conn = _app.get_db()
-            try:
-                content_id = str(uuid.uuid4())
-                conn.execute(
-                    '''INSERT INTO ai_contents (id, user_id, ai_function, prompt, response, created_at)
-                       VALUES (?, ?, 'chat', ?, ?, ?)''',
-                    (content_id, session['user_id'], message, response_text, _bj_now()))
-                conn.commit()
-
-                _app.log_message(log_type='operation', log_level='INFO',
-                           message=f'AI对话完成 (模型: {model})',
-                           user_id=session['user_id'], action='ai_chat',
-                           target_id=content_id, target_type='ai_content', request=request)
-
-                saved_contents = _get_saved_contents(session['user_id'])
-                return render_template('ai_page.html',
-                                     username=session.get('username'),
-                                     user_message=message,
-                                     response=response_text,
-                                     content_id=content_id,
-                                     saved_contents=saved_contents)
-            finally:
-                conn.close()
+            job = _run_ai_job('chat', message, [{"role": "user", "content": message}], model=model)
+            content_id = job['content_id']
+
+            _app.log_message(log_type='operation', log_level='INFO',
+                       message=f'AI对话完成 (模型: {model})',
+                       user_id=session['user_id'], action='ai_chat',
+                       target_id=content_id, target_type='ai_content', request=request)
+
+            saved_contents = _get_saved_contents(session['user_id'])
+            return render_template('ai_page.html',
+                                 username=session.get('username'),
+                                 user_message=message,
+                                 response=job['response'],
+                                 content_id=content_id,
+                                 saved_contents=saved_contents)
 
         except Exception as e:
             flash(f'AI服务调用失败: {str(e)}')
@@ -195,36 +243,31 @@ def api_ai_chat():
 
     if stream:
         try:
-            result = _app.deepseek_chat([{"role": "user", "content": message}], model=model)
-            response_text = result.get('choices', [{}])[0].get('message', {}).get('content', str(result))
-            return _app.api_response(success=True, data={'response': response_text})
+            _app.release_db()
+            result = _app.ai_dispatcher.call(session['user_id'], _app.AI_PRIORITY_INTERACTIVE,
+                                             _app.deepseek_chat, [{"role": "user", "content": message}],
+                                             model=model)
+            return _app.api_response(success=True, data={'response': _app.extract_ai_text(result)})
+        except _app.AIBusyError as e:
+            return _busy_response(e)
         except Exception as e:
             return _app.api_response(success=False, message=f'AI调用失败: {str(e)}')
 
     try:
-        result = _app.deepseek_chat([{"role": "user", "content": message}], model=model)
-        response_text = result.get('choices', [{}])[0].get('message', {}).get('content', str(result))
-
-        conn = _app.get_db()
-        try:
-            content_id = str(uuid.uuid4())
-            conn.execute(
-                '''INSERT INTO ai_contents (id, user_id, ai_function, prompt, response, created_at)
-                   VALUES (?, ?, 'chat', ?, ?, ?)''',
-                (content_id, session['user_id'], message, response_text, _bj_now()))
-            conn.commit()
+        job = _run_ai_job('chat', message, [{"role": "user", "content": message}], model=model)
+        content_id = job['content_id']
 
-            _app.log_message(log_type='operation', log_level='INFO',
-                       message=f'API AI对话完成 (模型: {model})',
-                       user_id=session['user_id'], action='api_ai_chat',
-                       target_id=content_id, target_type='ai_content', request=request)
+        _app.log_message(log_type='operation', log_level='INFO',
+                   message=f'API AI对话完成 (模型: {model})',
+                   user_id=session['user_id'], action='api_ai_chat',
+                   target_id=content_id, target_type='ai_content', request=request)
 
-            return _app.api_response(success=True, data={
-                'response': response_text,
-                'content_id': content_id
-            })
-        finally:
-            conn.close()
+        return _app.api_response(success=True, data={
+            'response': job['response'],
+            'content_id': content_id
+        })
+    except _app.AIBusyError as e:
+        return _busy_response(e)
     except Exception as e:
         return _app.api_response(success=False, message=f'AI调用失败: {str(e)}')
 
@@ -344,9 +387,13 @@ def api_ai_chat_multi_turn():
     model = data.get('model', 'deepseek-chat')
     system_prompt = data.get('system_prompt', '')
 
+    if 'message' in data or data.get('conversation_id'):
+        return _chat_in_conversation(data)
+
     if not messages:
         return _app.api_response(success=False, message='消息不能为空')
 
+    # 兼容旧客户端：每轮回传完整 messages
     try:
         api_messages = []
         if system_prompt:
@@ -355,99 +402,233 @@ def api_ai_chat_multi_turn():
             if msg.get('role') in ('user', 'assistant', 'system'):
                 api_messages.append({"role": msg['role'], "content": msg['content']})
 
-        result = _app.deepseek_chat(api_messages, model=model)
-        response_text = result.get('choices', [{}])[0].get('message', {}).get('content', str(result))
-
-        conn = _app.get_db()
-        try:
-            content_id = str(uuid.uuid4())
-            conversation_json = json.dumps(messages[-3:], ensure_ascii=False)
-            conn.execute(
-                '''INSERT INTO ai_contents (id, user_id, ai_function, prompt, response, created_at)
-                   VALUES (?, ?, 'multi_turn', ?, ?, ?)''',
-                (content_id, session['user_id'],
-                 conversation_json, response_text, _bj_now()))
-            conn.commit()
-        finally:
-            conn.close()
+        conversation_json = json.dumps(messages[-3:], ensure_ascii=False)
+        cache_scope = 'template' if system_prompt in _TEMPLATE_PROMPTS and len(messages) == 1 else None
+        job = _run_ai_job('multi_turn', conversation_json, api_messages, model=model,
+                          cache_scope=cache_scope)
 
         return _app.api_response(success=True, data={
-            'response': response_text,
-            'content_id': content_id
+            'response': job['response'],
+            'content_id': job['content_id']
         })
+    except _app.AIBusyError as e:
+        return _busy_response(e)
     except Exception as e:
         return _app.api_response(success=False, message=f'AI调用失败: {str(e)}')
 
 
-@ai_bp.route('/api/ai/templates', methods=['GET'], endpoint='api_ai_templates')
-def api_ai_templates():
-    templates = [
-        {'id': 'code_review', 'name': '代码审查', 'icon': '🔍',
-         'system_prompt': '你是一位资深代码审查专家，请分析代码质量、安全漏洞和优化建议。',
-         'placeholder': '粘贴你的代码，我来帮你审查...'},
-        {'id': 'doc_writer', 'name': '文档写作', 'icon': '📝',
-         'system_prompt': '你是一位技术文档专家，请帮助撰写清晰、专业的技术文档。',
-         'placeholder': '描述你要写文档的功能或项目...'},
-        {'id': 'translator', 'name': '翻译助手', 'icon': '🌐',
-         'system_prompt': '你是一位专业翻译，请准确翻译并保持原文风格。如未指定语言，默认中英互译。',
-         'placeholder': '输入需要翻译的内容...'},
-        {'id': 'data_analyst', 'name': '数据分析', 'icon': '📊',
-         'system_prompt': '你是一位数据分析专家，请帮助分析数据、生成洞察和建议可视化方案。',
-         'placeholder': '描述你的数据或粘贴CSV数据...'},
-        {'id': 'debug_helper', 'name': '调试助手', 'icon': '🐛',
-         'system_prompt': '你是一位调试专家，请帮助分析错误原因并提供修复方案。',
-         'placeholder': '粘贴错误信息和相关代码...'},
-        {'id': 'general', 'name': '通用对话', 'icon': '💬',
-         'system_prompt': '',
-         'placeholder': '输入你的问题...'},
-    ]
-    return _app.api_response(success=True, data={'templates': templates})
+def _chat_in_conversation(data):
+    """服务端会话模式：客户端只发送本轮 message，上下文由服务端按 token 预算组装"""
+    message = (data.get('message') or '').strip()
+    conversation_id = data.get('conversation_id')
+    if not message:
+        return _app.api_response(success=False, message='消息不能为空')
 
+    conn = _app.get_db()
+    if conversation_id:
+        conversation = conn.execute("SELECT * FROM ai_conversations WHERE id = ? AND user_id = ?",
+                                    (conversation_id, session['user_id'])).fetchone()
+        if not conversation:
+            return _app.api_response(success=False, message='会话不存在', code=404)
+    else:
+        conversation_id = _app.create_ai_conversation(conn, session['user_id'],
+                                                      model=data.get('model', 'deepseek-chat'),
+                                                      system_prompt=data.get('system_prompt', ''))
+        conn.commit()
+        conversation = conn.execute("SELECT * FROM ai_conversations WHERE id = ?",
+                                    (conversation_id,)).fetchone()
 
-@ai_bp.route('/api/ai/analyze-file/<file_id>', methods=['POST'], endpoint='api_ai_analyze_file')
-def api_ai_analyze_file(file_id):
+    api_messages, context = _app.build_ai_context(conn, conversation, new_message=message)
+    first_turn = conversation['message_count'] == 0
+    cache_scope = 'template' if first_turn and conversation['system_prompt'] in _TEMPLATE_PROMPTS else None
+
+    try:
+        job = _run_ai_job('multi_turn', message, api_messages,
+                          model=conversation['model'] or 'deepseek-chat', cache_scope=cache_scope)
+    except _app.AIBusyError as e:
+        return _busy_response(e)
+    except Exception as e:
+        return _app.api_response(success=False, message=f'AI调用失败: {str(e)}')
+
+    # 本轮问答在一个短事务里落库，调用失败时不会留下没有回复的消息
+    try:
+        _app.save_ai_turn(_app.get_db(), conversation_id, message, job['response'])
+    except Exception as e:
+        print(f'[AI] 会话消息保存失败: {e}')
+        return _app.api_response(success=False, message='会话消息保存失败，请稍后重试',
+                                 data={'response': job['response'], 'content_id': job['content_id'],
+                                       'conversation_id': conversation_id}, code=409)
+
+    if context['summarize_upto']:
+        _app.schedule_ai_summary(conversation_id, context['summarize_upto'])
+
+    return _app.api_response(success=True, data={
+        'response': job['response'],
+        'content_id': job['content_id'],
+        'conversation_id': conversation_id,
+        'context': {
+            'tokens': context['tokens'],
+            'messages': context['messages'],
+            'summarized_upto': context['summarized_upto'],
+        }
+    })
+
+
+@ai_bp.route('/api/ai/chat/threads', methods=['GET'], endpoint='api_ai_chat_threads')
+def api_ai_chat_threads():
     if 'user_id' not in session:
         return _app.api_response(success=False, message='请先登录', code=401)
 
+    limit = min(request.args.get('limit', 50, type=int), 200)
+    offset = request.args.get('offset', 0, type=int)
+
     conn = _app.get_db()
     try:
-        file = conn.execute("SELECT * FROM files WHERE id = ?", (file_id,)).fetchone()
-        if not file:
-            return _app.api_response(success=False, message='文件不存在', code=404)
+        rows = conn.execute(
+            """SELECT id, title, model, message_count, created_at, updated_at
+               FROM ai_conversations WHERE user_id = ?
+               ORDER BY updated_at DESC LIMIT ? OFFSET ?""",
+            (session['user_id'], limit, offset)).fetchall()
+        return _app.api_response(success=True, data={
+            'threads': [dict(r) for r in rows],
+            'limit': limit,
+            'offset': offset
+        })
+    finally:
+        conn.close()
 
-        fd = dict(file)
-        analysis_type = request.get_json(silent=True) or {}.get('type', 'summary')
 
-        prompt_map = {
-            'summary': f'请对以下文件进行简要摘要分析：\n文件名：{fd["filename"]}\n大小：{fd["size"]}字节\n项目：{fd.get("project_name", "无")}\n描述：{fd.get("project_desc", "无")}',
-            'tags': f'请为以下文件推荐3-5个标签（只输出标签，逗号分隔）：\n文件名：{fd["filename"]}\n项目：{fd.get("project_name", "无")}\n描述：{fd.get("project_desc", "无")}',
-            'security': f'请分析以下文件的安全风险：\n文件名：{fd["filename"]}\n类型：{fd["filename"].split(".")[-1] if "." in fd["filename"] else "未知"}',
-        }
+@ai_bp.route('/api/ai/chat/threads/<conversation_id>', methods=['GET'], endpoint='api_ai_chat_thread')
+def api_ai_chat_thread(conversation_id):
+    """会话消息，按 seq 倒序分页（before=<seq>）"""
+    if 'user_id' not in session:
+        return _app.api_response(success=False, message='请先登录', code=401)
 
-        prompt = prompt_map.get(analysis_type, prompt_map['summary'])
+    limit = min(request.args.get('limit', 50, type=int), 200)
+    before = request.args.get('before', type=int)
 
-        try:
-            result = _app.deepseek_chat([{"role": "user", "content": prompt}])
-            response_text = result.get('choices', [{}])[0].get('message', {}).get('content', str(result))
-        except Exception as e:
-            return _app.api_response(success=False, message=f'AI分析失败: {str(e)}')
-
-        content_id = str(uuid.uuid4())
-        conn.execute(
-            '''INSERT INTO ai_contents (id, user_id, ai_function, prompt, response, created_at)
-               VALUES (?, ?, 'file_analysis', ?, ?, ?)''',
-            (content_id, session['user_id'], prompt, response_text, _bj_now()))
-        conn.commit()
+    conn = _app.get_db()
+    try:
+        conversation = conn.execute(
+            """SELECT id, title, model, system_prompt, summary, summary_upto, message_count,
+                      created_at, updated_at
+               FROM ai_conversations WHERE id = ? AND user_id = ?""",
+            (conversation_id, session['user_id'])).fetchone()
+        if not conversation:
+            return _app.api_response(success=False, message='会话不存在', code=404)
+
+        params = [conversation_id]
+        where_sql = "conversation_id = ?"
+        if before:
+            where_sql += " AND seq < ?"
+            params.append(before)
+        rows = conn.execute(
+            f"""SELECT seq, role, content, created_at FROM ai_messages
+                WHERE {where_sql} ORDER BY seq DESC LIMIT ?""",
+            (*params, limit)).fetchall()
+        messages = [dict(r) for r in reversed(rows)]
 
         return _app.api_response(success=True, data={
-            'analysis': response_text,
-            'content_id': content_id,
-            'file_id': file_id
+            'conversation': dict(conversation),
+            'messages': messages,
+            'has_more': bool(messages) and messages[0]['seq'] > 1
         })
     finally:
         conn.close()
 
 
+@ai_bp.route('/api/ai/chat/threads/<conversation_id>', methods=['DELETE'], endpoint='api_ai_chat_thread_delete')
+def api_ai_chat_thread_delete(conversation_id):
+    if 'user_id' not in session:
+        return _app.api_response(success=False, message='请先登录', code=401)
+
+    conn = _app.get_db()
+    try:
+        result = conn.execute("DELETE FROM ai_conversations WHERE id = ? AND user_id = ?",
+                              (conversation_id, session['user_id']))
+        if result.rowcount == 0:
+            return _app.api_response(success=False, message='会话不存在', code=404)
+        conn.execute("DELETE FROM ai_messages WHERE conversation_id = ?", (conversation_id,))
+        conn.commit()
+        return _app.api_response(success=True, message='会话已删除')
+    finally:
+        conn.close()
+
+
+@ai_bp.route('/api/ai/dispatcher/stats', methods=['GET'], endpoint='api_ai_dispatcher_stats')
+def api_ai_dispatcher_stats():
+    if 'user_id' not in session or session.get('role') != 'admin':
+        return _app.api_response(success=False, message='权限不足', code=403)
+    return _app.api_response(success=True, data=_app.ai_dispatcher.get_stats())
+
+
+@ai_bp.route('/api/ai/templates', methods=['GET'], endpoint='api_ai_templates')
+def api_ai_templates():
+    return _app.api_response(success=True, data={'templates': AI_TEMPLATES})
+
+
+@ai_bp.route('/api/ai/analyze-file/<file_id>', methods=['POST'], endpoint='api_ai_analyze_file')
+def api_ai_analyze_file(file_id):
+    """文件 AI 分析；async=true 时放入后台队列，通过 /api/ai/jobs/<job_id> 轮询或 ai_job_update 事件获取结果"""
+    if 'user_id' not in session:
+        return _app.api_response(success=False, message='请先登录', code=401)
+
+    data = request.get_json(silent=True) or {}
+    analysis_type = data.get('type', 'summary')
+    run_async = bool(data.get('async', False))
+
+    conn = _app.get_db()
+    file = conn.execute("SELECT * FROM files WHERE id = ?", (file_id,)).fetchone()
+    if not file:
+        return _app.api_response(success=False, message='文件不存在', code=404)
+    fd = dict(file)
+
+    prompt_map = {
+        'summary': f'请对以下文件进行简要摘要分析：\n文件名：{fd["filename"]}\n大小：{fd["size"]}字节\n项目：{fd.get("project_name", "无")}\n描述：{fd.get("project_desc", "无")}',
+        'tags': f'请为以下文件推荐3-5个标签（只输出标签，逗号分隔）：\n文件名：{fd["filename"]}\n项目：{fd.get("project_name", "无")}\n描述：{fd.get("project_desc", "无")}',
+        'security': f'请分析以下文件的安全风险：\n文件名：{fd["filename"]}\n类型：{fd["filename"].split(".")[-1] if "." in fd["filename"] else "未知"}',
+    }
+
+    prompt = prompt_map.get(analysis_type, prompt_map['summary'])
+    messages = [{"role": "user", "content": prompt}]
+
+    if run_async:
+        _app.release_db()
+        job_id = _app.create_ai_job(session['user_id'], 'file_analysis', prompt, target_id=file_id)
+        _app.submit_ai_job(job_id, messages, cache_scope=f'file_{file_id}')
+        return _app.api_response(success=True, message='分析任务已提交', data={
+            'job_id': job_id,
+            'status': 'pending',
+            'file_id': file_id
+        }, code=202)
+
+    try:
+        job = _run_ai_job('file_analysis', prompt, messages, target_id=file_id,
+                          cache_scope=f'file_{file_id}')
+    except _app.AIBusyError as e:
+        return _busy_response(e)
+    except Exception as e:
+        return _app.api_response(success=False, message=f'AI分析失败: {str(e)}')
+
+    return _app.api_response(success=True, data={
+        'analysis': job['response'],
+        'content_id': job['content_id'],
+        'file_id': file_id,
+        'job_id': job['id']
+    })
+
+
+@ai_bp.route('/api/ai/jobs/<job_id>', methods=['GET'], endpoint='api_ai_job_status')
+def api_ai_job_status(job_id):
+    if 'user_id' not in session:
+        return _app.api_response(success=False, message='请先登录', code=401)
+
+    job = _app.get_ai_job(job_id, user_id=session['user_id'])
+    if not job:
+        return _app.api_response(success=False, message='任务不存在', code=404)
+    return _app.api_response(success=True, data=_serialize_job(job))
+
+
 @ai_bp.route('/api/ai/chat/stream', methods=['POST'], endpoint='api_ai_chat_stream')
 def api_ai_chat_stream():
     if 'user_id' not in session:
@@ -461,24 +642,14 @@ def api_ai_chat_stream():
         return _app.api_response(success=False, message='消息不能为空')
 
     try:
-        result = _app.deepseek_chat([{"role": "user", "content": message}], model=model)
-        response_text = result.get('choices', [{}])[0].get('message', {}).get('content', str(result))
-
-        conn = _app.get_db()
-        try:
-            content_id = str(uuid.uuid4())
-            conn.execute(
-                '''INSERT INTO ai_contents (id, user_id, ai_function, prompt, response, created_at)
-                   VALUES (?, ?, 'chat', ?, ?, ?)''',
-                (content_id, session['user_id'], message, response_text, _bj_now()))
-            conn.commit()
-        finally:
-            conn.close()
+        job = _run_ai_job('chat', message, [{"role": "user", "content": message}], model=model)
 
         return _app.api_response(success=True, data={
-            'response': response_text,
-            'content_id': content_id
+            'response': job['response'],
+            'content_id': job['content_id']
         })
+    except _app.AIBusyError as e:
+        return _busy_response(e)
     except Exception as e:
         return _app.api_response(success=False, message=f'AI调用失败: {str(e)}')
 
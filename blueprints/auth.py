@@ -19,7 +19,7 @@ class _LazyAppImports:
             log_message, log_login_attempt, api_response,
             get_access_logs, get_file_by_id, page_error_response,
             get_like_count, get_favorite_count, is_liked, is_favorited,
-            assign_category_to_file, get_favorite_files
+            assign_category_to_file, get_favorite_files, invalidate_user_snapshot
         )
         locals_dict = locals()
         if name in locals_dict:
@@ -323,6 +323,7 @@ def update_profile():
                        (username, session['user_id']))
 
         conn.commit()
+        _app.invalidate_user_snapshot(session['user_id'])
 
         session['username'] = username
 
@@ -524,8 +525,6 @@ def detail(file_id):
 
         is_owner = file['user_id'] == session.get('user_id') or session.get('role') == 'admin'
 
-        file['like_count'] = _app.get_like_count(file_id)
-        file['favorite_count'] = _app.get_favorite_count(file_id)
         file['is_liked'] = _app.is_liked(file_id, session.get('user_id'))
         file['is_favorited'] = _app.is_favorited(file_id, session.get('user_id'))
 
@@ -603,6 +602,8 @@ def change_password():
         new_hash = generate_password_hash(new_password)
         conn.execute('UPDATE users SET password = ? WHERE id = ?', (new_hash, session['user_id']))
         conn.commit()
+        from blueprints.miniapp import revoke_miniapp_tokens
+        revoke_miniapp_tokens(session['user_id'])
 
         _app.log_message(log_type='security', log_level='INFO',
                    message='用户修改了密码', user_id=session['user_id'],
@@ -643,6 +644,7 @@ def change_email():
 
         conn.execute('UPDATE users SET email = ? WHERE id = ?', (new_email, session['user_id']))
         conn.commit()
+        _app.invalidate_user_snapshot(session['user_id'])
         session['email'] = new_email
 
         _app.log_message(log_type='security', log_level='INFO',
@@ -22,54 +22,122 @@ _app = _LazyAppImports()
 comments_bp = Blueprint('comments', __name__)
 
 
-def _build_reactions(reaction_rows):
-    reactions = {}
-    for r in reaction_rows:
-        emoji = r['emoji']
-        if emoji not in reactions:
-            reactions[emoji] = {'emoji': emoji, 'count': 0, 'users': []}
-        reactions[emoji]['count'] += 1
-        reactions[emoji]['users'].append({'user_id': r['user_id'], 'username': r['username']})
-    return list(reactions.values())
+# 每条顶层评论随列表返回的回复预览条数，其余回复通过 replies 接口按需加载
+REPLY_PREVIEW_LIMIT = 3
+MAX_PAGE_SIZE = 100
+
+# 排序方式 -> (ORDER BY, 游标字段)
+_SORTS = {
+    'newest': ("c.created_at DESC, c.id DESC", ('created_at', 'id')),
+    'oldest': ("c.created_at ASC, c.id ASC", ('created_at', 'id')),
+    'unresolved': ("c.is_resolved ASC, c.created_at DESC, c.id DESC", ('is_resolved', 'created_at', 'id')),
+}
+
+_COMMENT_COLUMNS = "c.*, u.username"
+
+
+def _load_reactions(conn, comment_ids):
+    """一次分组查询取回多条评论的表情汇总：comment_id -> [{emoji, count, users}]"""
+    result = {cid: [] for cid in comment_ids}
+    if not comment_ids:
+        return result
+    placeholders = ','.join('?' * len(comment_ids))
+    rows = conn.execute(
+        f"""SELECT cr.comment_id, cr.emoji, COUNT(*) AS count,
+                   json_group_array(json_object('user_id', cr.user_id, 'username', u.username)) AS users
+            FROM comment_reactions cr
+            LEFT JOIN users u ON cr.user_id = u.id
+            WHERE cr.comment_id IN ({placeholders})
+            GROUP BY cr.comment_id, cr.emoji
+            ORDER BY cr.comment_id, MIN(cr.created_at)""",
+        list(comment_ids)
+    ).fetchall()
+    for r in rows:
+        result[r['comment_id']].append({
+            'emoji': r['emoji'],
+            'count': r['count'],
+            'users': json.loads(r['users']),
+        })
+    return result
+
+
+def _encode_cursor(row, fields):
+    payload = json.dumps([row[f] for f in fields], ensure_ascii=False)
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def _decode_cursor(cursor, fields):
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(values, list) or len(values) != len(fields):
+        return None
+    # 游标来自客户端，只接受标量值，否则回退到第一页
+    for field, value in zip(fields, values):
+        if isinstance(value, bool) or not isinstance(value, (str, int)):
+            return None
+        if field == 'is_resolved' and not isinstance(value, int):
+            return None
+    return values
+
+
+def _cursor_condition(sort, values):
+    """把游标翻译成 WHERE 条件（与 _SORTS 中的排序方向一致）"""
+    if sort == 'oldest':
+        return "(c.created_at, c.id) > (?, ?)", values
+    if sort == 'unresolved':
+        is_resolved, created_at, comment_id = values
+        return ("(c.is_resolved > ? OR (c.is_resolved = ? AND (c.created_at, c.id) < (?, ?)))",
+                [is_resolved, is_resolved, created_at, comment_id])
+    return "(c.created_at, c.id) < (?, ?)", values
+
+
+def _serialize_comment(row):
+    comment = dict(row)
+    comment['supports_markdown'] = True
+    return comment
 
 
 def _handle_mentions(content, comment_id, author_id, conn):
-    mentions = re.findall(r'@(\w+)', content)
+    mentions = list(dict.fromkeys(re.findall(r'@(\w+)', content)))
     if not mentions:
         return
-    seen = set()
-    for username in mentions:
-        if username in seen:
-            continue
-        seen.add(username)
-        user = conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
-        if not user or user['id'] == author_id:
-            continue
-        notif_id = uuid.uuid4().hex
-        truncated = content[:100]
-        conn.execute(
-            """INSERT INTO notifications (id, user_id, type, category, title, content,
-               icon, action_url, action_text, source_type, source_id, is_read, created_at, expires_at)
-               VALUES (?, ?, 'comment_mention', 'info', '在评论中提到了你', ?, '', '', '查看详情',
-                       'comment', ?, 0, CURRENT_TIMESTAMP, '')""",
-            (notif_id, user['id'], truncated, comment_id)
-        )
+    placeholders = ','.join('?' * len(mentions))
+    users = conn.execute(
+        f"SELECT id FROM users WHERE username IN ({placeholders}) AND id != ?",
+        (*mentions, author_id)
+    ).fetchall()
+    if not users:
+        return
+    truncated = content[:100]
+    conn.executemany(
+        """INSERT INTO notifications (id, user_id, type, category, title, content,
+           icon, action_url, action_text, source_type, source_id, is_read, created_at, expires_at)
+           VALUES (?, ?, 'comment_mention', 'info', '在评论中提到了你', ?, '', '', '查看详情',
+                   'comment', ?, 0, CURRENT_TIMESTAMP, '')""",
+        [(uuid.uuid4().hex, user['id'], truncated, comment_id) for user in users]
+    )
     conn.commit()
 
 
 @comments_bp.route('/api/files/<file_id>/comments', methods=['GET'], endpoint='api_list_comments')
 def api_list_comments(file_id):
+    """顶层评论分页（cursor 游标优先，兼容 page 页码），附带回复预览与表情汇总"""
     if 'user_id' not in session:
         return _app.api_response(success=False, message='未登录', code=401)
 
     page = request.args.get('page', 1, type=int)
-    per_page = request.args.get('per_page', 20, type=int)
+    per_page = min(max(request.args.get('per_page', 20, type=int), 1), MAX_PAGE_SIZE)
     sort = request.args.get('sort', 'newest')
+    cursor = request.args.get('cursor', '')
 
-    if sort not in ('newest', 'oldest', 'unresolved'):
+    if sort not in _SORTS:
         sort = 'newest'
-
-    offset = (page - 1) * per_page
+    order_sql, cursor_fields = _SORTS[sort]
 
     conn = _app.get_db()
     try:
@@ -77,59 +145,70 @@ def api_list_comments(file_id):
         if not file_row:
             return _app.api_response(success=False, message='文件不存在', code=404)
 
-        if sort == 'oldest':
-            order_sql = "c.created_at ASC"
-        elif sort == 'unresolved':
-            order_sql = "c.is_resolved ASC, c.created_at DESC"
-        else:
-            order_sql = "c.created_at DESC"
-
         total = conn.execute(
             "SELECT COUNT(*) FROM file_comments WHERE file_id = ? AND parent_id IS NULL",
             (file_id,)
         ).fetchone()[0]
 
+        where_sql = "c.file_id = ? AND c.parent_id IS NULL"
+        params = [file_id]
+        cursor_values = _decode_cursor(cursor, cursor_fields)
+        if cursor_values is not None:
+            condition, condition_params = _cursor_condition(sort, cursor_values)
+            where_sql += " AND " + condition
+            params.extend(condition_params)
+            offset = 0
+        else:
+            offset = (max(page, 1) - 1) * per_page
+
         rows = conn.execute(
-            f"""SELECT c.*, u.username FROM file_comments c
+            f"""SELECT {_COMMENT_COLUMNS} FROM file_comments c
                 LEFT JOIN users u ON c.user_id = u.id
-                WHERE c.file_id = ? AND c.parent_id IS NULL
+                WHERE {where_sql}
                 ORDER BY {order_sql} LIMIT ? OFFSET ?""",
-            (file_id, per_page, offset)
+            (*params, per_page + 1, offset)
         ).fetchall()
 
-        comments = []
-        for row in rows:
-            comment = dict(row)
-            comment['supports_markdown'] = True
-            comment['replies'] = []
+        has_more = len(rows) > per_page
+        rows = rows[:per_page]
+        comments = [_serialize_comment(row) for row in rows]
+        top_ids = [c['id'] for c in comments]
 
+        # 所有顶层评论的回复预览与回复总数：一次窗口函数查询
+        replies_by_parent = {cid: [] for cid in top_ids}
+        reply_counts = dict.fromkeys(top_ids, 0)
+        if top_ids:
+            placeholders = ','.join('?' * len(top_ids))
             reply_rows = conn.execute(
-                """SELECT c.*, u.username FROM file_comments c
-                   LEFT JOIN users u ON c.user_id = u.id
-                   WHERE c.parent_id = ? ORDER BY c.created_at ASC""",
-                (comment['id'],)
+                f"""SELECT * FROM (
+                        SELECT {_COMMENT_COLUMNS},
+                               ROW_NUMBER() OVER (PARTITION BY c.parent_id ORDER BY c.created_at, c.id) AS reply_rank,
+                               COUNT(*) OVER (PARTITION BY c.parent_id) AS reply_total
+                        FROM file_comments c
+                        LEFT JOIN users u ON c.user_id = u.id
+                        WHERE c.parent_id IN ({placeholders})
+                    ) WHERE reply_rank <= ?
+                    ORDER BY parent_id, reply_rank""",
+                (*top_ids, REPLY_PREVIEW_LIMIT)
             ).fetchall()
-
             for reply in reply_rows:
-                reply_dict = dict(reply)
-                reply_dict['supports_markdown'] = True
-                reaction_rows = conn.execute(
-                    """SELECT cr.emoji, cr.user_id, u.username FROM comment_reactions cr
-                       LEFT JOIN users u ON cr.user_id = u.id
-                       WHERE cr.comment_id = ?""",
-                    (reply_dict['id'],)
-                ).fetchall()
-                reply_dict['reactions'] = _build_reactions(reaction_rows)
-                comment['replies'].append(reply_dict)
-
-            reaction_rows = conn.execute(
-                """SELECT cr.emoji, cr.user_id, u.username FROM comment_reactions cr
-                   LEFT JOIN users u ON cr.user_id = u.id
-                   WHERE cr.comment_id = ?""",
-                (comment['id'],)
-            ).fetchall()
-            comment['reactions'] = _build_reactions(reaction_rows)
-            comments.append(comment)
+                reply_dict = _serialize_comment(reply)
+                reply_counts[reply_dict['parent_id']] = reply_dict.pop('reply_total')
+                reply_dict.pop('reply_rank', None)
+                replies_by_parent[reply_dict['parent_id']].append(reply_dict)
+
+        reply_ids = [r['id'] for replies in replies_by_parent.values() for r in replies]
+        reactions = _load_reactions(conn, top_ids + reply_ids)
+
+        for comment in comments:
+            replies = replies_by_parent[comment['id']]
+            for reply in replies:
+                reply['reactions'] = reactions[reply['id']]
+            comment['replies'] = replies
+            comment['reply_count'] = reply_counts[comment['id']]
+            comment['replies_cursor'] = (_encode_cursor(replies[-1], ('created_at', 'id'))
+                                         if comment['reply_count'] > len(replies) else None)
+            comment['reactions'] = reactions[comment['id']]
 
         return _app.api_response(success=True, data={
             'comments': comments,
@@ -137,13 +216,60 @@ def api_list_comments(file_id):
                 'page': page,
                 'per_page': per_page,
                 'total': total,
-                'total_pages': (total + per_page - 1) // per_page
+                'total_pages': (total + per_page - 1) // per_page,
+                'has_more': has_more,
+                'next_cursor': _encode_cursor(rows[-1], cursor_fields) if has_more else None,
             }
         })
     finally:
         conn.close()
 
 
+@comments_bp.route('/api/comments/<comment_id>/replies', methods=['GET'], endpoint='api_list_comment_replies')
+def api_list_comment_replies(comment_id):
+    """按需加载某条评论的回复（按时间正序游标翻页）"""
+    if 'user_id' not in session:
+        return _app.api_response(success=False, message='未登录', code=401)
+
+    limit = min(max(request.args.get('limit', 20, type=int), 1), MAX_PAGE_SIZE)
+    cursor_values = _decode_cursor(request.args.get('cursor', ''), ('created_at', 'id'))
+
+    conn = _app.get_db()
+    try:
+        parent = conn.execute("SELECT id FROM file_comments WHERE id = ?", (comment_id,)).fetchone()
+        if not parent:
+            return _app.api_response(success=False, message='评论不存在', code=404)
+
+        where_sql = "c.parent_id = ?"
+        params = [comment_id]
+        if cursor_values is not None:
+            where_sql += " AND (c.created_at, c.id) > (?, ?)"
+            params.extend(cursor_values)
+
+        rows = conn.execute(
+            f"""SELECT {_COMMENT_COLUMNS} FROM file_comments c
+                LEFT JOIN users u ON c.user_id = u.id
+                WHERE {where_sql}
+                ORDER BY c.created_at ASC, c.id ASC LIMIT ?""",
+            (*params, limit + 1)
+        ).fetchall()
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        replies = [_serialize_comment(row) for row in rows]
+        reactions = _load_reactions(conn, [r['id'] for r in replies])
+        for reply in replies:
+            reply['reactions'] = reactions[reply['id']]
+
+        return _app.api_response(success=True, data={
+            'replies': replies,
+            'has_more': has_more,
+            'next_cursor': _encode_cursor(rows[-1], ('created_at', 'id')) if has_more else None,
+        })
+    finally:
+        conn.close()
+
+
 @comments_bp.route('/api/files/<file_id>/comments', methods=['POST'], endpoint='api_create_comment')
 def api_create_comment(file_id):
     if 'user_id' not in session:
@@ -273,12 +399,11 @@ def api_delete_comment(comment_id):
         if not is_author and not is_admin:
             return _app.api_response(success=False, message='无权删除此评论', code=403)
 
-        conn.execute("DELETE FROM comment_reactions WHERE comment_id = ?", (comment_id,))
-        reply_rows = conn.execute(
-            "SELECT id FROM file_comments WHERE parent_id = ?", (comment_id,)
-        ).fetchall()
-        for reply in reply_rows:
-            conn.execute("DELETE FROM comment_reactions WHERE comment_id = ?", (reply['id'],))
+        conn.execute(
+            """DELETE FROM comment_reactions
+               WHERE comment_id = ? OR comment_id IN (SELECT id FROM file_comments WHERE parent_id = ?)""",
+            (comment_id, comment_id)
+        )
         conn.execute("DELETE FROM file_comments WHERE parent_id = ?", (comment_id,))
         conn.execute("DELETE FROM file_comments WHERE id = ?", (comment_id,))
         conn.commit()
@@ -369,13 +494,7 @@ def api_react_comment(comment_id):
 
         conn.commit()
 
-        reaction_rows = conn.execute(
-            """SELECT cr.emoji, cr.user_id, u.username FROM comment_reactions cr
-               LEFT JOIN users u ON cr.user_id = u.id
-               WHERE cr.comment_id = ?""",
-            (comment_id,)
-        ).fetchall()
-        reactions = _build_reactions(reaction_rows)
+        reactions = _load_reactions(conn, [comment_id])[comment_id]
 
         return _app.api_response(success=True, data={'reactions': reactions})
     finally:
@@ -20,8 +20,10 @@ class _LazyAppImports:
             get_db, get_all_files, log_message, log_access,
             page_error_response, api_response,
             get_file_by_id, get_like_count, get_favorite_count,
-            is_liked, is_favorited,
-            get_user_storage_usage
+            is_liked, is_favorited, get_user_interactions,
+            get_user_storage_usage, get_folder_breadcrumbs, get_folder_tree_stats,
+            move_folder, SQL_UUID4, trash_files,
+            invalidate_ai_cache,
         )
         locals_dict = locals()
         if name in locals_dict:
@@ -243,8 +245,6 @@ def folder_file_detail(file_id):
 
         is_owner = file['user_id'] == session.get('user_id') or session.get('role') == 'admin'
 
-        file['like_count'] = _app.get_like_count(file_id)
-        file['favorite_count'] = _app.get_favorite_count(file_id)
         file['is_liked'] = _app.is_liked(file_id, session.get('user_id'))
         file['is_favorited'] = _app.is_favorited(file_id, session.get('user_id'))
 
@@ -438,8 +438,6 @@ def file_info(file_id):
         if not file:
             return _app.api_response(success=False, message="文件不存在", code=404)
 
-        file['like_count'] = _app.get_like_count(file_id)
-        file['favorite_count'] = _app.get_favorite_count(file_id)
         file['is_liked'] = _app.is_liked(file_id, session.get('user_id'))
         file['is_favorited'] = _app.is_favorited(file_id, session.get('user_id'))
 
@@ -519,6 +517,7 @@ def file_replace():
                        dkfile=?, updated_at=CURRENT_TIMESTAMP WHERE id=?""",
                     (new_file.filename, new_stored_name, new_path, new_size, dkfile_info, file_id))
         conn.commit()
+        _app.invalidate_ai_cache(file_id)
 
         _app.log_message(log_type='operation', log_level='INFO',
                    message=f"替换文件: {existing['filename']} -> {new_file.filename}",
@@ -913,25 +912,7 @@ def batch_delete_files():
 
     conn = _app.get_db()
     try:
-        deleted_count = 0
-        for fid in file_ids:
-            if fid:
-                file = conn.execute('SELECT * FROM files WHERE id = ? AND user_id = ?',
-                                   (fid, session['user_id'])).fetchone()
-                if file:
-                    file = dict(file)
-                    trash_id = str(uuid.uuid4())
-                    from datetime import timezone, timedelta as _td
-                    bj_tz = timezone(_td(hours=8))
-                    bj_now = datetime.now(bj_tz).strftime('%Y-%m-%d %H:%M:%S') + '+08:00'
-                    expire_at = (datetime.now(bj_tz) + timedelta(days=30)).isoformat()
-                    conn.execute('''INSERT INTO trash (id, file_id, user_id, filename, stored_name, file_path, file_size, file_type, folder_id, deleted_at, expire_at)
-                                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                                (trash_id, fid, session['user_id'], file['filename'], file['stored_name'],
-                                 file.get('path', ''), file.get('size', 0), '', file.get('folder_id'), bj_now, expire_at))
-                    conn.execute('DELETE FROM files WHERE id = ? AND user_id = ?', (fid, session['user_id']))
-                    deleted_count += 1
-
+        deleted_count = _app.trash_files(conn, session['user_id'], file_ids)
         conn.commit()
 
         _app.log_message(log_type='operation', log_level='WARNING',
@@ -1002,7 +983,9 @@ def folder_detail(folder_id):
                              folder=dict(folder) if folder else None,
                              files=[dict(f) for f in files],
                              subfolders=[dict(s) for s in subfolders],
-                             user_folders=[dict(uf) for uf in user_folders])
+                             user_folders=[dict(uf) for uf in user_folders],
+                             breadcrumbs=_app.get_folder_breadcrumbs(conn, folder_id),
+                             tree_stats=_app.get_folder_tree_stats(conn, folder_id))
     finally:
         conn.close()
 
@@ -1022,47 +1005,21 @@ def delete_folder(folder_id):
 
         folder = dict(folder)
 
-        def move_files_to_trash(parent_folder_id):
-            from datetime import timezone, timedelta as _td
-            bj_tz = timezone(_td(hours=8))
-            bj_now = datetime.now(bj_tz).strftime('%Y-%m-%d %H:%M:%S') + '+08:00'
-            expire_at_val = (datetime.now(bj_tz) + timedelta(days=30)).isoformat()
-            subfolders = conn.execute('SELECT id FROM folders WHERE parent_id = ? AND user_id = ?',
-                                     (parent_folder_id, session['user_id'])).fetchall()
-            for subfolder in subfolders:
-                move_files_to_trash(subfolder['id'])
-                sub_files = conn.execute('SELECT * FROM files WHERE folder_id = ? AND user_id = ?',
-                                        (subfolder['id'], session['user_id'])).fetchall()
-                for f in sub_files:
-                    f = dict(f)
-                    trash_id = str(uuid.uuid4())
-                    conn.execute('''INSERT INTO trash (id, file_id, user_id, filename, stored_name, file_path, file_size, file_type, folder_id, deleted_at, expire_at)
-                                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                                (trash_id, f['id'], session['user_id'], f['filename'], f['stored_name'],
-                                 f.get('path', ''), f.get('size', 0), '', f.get('folder_id'), bj_now, expire_at_val))
-                conn.execute('DELETE FROM files WHERE folder_id = ? AND user_id = ?',
-                            (subfolder['id'], session['user_id']))
-                conn.execute('DELETE FROM folders WHERE id = ?', (subfolder['id'],))
-
-        move_files_to_trash(folder_id)
-
-        files_in_folder = conn.execute('SELECT * FROM files WHERE folder_id = ? AND user_id = ?',
-                                       (folder_id, session['user_id'])).fetchall()
         from datetime import timezone, timedelta as _td
         bj_tz = timezone(_td(hours=8))
         bj_now = datetime.now(bj_tz).strftime('%Y-%m-%d %H:%M:%S') + '+08:00'
         expire_at = (datetime.now(bj_tz) + timedelta(days=30)).isoformat()
-        for f in files_in_folder:
-            f = dict(f)
-            trash_id = str(uuid.uuid4())
-            conn.execute('''INSERT INTO trash (id, file_id, user_id, filename, stored_name, file_path, file_size, file_type, folder_id, deleted_at, expire_at)
-                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                        (trash_id, f['id'], session['user_id'], f['filename'], f['stored_name'],
-                         f.get('path', ''), f.get('size', 0), '', f.get('folder_id'), bj_now, expire_at))
-
-        conn.execute('DELETE FROM files WHERE folder_id = ? AND user_id = ?',
-                    (folder_id, session['user_id']))
-        conn.execute('DELETE FROM folders WHERE id = ?', (folder_id,))
+
+        # 整棵子树一次处理：闭包表给出所有后代文件夹
+        subtree = 'SELECT descendant FROM folder_closure WHERE ancestor = ?'
+        conn.execute(f'''INSERT INTO trash (id, file_id, user_id, filename, stored_name, file_path, file_size, file_type, folder_id, deleted_at, expire_at)
+                         SELECT {_app.SQL_UUID4}, id, user_id, filename, stored_name, COALESCE(path, ''), COALESCE(size, 0), '', folder_id, ?, ?
+                         FROM files WHERE user_id = ? AND folder_id IN ({subtree})''',
+                     (bj_now, expire_at, session['user_id'], folder_id))
+        conn.execute(f'DELETE FROM files WHERE user_id = ? AND folder_id IN ({subtree})',
+                     (session['user_id'], folder_id))
+        conn.execute(f'DELETE FROM folders WHERE user_id = ? AND id IN ({subtree})',
+                     (session['user_id'], folder_id))
         conn.commit()
 
         _app.log_message(log_type='operation', log_level='WARNING',
@@ -1083,6 +1040,35 @@ def delete_folder(folder_id):
     return redirect(url_for('project_folders'))
 
 
+@files_bp.route('/api/folders/<folder_id>/move', methods=['POST'], endpoint='api_move_folder')
+def api_move_folder(folder_id):
+    if 'user_id' not in session:
+        return _app.api_response(success=False, message='请先登录', code=401)
+
+    data = request.get_json(silent=True) or {}
+    new_parent_id = data.get('parent_id') or None
+
+    conn = _app.get_db()
+    try:
+        ok, message = _app.move_folder(conn, folder_id, new_parent_id, session['user_id'])
+        if not ok:
+            return _app.api_response(success=False, message=message)
+        conn.commit()
+
+        _app.log_message(log_type='operation', log_level='INFO', message='移动文件夹',
+                   user_id=session['user_id'], action='move_folder',
+                   target_id=folder_id, target_type='folder',
+                   details=f'目标父文件夹: {new_parent_id or "根目录"}', request=request)
+
+        return _app.api_response(success=True, message=message,
+                                 data={'breadcrumbs': _app.get_folder_breadcrumbs(conn, folder_id)})
+    except Exception as e:
+        conn.rollback()
+        return _app.api_response(success=False, message=f'移动失败: {str(e)}')
+    finally:
+        conn.close()
+
+
 @files_bp.route('/create-folder', methods=['POST'], endpoint='create_folder')
 def create_folder():
     if 'user_id' not in session:
@@ -1140,6 +1126,7 @@ def api_my_files():
     search = request.args.get('search', '')
     category = request.args.get('category', '')
     tag = request.args.get('tag', '')
+    sort = request.args.get('sort', 'latest')
 
     offset = (page - 1) * per_page
     where_clauses = ['f.user_id = ?']
@@ -1158,22 +1145,29 @@ def api_my_files():
         params.append(tag)
 
     where_sql = ' AND '.join(where_clauses)
+    if sort == 'popular':
+        order_sql = 'f.like_count DESC, f.favorite_count DESC, f.created_at DESC'
+    else:
+        order_sql = 'f.created_at DESC'
     count_sql = f'SELECT COUNT(*) FROM files f WHERE {where_sql}'
     data_sql = f'''SELECT f.* FROM files f WHERE {where_sql}
-                  ORDER BY f.created_at DESC LIMIT ? OFFSET ?'''
+                  ORDER BY {order_sql} LIMIT ? OFFSET ?'''
 
     conn = _app.get_db()
     try:
         total = conn.execute(count_sql, params).fetchone()[0]
         rows = conn.execute(data_sql, params + [per_page, offset]).fetchall()
 
+        liked_ids, favorited_ids = _app.get_user_interactions(
+            [row['id'] for row in rows], session.get('user_id'))
+
         files = []
         for row in rows:
             f = dict(row)
-            f['like_count'] = _app.get_like_count(f['id'])
-            f['favorite_count'] = _app.get_favorite_count(f['id'])
-            f['is_liked'] = _app.is_liked(f['id'], session.get('user_id'))
-            f['is_favorited'] = _app.is_favorited(f['id'], session.get('user_id'))
+            f['like_count'] = f.get('like_count') or 0
+            f['favorite_count'] = f.get('favorite_count') or 0
+            f['is_liked'] = f['id'] in liked_ids
+            f['is_favorited'] = f['id'] in favorited_ids
             file_tags = conn.execute(
                 """SELECT t.id, t.name FROM tags t JOIN file_tags ft ON t.id = ft.tag_id
                    WHERE ft.file_id = ?""", (f['id'],)).fetchall()
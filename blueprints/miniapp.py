@@ -4,6 +4,10 @@ from functools import wraps
 import uuid
 import json
 import os
+import time
+import threading
+from collections import OrderedDict
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
 import requests as http_requests
 from datetime import datetime, timedelta
 
@@ -19,8 +23,10 @@ class _LazyAppImports:
             get_db, get_all_files, log_message, log_access,
             api_response, get_file_by_id,
             get_like_count, get_favorite_count,
-            is_liked, is_favorited,
-            deepseek_chat,
+            is_liked, is_favorited, get_user_interactions,
+            deepseek_chat, invalidate_user_snapshot, load_user_snapshot,
+            release_db, create_ai_job, run_ai_job,
+            get_workspace_role, invalidate_workspace_roles,
         )
         locals_dict = locals()
         if name in locals_dict:
@@ -38,21 +44,148 @@ def _get_token_from_request():
     return request.args.get('token', '')
 
 
+SESSION_DAYS = 30
+# 会话缓存：token -> 用户信息，TTL 不超过会话本身的过期时间
+# 缓存只在本进程内有效，TTL 即其他进程最多还能接受已吊销令牌的秒数，因此取值要短
+SESSION_CACHE_TTL = int(os.getenv('MINIAPP_SESSION_CACHE_TTL', '5'))
+SESSION_CACHE_MAX = int(os.getenv('MINIAPP_SESSION_CACHE_MAX', '10000'))
+# 无状态令牌模式：签名令牌只携带用户ID与令牌版本，校验时与数据库中的当前版本比对
+STATELESS_TOKENS = os.getenv('MINIAPP_STATELESS_TOKENS', 'false').lower() == 'true'
+STATELESS_PREFIX = 's.'
+# 缓存与令牌中保留的用户字段（不含密码）
+_PRINCIPAL_FIELDS = ('id', 'username', 'email', 'role', 'avatar', 'avatar_url')
+
+_session_cache = OrderedDict()
+_token_versions = OrderedDict()  # user_id -> (令牌版本, 过期时间)
+_session_lock = threading.Lock()
+_tables_ready = False
+
+
+def _principal(user):
+    return {k: user.get(k) for k in _PRINCIPAL_FIELDS if k in user}
+
+
+def _cache_session(token, user, expires_at):
+    ttl = min(SESSION_CACHE_TTL, expires_at - time.time())
+    if ttl <= 0:
+        return
+    with _session_lock:
+        _session_cache[token] = (_principal(user), time.time() + ttl)
+        _session_cache.move_to_end(token)
+        while len(_session_cache) > SESSION_CACHE_MAX:
+            _session_cache.popitem(last=False)
+
+
+def _cached_session(token):
+    with _session_lock:
+        entry = _session_cache.get(token)
+        if entry is None:
+            return None
+        user, expires = entry
+        if expires <= time.time():
+            del _session_cache[token]
+            return None
+        _session_cache.move_to_end(token)
+        return dict(user)
+
+
+def invalidate_miniapp_sessions(token=None, user_id=None):
+    """登出或用户信息变更后清除会话缓存"""
+    with _session_lock:
+        if token is not None:
+            _session_cache.pop(token, None)
+        if user_id is not None:
+            for key in [k for k, (u, _) in _session_cache.items() if u.get('id') == user_id]:
+                del _session_cache[key]
+            _token_versions.pop(user_id, None)
+
+
+def _token_serializer():
+    return URLSafeTimedSerializer(_app.app.secret_key, salt='miniapp-session')
+
+
+def _issue_stateless_token(user):
+    return STATELESS_PREFIX + _token_serializer().dumps(
+        {'id': user['id'], 'tv': user.get('token_version') or 0})
+
+
+def _current_token_version(user_id):
+    """从数据库读取用户当前令牌版本，按 SESSION_CACHE_TTL 短暂缓存；用户不存在时返回None"""
+    now = time.time()
+    with _session_lock:
+        entry = _token_versions.get(user_id)
+        if entry is not None and entry[1] > now:
+            return entry[0]
+    row = _app.get_db().execute(
+        "SELECT COALESCE(token_version, 0) FROM users WHERE id = ?", (user_id,)
+    ).fetchone()
+    version = row[0] if row else None
+    with _session_lock:
+        _token_versions[user_id] = (version, now + SESSION_CACHE_TTL)
+        _token_versions.move_to_end(user_id)
+        while len(_token_versions) > SESSION_CACHE_MAX:
+            _token_versions.popitem(last=False)
+    return version
+
+
+def _load_stateless_token(token):
+    """校验签名后与数据库中的令牌版本比对；用户被删除或版本已递增即失效，角色等资料以快照为准"""
+    try:
+        payload = _token_serializer().loads(token[len(STATELESS_PREFIX):],
+                                            max_age=SESSION_DAYS * 86400)
+    except (BadSignature, SignatureExpired):
+        return None
+    if not isinstance(payload, dict) or not payload.get('id'):
+        return None
+    version = _current_token_version(payload['id'])
+    if version is None or payload.get('tv') != version:
+        return None
+    user = _app.load_user_snapshot(payload['id'])
+    if user and (user.get('token_version') or 0) != version:
+        # 本进程的快照早于版本变更（如其他进程改了角色），丢弃后重新加载
+        _app.invalidate_user_snapshot(payload['id'])
+        user = _app.load_user_snapshot(payload['id'])
+    if not user:
+        return None
+    return _principal(user)
+
+
+def revoke_miniapp_tokens(user_id):
+    """递增用户的令牌版本，使其已签发的无状态令牌全部失效（改角色、删除用户、改密码、登出时调用）"""
+    conn = _app.get_db()
+    conn.execute("UPDATE users SET token_version = COALESCE(token_version, 0) + 1 WHERE id = ?", (user_id,))
+    conn.commit()
+    invalidate_miniapp_sessions(user_id=user_id)
+    _app.invalidate_user_snapshot(user_id)
+
+
 def _get_user_by_token(token):
     if not token:
         return None
+    if token.startswith(STATELESS_PREFIX):
+        return _load_stateless_token(token)
+
+    user = _cached_session(token)
+    if user:
+        return user
+
     conn = _app.get_db()
     try:
-        sess = conn.execute(
-            "SELECT * FROM miniapp_sessions WHERE token = ? AND expires_at > datetime('now')",
+        row = conn.execute(
+            """SELECT u.*, s.expires_at AS session_expires_at
+               FROM miniapp_sessions s JOIN users u ON u.id = s.user_id
+               WHERE s.token = ? AND s.expires_at > datetime('now')""",
             (token,)
         ).fetchone()
-        if not sess:
+        if not row:
             return None
-        user = conn.execute("SELECT * FROM users WHERE id = ?", (sess['user_id'],)).fetchone()
-        if user:
-            return dict(user)
-        return None
+        user = dict(row)
+        try:
+            expires_at = datetime.strptime(user['session_expires_at'], '%Y-%m-%d %H:%M:%S').timestamp()
+        except (TypeError, ValueError):
+            expires_at = time.time() + SESSION_CACHE_TTL
+        _cache_session(token, user, expires_at)
+        return _principal(user)
     finally:
         conn.close()
 
@@ -69,9 +202,11 @@ def miniapp_login_required(f):
     return decorated
 
 
-def _create_session(conn, user_id):
+def _create_session(conn, user_id, user=None):
+    if STATELESS_TOKENS and user is not None:
+        return _issue_stateless_token(user)
     token = str(uuid.uuid4())
-    expires_at = (datetime.now() + timedelta(days=30)).strftime('%Y-%m-%d %H:%M:%S')
+    expires_at = (datetime.now() + timedelta(days=SESSION_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
     conn.execute(
         "INSERT INTO miniapp_sessions (token, user_id, expires_at, created_at) VALUES (?, ?, ?, datetime('now'))",
         (token, user_id, expires_at)
@@ -81,6 +216,9 @@ def _create_session(conn, user_id):
 
 
 def _ensure_tables(conn):
+    global _tables_ready
+    if _tables_ready:
+        return
     conn.execute('''CREATE TABLE IF NOT EXISTS miniapp_sessions (
         id TEXT PRIMARY KEY,
         token TEXT UNIQUE NOT NULL,
@@ -106,6 +244,7 @@ def _ensure_tables(conn):
     except Exception:
         pass
     conn.commit()
+    _tables_ready = True
 
 
 @miniapp_bp.route('/miniapp/api/auth/wx-login', methods=['POST'])
@@ -142,7 +281,7 @@ def wx_login():
         if user:
             user = dict(user)
             conn.execute("DELETE FROM miniapp_sessions WHERE user_id = ? AND expires_at < datetime('now')", (user['id'],))
-            token = _create_session(conn, user['id'])
+            token = _create_session(conn, user['id'], user)
             return jsonify(success=True, data={
                 'token': token,
                 'user': {
@@ -161,7 +300,8 @@ def wx_login():
                 (user_id, username, openid, unionid)
             )
             conn.commit()
-            token = _create_session(conn, user_id)
+            token = _create_session(conn, user_id, {'id': user_id, 'username': username,
+                                                    'email': '', 'role': 'user'})
             return jsonify(success=True, data={
                 'token': token,
                 'user': {
@@ -200,7 +340,7 @@ def account_login():
             return jsonify(success=False, message='邮箱或密码错误')
 
         conn.execute("DELETE FROM miniapp_sessions WHERE user_id = ? AND expires_at < datetime('now')", (user['id'],))
-        token = _create_session(conn, user['id'])
+        token = _create_session(conn, user['id'], user)
 
         return jsonify(success=True, data={
             'token': token,
@@ -259,6 +399,8 @@ def update_profile():
             params.append(user['id'])
             conn.execute(f"UPDATE users SET {', '.join(updates)} WHERE id = ?", params)
             conn.commit()
+            invalidate_miniapp_sessions(user_id=user['id'])
+            _app.invalidate_user_snapshot(user['id'])
 
         return jsonify(success=True, message='更新成功')
     except Exception as e:
@@ -268,7 +410,7 @@ def update_profile():
         conn.close()
 
 
-@miniapp_bp.route('/miniapp/api/auth/change-password', methods=['POST'])
+@miniapp_bp.route('/miniapp/api/auth/change-password', methods=['POST'], endpoint='miniapp_change_password')
 @miniapp_login_required
 def change_password():
     user = request.miniapp_user
@@ -283,21 +425,29 @@ def change_password():
 
     conn = _app.get_db()
     try:
-        if not user.get('password') or not check_password_hash(user['password'], old_password):
+        row = conn.execute("SELECT password FROM users WHERE id = ?", (user['id'],)).fetchone()
+        if not row or not row['password'] or not check_password_hash(row['password'], old_password):
             return jsonify(success=False, message='旧密码不正确')
 
         new_hash = generate_password_hash(new_password)
         conn.execute("UPDATE users SET password = ? WHERE id = ?", (new_hash, user['id']))
         conn.commit()
+        revoke_miniapp_tokens(user['id'])
         return jsonify(success=True, message='密码修改成功')
     finally:
         conn.close()
 
 
-@miniapp_bp.route('/miniapp/api/auth/logout', methods=['POST'])
+@miniapp_bp.route('/miniapp/api/auth/logout', methods=['POST'], endpoint='miniapp_logout')
 @miniapp_login_required
 def logout():
     token = _get_token_from_request()
+    if token.startswith(STATELESS_PREFIX):
+        # 无状态令牌无法单独吊销，递增版本使该用户的无状态令牌全部失效；
+        # 版本存于数据库，其他进程最迟在 SESSION_CACHE_TTL 秒后拒绝旧令牌
+        revoke_miniapp_tokens(request.miniapp_user['id'])
+        return jsonify(success=True, message='已退出登录')
+    invalidate_miniapp_sessions(token=token)
     conn = _app.get_db()
     try:
         conn.execute("DELETE FROM miniapp_sessions WHERE token = ?", (token,))
@@ -323,13 +473,15 @@ def get_files():
             (user['id'], per_page, offset)
         ).fetchall()
 
+        liked_ids, favorited_ids = _app.get_user_interactions([row['id'] for row in rows], user['id'])
+
         files = []
         for row in rows:
             f = dict(row)
-            f['like_count'] = _app.get_like_count(f['id'])
-            f['favorite_count'] = _app.get_favorite_count(f['id'])
-            f['is_liked'] = _app.is_liked(f['id'], user['id'])
-            f['is_favorited'] = _app.is_favorited(f['id'], user['id'])
+            f['like_count'] = f.get('like_count') or 0
+            f['favorite_count'] = f.get('favorite_count') or 0
+            f['is_liked'] = f['id'] in liked_ids
+            f['is_favorited'] = f['id'] in favorited_ids
             files.append(f)
 
         return jsonify(success=True, data={'files': files})
@@ -348,8 +500,8 @@ def get_file_detail(file_id):
             return jsonify(success=False, message='文件不存在'), 404
 
         f = dict(file)
-        f['like_count'] = _app.get_like_count(f['id'])
-        f['favorite_count'] = _app.get_favorite_count(f['id'])
+        f['like_count'] = f.get('like_count') or 0
+        f['favorite_count'] = f.get('favorite_count') or 0
         f['is_liked'] = _app.is_liked(f['id'], user['id'])
         f['is_favorited'] = _app.is_favorited(f['id'], user['id'])
 
@@ -444,13 +596,15 @@ def search_files():
             (user['id'], f'%{keyword}%')
         ).fetchall()
 
+        liked_ids, favorited_ids = _app.get_user_interactions([row['id'] for row in rows], user['id'])
+
         files = []
         for row in rows:
             f = dict(row)
-            f['like_count'] = _app.get_like_count(f['id'])
-            f['favorite_count'] = _app.get_favorite_count(f['id'])
-            f['is_liked'] = _app.is_liked(f['id'], user['id'])
-            f['is_favorited'] = _app.is_favorited(f['id'], user['id'])
+            f['like_count'] = f.get('like_count') or 0
+            f['favorite_count'] = f.get('favorite_count') or 0
+            f['is_liked'] = f['id'] in liked_ids
+            f['is_favorited'] = f['id'] in favorited_ids
             files.append(f)
 
         return jsonify(success=True, data={'files': files})
@@ -683,16 +837,13 @@ def get_workspaces():
     conn = _app.get_db()
     try:
         owned = conn.execute(
-            """SELECT w.*, (SELECT COUNT(*) FROM workspace_members WHERE workspace_id = w.id) as member_count,
-                      (SELECT COUNT(*) FROM workspace_files WHERE workspace_id = w.id) as file_count
+            """SELECT w.*
                FROM workspaces w WHERE w.owner_id = ? ORDER BY w.updated_at DESC""",
             (user['id'],)
         ).fetchall()
 
         joined = conn.execute(
-            """SELECT w.*, wm.role as member_role,
-                      (SELECT COUNT(*) FROM workspace_members WHERE workspace_id = w.id) as member_count,
-                      (SELECT COUNT(*) FROM workspace_files WHERE workspace_id = w.id) as file_count
+            """SELECT w.*, wm.role as member_role
                FROM workspaces w JOIN workspace_members wm ON w.id = wm.workspace_id
                WHERE wm.user_id = ? ORDER BY w.updated_at DESC""",
             (user['id'],)
@@ -730,6 +881,7 @@ def create_workspace():
             (member_id, ws_id, user['id'])
         )
         conn.commit()
+        _app.invalidate_workspace_roles(ws_id)
         return jsonify(success=True, message='创建成功', data={'id': ws_id, 'name': name})
     except Exception as e:
         conn.rollback()
@@ -748,9 +900,6 @@ def get_workspace_detail(workspace_id):
         if not ws:
             return jsonify(success=False, message='空间不存在'), 404
 
-        member_count = conn.execute("SELECT COUNT(*) as cnt FROM workspace_members WHERE workspace_id = ?", (workspace_id,)).fetchone()['cnt']
-        file_count = conn.execute("SELECT COUNT(*) as cnt FROM workspace_files WHERE workspace_id = ?", (workspace_id,)).fetchone()['cnt']
-
         files = conn.execute(
             """SELECT f.* FROM files f JOIN workspace_files wf ON f.id = wf.file_id
                WHERE wf.workspace_id = ? AND f.is_deleted = 0""",
@@ -758,7 +907,7 @@ def get_workspace_detail(workspace_id):
         ).fetchall()
 
         return jsonify(success=True, data={
-            'workspace': {**dict(ws), 'member_count': member_count, 'file_count': file_count},
+            'workspace': dict(ws),
             'files': [dict(f) for f in files]
         })
     finally:
@@ -798,11 +947,8 @@ def invite_member(workspace_id):
         if not ws:
             return jsonify(success=False, message='空间不存在'), 404
 
-        if ws['owner_id'] != user['id']:
-            caller = conn.execute("SELECT role FROM workspace_members WHERE workspace_id = ? AND user_id = ?",
-                                 (workspace_id, user['id'])).fetchone()
-            if not caller or caller['role'] not in ('owner', 'admin'):
-                return jsonify(success=False, message='权限不足'), 403
+        if _app.get_workspace_role(workspace_id, user['id']) not in ('owner', 'admin'):
+            return jsonify(success=False, message='权限不足'), 403
 
         target = conn.execute("SELECT * FROM users WHERE email = ?", (email,)).fetchone()
         if not target:
@@ -819,6 +965,7 @@ def invite_member(workspace_id):
             (member_id, workspace_id, target['id'], role)
         )
         conn.commit()
+        _app.invalidate_workspace_roles(workspace_id)
         return jsonify(success=True, message='邀请成功')
     except Exception as e:
         conn.rollback()
@@ -845,6 +992,7 @@ def remove_member(workspace_id, user_id):
 
         conn.execute("DELETE FROM workspace_members WHERE workspace_id = ? AND user_id = ?", (workspace_id, user_id))
         conn.commit()
+        _app.invalidate_workspace_roles(workspace_id)
         return jsonify(success=True, message='已移除')
     finally:
         conn.close()
@@ -862,22 +1010,13 @@ def ai_chat():
         return jsonify(success=False, message='请输入消息')
 
     try:
-        result = _app.deepseek_chat([{"role": "user", "content": message}], model=model)
-        response_text = result.get('choices', [{}])[0].get('message', {}).get('content', str(result))
-
-        conn = _app.get_db()
-        try:
-            content_id = str(uuid.uuid4())
-            conn.execute(
-                """INSERT INTO ai_contents (id, user_id, ai_function, prompt, response, created_at)
-                   VALUES (?, ?, 'chat', ?, ?, CURRENT_TIMESTAMP)""",
-                (content_id, user['id'], message, response_text)
-            )
-            conn.commit()
-        finally:
-            conn.close()
+        _app.release_db()
+        job_id = _app.create_ai_job(user['id'], 'chat', message, model=model)
+        job = _app.run_ai_job(job_id, [{"role": "user", "content": message}])
+        if job['status'] != 'done':
+            raise Exception(job['error'] or 'AI任务失败')
 
-        return jsonify(success=True, data={'response': response_text, 'id': content_id})
+        return jsonify(success=True, data={'response': job['response'], 'id': job['content_id']})
     except Exception as e:
         return jsonify(success=False, message=f'AI对话失败: {str(e)}')
 
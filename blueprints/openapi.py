@@ -1,5 +1,5 @@
 from flask import Blueprint, request, render_template, redirect, url_for, jsonify, session, send_from_directory
-import os, json, sqlite3, shutil, base64, uuid, hashlib, time
+import os, json, sqlite3, shutil, base64, uuid, hashlib, time, threading
 from datetime import datetime, timedelta
 from pathlib import Path
 import jwt
@@ -9,10 +9,11 @@ from werkzeug.security import check_password_hash
 class _LazyAppImports:
     def __getattr__(self, name):
         from app import (app as _flask_app, get_db, log_message,
-                        page_error_response, api_response)
+                        page_error_response, api_response, DB_FILE)
         _mapping = {
             'app': _flask_app,
             'get_db': get_db,
+            'DB_FILE': DB_FILE,
             'log_message': log_message,
             'page_error_response': page_error_response,
             'api_response': api_response,
@@ -28,6 +29,18 @@ JWT_SECRET = None
 JWT_ACCESS_EXPIRY = timedelta(hours=1)
 JWT_REFRESH_EXPIRY = timedelta(days=30)
 
+# 已验证主体缓存：令牌/密钥摘要 -> 主体信息，TTL 内免解码、免查库
+PRINCIPAL_CACHE_TTL = int(os.getenv('OPENAPI_PRINCIPAL_CACHE_TTL', '60'))
+PRINCIPAL_CACHE_MAX = int(os.getenv('OPENAPI_PRINCIPAL_CACHE_MAX', '10000'))
+# last_used_at 合并写入间隔（秒）
+KEY_USAGE_FLUSH_INTERVAL = int(os.getenv('OPENAPI_KEY_USAGE_FLUSH_INTERVAL', '30'))
+
+_principal_cache = {}
+_principal_lock = threading.Lock()
+_pending_key_usage = {}
+_key_usage_lock = threading.Lock()
+_key_usage_thread = None
+
 
 def _get_jwt_secret():
     global JWT_SECRET
@@ -74,12 +87,103 @@ def _decode_token(token):
         return None
 
 
+def _cache_digest(kind, credential):
+    return hashlib.sha256(f'{kind}:{credential}'.encode('utf-8')).hexdigest()
+
+
+def _get_cached_principal(digest):
+    with _principal_lock:
+        entry = _principal_cache.get(digest)
+        if entry is None:
+            return None
+        if entry['expires'] <= time.time():
+            _principal_cache.pop(digest, None)
+            return None
+        return entry
+
+
+def _cache_principal(digest, principal, ttl, key_id=None, key_expires=None):
+    if ttl <= 0:
+        return
+    with _principal_lock:
+        if len(_principal_cache) >= PRINCIPAL_CACHE_MAX:
+            now = time.time()
+            for stale in [d for d, e in _principal_cache.items() if e['expires'] <= now]:
+                del _principal_cache[stale]
+            if len(_principal_cache) >= PRINCIPAL_CACHE_MAX:
+                _principal_cache.pop(next(iter(_principal_cache)))
+        _principal_cache[digest] = {
+            'principal': principal,
+            'expires': time.time() + ttl,
+            'key_id': key_id,
+            'key_expires': key_expires,
+        }
+
+
+def invalidate_api_principals(user_id=None, key_id=None):
+    """撤销钩子：密钥吊销、角色变更或删除用户后清除对应的缓存主体"""
+    with _principal_lock:
+        if user_id is None and key_id is None:
+            _principal_cache.clear()
+            return
+        for digest in [d for d, e in _principal_cache.items()
+                       if (key_id is not None and e['key_id'] == key_id)
+                       or (user_id is not None and e['principal']['id'] == user_id)]:
+            del _principal_cache[digest]
+
+
+def _note_key_usage(key_id):
+    """记录密钥使用时间，由后台线程定期合并写入 last_used_at"""
+    global _key_usage_thread
+    with _key_usage_lock:
+        _pending_key_usage[key_id] = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        if _key_usage_thread is None or not _key_usage_thread.is_alive():
+            _key_usage_thread = threading.Thread(target=_key_usage_loop,
+                                                 name='api-key-usage-flusher', daemon=True)
+            _key_usage_thread.start()
+
+
+def flush_key_usage():
+    """把累积的 last_used_at 一次性写入数据库"""
+    with _key_usage_lock:
+        if not _pending_key_usage:
+            return 0
+        pending = list(_pending_key_usage.items())
+        _pending_key_usage.clear()
+    try:
+        conn = sqlite3.connect(str(_app.DB_FILE), timeout=30)
+        try:
+            conn.executemany('UPDATE api_keys SET last_used_at = ? WHERE id = ?',
+                             [(used_at, key_id) for key_id, used_at in pending])
+            conn.commit()
+        finally:
+            conn.close()
+    except Exception as e:
+        print(f'[OpenAPI] 写入密钥使用时间失败: {e}')
+        with _key_usage_lock:
+            for key_id, used_at in pending:
+                _pending_key_usage.setdefault(key_id, used_at)
+        return 0
+    return len(pending)
+
+
+def _key_usage_loop():
+    while True:
+        time.sleep(KEY_USAGE_FLUSH_INTERVAL)
+        flush_key_usage()
+
+
 def _require_api_auth(f):
     @wraps(f)
     def decorated(*args, **kwargs):
         auth_header = request.headers.get('Authorization', '')
         if auth_header.startswith('Bearer '):
             token = auth_header[7:]
+            digest = _cache_digest('jwt', token)
+            cached = _get_cached_principal(digest)
+            if cached:
+                request.api_user = dict(cached['principal'])
+                return f(*args, **kwargs)
             payload = _decode_token(token)
             if payload and payload.get('type') == 'access':
                 request.api_user = {
@@ -89,12 +193,24 @@ def _require_api_auth(f):
                     'role': payload.get('role', 'user'),
                     'auth_type': 'jwt',
                 }
+                # 缓存不超过令牌自身的过期时间
+                ttl = min(PRINCIPAL_CACHE_TTL, int(payload.get('exp', 0) - time.time()))
+                _cache_principal(digest, dict(request.api_user), ttl)
                 return f(*args, **kwargs)
             return jsonify({'error': '令牌无效或已过期', 'code': 401}), 401
 
         api_key = request.headers.get('X-API-Key', '')
         if api_key:
             key_hash = hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+            digest = _cache_digest('key', key_hash)
+            cached = _get_cached_principal(digest)
+            if cached:
+                if cached['key_expires'] and datetime.now() > cached['key_expires']:
+                    invalidate_api_principals(key_id=cached['key_id'])
+                    return jsonify({'error': 'API密钥已过期', 'code': 401}), 401
+                _note_key_usage(cached['key_id'])
+                request.api_user = dict(cached['principal'])
+                return f(*args, **kwargs)
             key_prefix = api_key[:8]
             conn = _app.get_db()
             try:
@@ -103,6 +219,7 @@ def _require_api_auth(f):
                     (key_hash, key_prefix)
                 ).fetchone()
                 if row:
+                    expires = None
                     if row['expires_at']:
                         try:
                             expires = datetime.strptime(row['expires_at'], '%Y-%m-%d %H:%M:%S')
@@ -112,11 +229,7 @@ def _require_api_auth(f):
                             pass
                     user = conn.execute('SELECT * FROM users WHERE id = ?', (row['user_id'],)).fetchone()
                     if user:
-                        conn.execute(
-                            'UPDATE api_keys SET last_used_at = CURRENT_TIMESTAMP WHERE id = ?',
-                            (row['id'],)
-                        )
-                        conn.commit()
+                        _note_key_usage(row['id'])
                         request.api_user = {
                             'id': user['id'],
                             'email': user['email'],
@@ -125,6 +238,8 @@ def _require_api_auth(f):
                             'auth_type': 'api_key',
                             'permissions': row['permissions'],
                         }
+                        _cache_principal(digest, dict(request.api_user), PRINCIPAL_CACHE_TTL,
+                                         key_id=row['id'], key_expires=expires)
                         return f(*args, **kwargs)
             finally:
                 conn.close()
@@ -227,6 +342,7 @@ def api_v1_list_keys():
     if 'user_id' not in session:
         return jsonify({'error': '请先登录', 'code': 401}), 401
 
+    flush_key_usage()
     conn = _app.get_db()
     try:
         rows = conn.execute(
@@ -318,6 +434,7 @@ def api_v1_delete_key(key_id):
 
         conn.execute('UPDATE api_keys SET is_active = 0 WHERE id = ?', (key_id,))
         conn.commit()
+        invalidate_api_principals(key_id=key_id)
 
         _app.log_message(
             log_type='security',
@@ -20,9 +20,10 @@ def login_required(f):
 
 class _LazyAppImports:
     def __getattr__(self, name):
-        from app import get_db, log_message, api_response, get_user_storage_usage
+        from app import get_db, log_message, api_response, get_user_storage_usage, invalidate_user_snapshot
         _mapping = {
             'get_db': get_db,
+            'invalidate_user_snapshot': invalidate_user_snapshot,
             'log_message': log_message,
             'api_response': api_response,
             'get_user_storage_usage': get_user_storage_usage,
@@ -91,6 +92,7 @@ def api_encrypt_user_emails():
             conn.execute("UPDATE users SET email = ? WHERE id = ?", (encrypted, user["id"]))
             count += 1
     conn.commit()
+    _app.invalidate_user_snapshot()
     _app.log_message(log_type='security', log_level='INFO',
                message=f'批量加密用户邮箱: {count} 条',
                action='batch_encrypt_emails', request=request)
@@ -109,6 +111,7 @@ def api_decrypt_user_emails():
             conn.execute("UPDATE users SET email = ? WHERE id = ?", (decrypted, user["id"]))
             count += 1
     conn.commit()
+    _app.invalidate_user_snapshot()
     return jsonify({"success": True, "decrypted_count": count})
 
 
@@ -371,6 +374,7 @@ def verify_2fa():
         conn.execute("UPDATE user_2fa SET verified = 1 WHERE id = ?", (two_fa['id'],))
         conn.execute("UPDATE users SET two_factor_enabled = 1 WHERE id = ?", (session['user_id'],))
         conn.commit()
+        _app.invalidate_user_snapshot(session['user_id'])
 
         _app.log_message(log_type='security', log_level='INFO',
                    message='用户完成两步验证设置', user_id=session['user_id'],
@@ -400,6 +404,7 @@ def disable_2fa():
         conn.execute("DELETE FROM user_2fa WHERE user_id = ?", (session['user_id'],))
         conn.execute("UPDATE users SET two_factor_enabled = 0 WHERE id = ?", (session['user_id'],))
         conn.commit()
+        _app.invalidate_user_snapshot(session['user_id'])
 
         _app.log_message(log_type='security', log_level='WARNING',
                    message='用户禁用两步验证', user_id=session['user_id'],
@@ -13,8 +13,10 @@ class _LazyAppImports:
     def __getattr__(self, name):
         from app import (app as _flask_app, get_db, get_all_files, log_message,
                         page_error_response, api_response, dkfile_info,
-                        get_database_stats, optimize_database,
-                        archive_old_logs, get_cache, preview_cache,
+                        get_database_stats, optimize_database, maintenance_scheduler,
+                        archive_old_logs, reconcile_engagement_counters,
+                        reconcile_workspace_counters,
+                        get_cache, preview_cache, get_ai_cache_stats,
                         hot_data_cache, get_user_storage_usage)
         _mapping = {
             'app': _flask_app,
@@ -26,8 +28,12 @@ class _LazyAppImports:
             'dkfile_info': dkfile_info,
             'get_database_stats': get_database_stats,
             'optimize_database': optimize_database,
+            'maintenance_scheduler': maintenance_scheduler,
             'archive_old_logs': archive_old_logs,
+            'reconcile_engagement_counters': reconcile_engagement_counters,
+            'reconcile_workspace_counters': reconcile_workspace_counters,
             'get_cache': get_cache,
+            'get_ai_cache_stats': get_ai_cache_stats,
             'preview_cache': preview_cache,
             'hot_data_cache': hot_data_cache,
             'get_user_storage_usage': get_user_storage_usage,
@@ -102,18 +108,48 @@ def api_db_optimize():
     if 'user_id' not in session or session.get('role') != 'admin':
         return _app.api_response(success=False, message='权限不足', code=403)
 
+    jobs = (request.get_json(silent=True) or {}).get('jobs')
+
     try:
-        result = _app.optimize_database()
+        result = _app.optimize_database(jobs=jobs)
 
         _app.log_message(log_type='operation', log_level='INFO',
-                   message='管理员执行数据库优化',
+                   message=f'管理员提交数据库优化任务: {", ".join(result["queued"])}',
                    user_id=session['user_id'], action='db_optimize', request=request)
 
-        return _app.api_response(success=True, data=result, message='数据库优化完成')
+        return _app.api_response(success=True, data=result, message='数据库优化任务已提交后台执行')
     except Exception as e:
         return _app.api_response(success=False, message=f'优化失败: {str(e)}')
 
 
+@system_bp.route('/api/db/maintenance', methods=['GET'], endpoint='api_db_maintenance')
+def api_db_maintenance():
+    if 'user_id' not in session or session.get('role') != 'admin':
+        return _app.api_response(success=False, message='权限不足', code=403)
+
+    return _app.api_response(success=True, data=_app.maintenance_scheduler.get_status())
+
+
+@system_bp.route('/api/db/auto-vacuum/convert', methods=['POST'], endpoint='api_db_convert_auto_vacuum')
+def api_db_convert_auto_vacuum():
+    if 'user_id' not in session or session.get('role') != 'admin':
+        return _app.api_response(success=False, message='权限不足', code=403)
+
+    if not (request.get_json(silent=True) or {}).get('confirm'):
+        db_path = _app.maintenance_scheduler.db_path
+        db_size_mb = round(os.path.getsize(db_path) / (1024 * 1024), 2) if os.path.exists(db_path) else 0
+        return _app.api_response(
+            success=False, data={'db_size_mb': db_size_mb},
+            message=f'转换需要对 {db_size_mb}MB 的数据库执行完整 VACUUM，期间所有写入都会阻塞，确认后请带 confirm=true 重新提交')
+
+    result = _app.maintenance_scheduler.request_auto_vacuum_conversion()
+    if result['success']:
+        _app.log_message(log_type='operation', log_level='WARNING',
+                   message=f'管理员确认 auto_vacuum 转换 ({result["db_size_mb"]}MB)',
+                   user_id=session['user_id'], action='db_convert_auto_vacuum', request=request)
+    return _app.api_response(success=result['success'], data=result, message=result['message'])
+
+
 @system_bp.route('/api/db/archive', methods=['POST'], endpoint='api_db_archive')
 def api_db_archive():
     if 'user_id' not in session or session.get('role') != 'admin':
@@ -133,6 +169,24 @@ def api_db_archive():
         return _app.api_response(success=False, message=f'归档失败: {str(e)}')
 
 
+@system_bp.route('/api/db/reconcile-counters', methods=['POST'], endpoint='api_db_reconcile_counters')
+def api_db_reconcile_counters():
+    if 'user_id' not in session or session.get('role') != 'admin':
+        return _app.api_response(success=False, message='权限不足', code=403)
+
+    try:
+        result = _app.reconcile_engagement_counters()
+        result['workspaces'] = _app.reconcile_workspace_counters()
+
+        _app.log_message(log_type='operation', log_level='INFO',
+                   message='管理员执行点赞/收藏计数校正',
+                   user_id=session['user_id'], action='db_reconcile_counters', request=request)
+
+        return _app.api_response(success=True, data=result, message='计数校正完成')
+    except Exception as e:
+        return _app.api_response(success=False, message=f'校正失败: {str(e)}')
+
+
 @system_bp.route('/api/cache/stats', methods=['GET'], endpoint='api_cache_stats')
 def api_cache_stats():
     cache = _app.get_cache()
@@ -147,7 +201,8 @@ def api_cache_stats():
     return _app.api_response(success=True, data={
         'main_cache': stats,
         'preview_cache': preview_stats,
-        'hot_data_cache': hot_stats
+        'hot_data_cache': hot_stats,
+        'ai_response_cache': _app.get_ai_cache_stats()
     })
 
 
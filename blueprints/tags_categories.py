@@ -39,6 +39,8 @@ def api_search():
             file_rows = conn.execute('''
                 SELECT f.id, f.filename, f.stored_name, f.size, f.project_name,
                        f.project_desc, f.user_id, f.created_at, f.folder_id,
+                       COALESCE(f.like_count, 0) as like_count,
+                       COALESCE(f.favorite_count, 0) as favorite_count,
                        u.username
                 FROM files f LEFT JOIN users u ON f.user_id = u.id
                 WHERE (f.filename LIKE ? OR f.project_name LIKE ? OR f.project_desc LIKE ?)
@@ -48,8 +50,6 @@ def api_search():
 
             for r in file_rows:
                 fd = dict(r)
-                fd['like_count'] = _app.get_like_count(fd['id'])
-                fd['favorite_count'] = _app.get_favorite_count(fd['id'])
                 tag_rows = conn.execute(
                     '''SELECT t.name FROM tags t JOIN file_tags ft ON t.id = ft.tag_id
                        WHERE ft.file_id = ?''', (fd['id'],)).fetchall()
@@ -685,8 +685,8 @@ def api_files_by_tag(tag_id):
         files = []
         for row in rows:
             f = dict(row)
-            f['like_count'] = _app.get_like_count(f['id'])
-            f['favorite_count'] = _app.get_favorite_count(f['id'])
+            f['like_count'] = f.get('like_count') or 0
+            f['favorite_count'] = f.get('favorite_count') or 0
             file_tags = conn.execute(
                 """SELECT t.id, t.name FROM tags t JOIN file_tags ft ON t.id = ft.tag_id
                    WHERE ft.file_id = ?""", (f['id'],)).fetchall()
@@ -719,8 +719,8 @@ def api_analytics_dashboard():
 
         file_count = conn.execute('SELECT COUNT(*) FROM files WHERE user_id = ? AND is_deleted IS NULL', (uid,)).fetchone()[0]
         total_size = conn.execute('SELECT COALESCE(SUM(size),0) FROM files WHERE user_id = ? AND is_deleted IS NULL', (uid,)).fetchone()[0]
-        total_likes = conn.execute('SELECT COUNT(*) FROM likes WHERE file_id IN (SELECT id FROM files WHERE user_id = ?)', (uid,)).fetchone()[0]
-        total_favorites = conn.execute('SELECT COUNT(*) FROM favorites WHERE file_id IN (SELECT id FROM files WHERE user_id = ?)', (uid,)).fetchone()[0]
+        total_likes = conn.execute('SELECT COALESCE(SUM(like_count),0) FROM files WHERE user_id = ?', (uid,)).fetchone()[0]
+        total_favorites = conn.execute('SELECT COALESCE(SUM(favorite_count),0) FROM files WHERE user_id = ?', (uid,)).fetchone()[0]
         total_views = conn.execute("SELECT COALESCE(SUM(view_count),0) FROM files WHERE user_id = ?", (uid,)).fetchone()[0]
 
         upload_trend = []
@@ -776,11 +776,11 @@ def api_analytics_dashboard():
 
         hot_files_rows = conn.execute('''
             SELECT f.id, f.filename, f.size, f.created_at,
-                   (SELECT COUNT(*) FROM likes WHERE file_id = f.id) as like_count,
-                   (SELECT COUNT(*) FROM favorites WHERE file_id = f.id) as fav_count,
+                   COALESCE(f.like_count, 0) as like_count,
+                   COALESCE(f.favorite_count, 0) as fav_count,
                    COALESCE(f.view_count, 0) as view_count
             FROM files f WHERE f.user_id = ? AND f.is_deleted IS NULL
-            ORDER BY (COALESCE(f.view_count,0) + (SELECT COUNT(*) FROM likes WHERE file_id = f.id)*5 + (SELECT COUNT(*) FROM favorites WHERE file_id = f.id)*3) DESC
+            ORDER BY (COALESCE(f.view_count,0) + COALESCE(f.like_count,0)*5 + COALESCE(f.favorite_count,0)*3) DESC
             LIMIT 10
         ''', (uid,)).fetchall()
         hot_files = [{'id': r['id'], 'filename': r['filename'], 'size': r['size'],
@@ -1,13 +1,13 @@
 from flask import Blueprint, request, render_template, redirect, url_for, flash, jsonify, session
-import os
 import json
 import uuid
-from datetime import datetime, timezone, timedelta
+from datetime import datetime
 
 
 class _LazyAppImports:
     def __getattr__(self, name):
-        from app import app as _flask_app, get_db, log_message, page_error_response, api_response, get_user_storage_usage
+        from app import (app as _flask_app, get_db, log_message, page_error_response, api_response,
+                         get_user_storage_usage, restore_trash_items, purge_trash_items, TRASH_LIST_COLUMNS)
         _mapping = {
             'app': _flask_app,
             'get_db': get_db,
@@ -15,6 +15,9 @@ class _LazyAppImports:
             'page_error_response': page_error_response,
             'api_response': api_response,
             'get_user_storage_usage': get_user_storage_usage,
+            'restore_trash_items': restore_trash_items,
+            'purge_trash_items': purge_trash_items,
+            'TRASH_LIST_COLUMNS': TRASH_LIST_COLUMNS,
         }
         if name not in _mapping:
             raise AttributeError(f"module 'app' has no attribute '{name}'")
@@ -26,6 +29,22 @@ _app = _LazyAppImports()
 trash_bp = Blueprint('trash', __name__)
 
 
+def _serialize_item(row):
+    item = dict(row)
+    item['original_data'] = {
+        'filename': row['filename'],
+        'stored_name': row['stored_name'],
+        'file_path': row['file_path'],
+        'file_size': row['file_size'],
+        'file_type': row['file_type'],
+    }
+    item['display_name'] = row['filename'] or '未知'
+    if 'deleted_at_display' in item:
+        item['deleted_at'] = item.pop('deleted_at_display')
+        item['is_expired'] = bool(item['is_expired'])
+    return item
+
+
 @trash_bp.route('/trash', endpoint='trash')
 def trash():
     if 'user_id' not in session:
@@ -33,50 +52,11 @@ def trash():
 
     conn = _app.get_db()
     try:
-        trash_items = []
+        # 北京时间与剩余天数由SQL计算，这里只做结构组装
         rows = conn.execute(
-            "SELECT * FROM trash WHERE user_id = ? ORDER BY deleted_at DESC",
+            f"SELECT {_app.TRASH_LIST_COLUMNS} FROM trash WHERE user_id = ? ORDER BY deleted_at DESC",
             (session['user_id'],)).fetchall()
-
-        bj_tz = timezone(timedelta(hours=8))
-        for row in rows:
-            item = dict(row)
-            item['original_data'] = {
-                'filename': row['filename'],
-                'stored_name': row['stored_name'],
-                'file_path': row['file_path'],
-                'file_size': row['file_size'],
-                'file_type': row['file_type'],
-            }
-            item['display_name'] = row['filename'] or '未知'
-
-            # 将 deleted_at 转换为北京时间显示
-            if item.get('deleted_at'):
-                try:
-                    dt = datetime.fromisoformat(str(item['deleted_at']).replace('Z', '+00:00'))
-                    if dt.tzinfo is None:
-                        dt = dt.replace(tzinfo=timezone.utc)
-                    item['deleted_at'] = dt.astimezone(bj_tz).strftime('%Y-%m-%d %H:%M:%S')
-                except (ValueError, TypeError):
-                    pass
-
-            if item.get('expire_at'):
-                try:
-                    expire_dt = datetime.fromisoformat(row['expire_at'])
-                    if expire_dt.tzinfo is None:
-                        expire_dt = expire_dt.replace(tzinfo=timezone.utc)
-                    now_bj = datetime.now(bj_tz)
-                    remaining = expire_dt.astimezone(bj_tz) - now_bj
-                    item['days_remaining'] = max(0, remaining.days)
-                    item['is_expired'] = now_bj > expire_dt.astimezone(bj_tz)
-                except (ValueError, TypeError):
-                    item['days_remaining'] = 30
-                    item['is_expired'] = False
-            else:
-                item['days_remaining'] = 30
-                item['is_expired'] = False
-
-            trash_items.append(item)
+        trash_items = [_serialize_item(row) for row in rows]
 
         storage_usage = _app.get_user_storage_usage(session['user_id'])
 
@@ -112,18 +92,7 @@ def api_get_trash():
         rows = conn.execute("SELECT * FROM trash WHERE user_id = ? ORDER BY deleted_at DESC LIMIT ? OFFSET ?",
                            (session['user_id'], per_page, offset)).fetchall()
 
-        items = []
-        for r in rows:
-            item = dict(r)
-            item['original_data'] = {
-                'filename': r['filename'],
-                'stored_name': r['stored_name'],
-                'file_path': r['file_path'],
-                'file_size': r['file_size'],
-                'file_type': r['file_type'],
-            }
-            item['display_name'] = r['filename'] or '未知'
-            items.append(item)
+        items = [_serialize_item(r) for r in rows]
 
         return _app.api_response(success=True, data={
             'items': items,
@@ -154,21 +123,11 @@ def api_restore_from_trash(item_id):
         if not item['file_id']:
             return _app.api_response(success=False, message='无效的回收站数据')
 
-        existing = conn.execute("SELECT id FROM files WHERE id = ?", (item['file_id'],)).fetchone()
-        if existing:
-            conn.execute("DELETE FROM trash WHERE id = ?", (item_id,))
-            conn.commit()
-            return _app.api_response(success=True, message=f'{item["filename"] or "未知"} 已恢复')
-
         try:
-            conn.execute(
-                "INSERT OR IGNORE INTO files (id, user_id, filename, stored_name, file_path, file_size, file_type, folder_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                (item['file_id'], item['user_id'], item['filename'], item['stored_name'],
-                 item['file_path'], item['file_size'], item['file_type'], item['folder_id']))
+            _app.restore_trash_items(conn, session['user_id'], [item_id])
         except Exception as e:
+            conn.rollback()
             return _app.api_response(success=False, message=f'恢复失败: {str(e)}')
-
-        conn.execute("DELETE FROM trash WHERE id = ?", (item_id,))
         conn.commit()
 
         display_name = item['filename'] or '未知'
@@ -195,14 +154,7 @@ def api_delete_from_trash_permanent(item_id):
         if not item:
             return _app.api_response(success=False, message='回收站项不存在', code=404)
 
-        stored_name = item['stored_name'] or ''
-        if stored_name:
-            file_path = os.path.join(_app.app.config['UPLOAD_FOLDER'], stored_name)
-            if os.path.exists(file_path):
-                os.remove(file_path)
-
-        conn.execute("DELETE FROM trash WHERE id = ?", (item_id,))
-        conn.commit()
+        _app.purge_trash_items(conn, user_id=session['user_id'], trash_ids=[item_id])
 
         display_name = item['filename'] or '未知'
         _app.log_message(log_type='operation', log_level='WARNING',
@@ -220,26 +172,11 @@ def api_clear_expired_trash():
     if 'user_id' not in session or session.get('role') != 'admin':
         return _app.api_response(success=False, message='权限不足', code=403)
 
-    from datetime import datetime
     now_iso = datetime.now().isoformat()
 
     conn = _app.get_db()
     try:
-        expired_items = conn.execute(
-            "SELECT * FROM trash WHERE expire_at IS NOT NULL AND expire_at < ?", (now_iso,)).fetchall()
-
-        deleted_count = 0
-        for item in expired_items:
-            stored_name = item['stored_name'] or ''
-            if stored_name:
-                file_path = os.path.join(_app.app.config['UPLOAD_FOLDER'], stored_name)
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-
-            conn.execute("DELETE FROM trash WHERE id = ?", (item['id'],))
-            deleted_count += 1
-
-        conn.commit()
+        deleted_count = len(_app.purge_trash_items(conn, expired_before=now_iso))
 
         _app.log_message(log_type='operation', log_level='INFO',
                    message=f'清理过期回收站项: {deleted_count} 个',
@@ -258,21 +195,7 @@ def api_clear_all_trash():
 
     conn = _app.get_db()
     try:
-        items = conn.execute("SELECT * FROM trash WHERE user_id = ?",
-                            (session['user_id'],)).fetchall()
-
-        deleted_count = 0
-        for item in items:
-            stored_name = item['stored_name'] or ''
-            if stored_name:
-                file_path = os.path.join(_app.app.config['UPLOAD_FOLDER'], stored_name)
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-
-            conn.execute("DELETE FROM trash WHERE id = ?", (item['id'],))
-            deleted_count += 1
-
-        conn.commit()
+        deleted_count = len(_app.purge_trash_items(conn, user_id=session['user_id']))
 
         _app.log_message(log_type='operation', log_level='WARNING',
                    message=f'清空回收站: {deleted_count} 个项目',
@@ -301,15 +224,7 @@ def api_trash_restore():
         if not item:
             return _app.api_response(success=False, message='回收站项不存在', code=404)
 
-        if item['file_id']:
-            existing = conn.execute("SELECT id FROM files WHERE id = ?", (item['file_id'],)).fetchone()
-            if not existing:
-                conn.execute(
-                    "INSERT OR IGNORE INTO files (id, user_id, filename, stored_name, file_path, file_size, file_type, folder_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                    (item['file_id'], item['user_id'], item['filename'], item['stored_name'],
-                     item['file_path'], item['file_size'], item['file_type'], item['folder_id']))
-
-        conn.execute("DELETE FROM trash WHERE id = ?", (trash_id,))
+        _app.restore_trash_items(conn, session['user_id'], [trash_id])
         conn.commit()
 
         display_name = item['filename'] or '未知'
@@ -340,14 +255,7 @@ def api_trash_delete_permanent():
         if not item:
             return _app.api_response(success=False, message='回收站项不存在', code=404)
 
-        stored_name = item['stored_name'] or ''
-        if stored_name:
-            file_path = os.path.join(_app.app.config['UPLOAD_FOLDER'], stored_name)
-            if os.path.exists(file_path):
-                os.remove(file_path)
-
-        conn.execute("DELETE FROM trash WHERE id = ?", (trash_id,))
-        conn.commit()
+        _app.purge_trash_items(conn, user_id=session['user_id'], trash_ids=[trash_id])
 
         display_name = item['filename'] or '未知'
         return _app.api_response(success=True, message=f'{display_name} 已被永久删除')
@@ -367,21 +275,7 @@ def api_trash_batch_restore():
 
     conn = _app.get_db()
     try:
-        restored = 0
-        for tid in trash_ids:
-            item = conn.execute("SELECT * FROM trash WHERE id = ? AND user_id = ?",
-                               (tid, session['user_id'])).fetchone()
-            if not item:
-                continue
-            if item['file_id']:
-                existing = conn.execute("SELECT id FROM files WHERE id = ?", (item['file_id'],)).fetchone()
-                if not existing:
-                    conn.execute(
-                        "INSERT OR IGNORE INTO files (id, user_id, filename, stored_name, file_path, file_size, file_type, folder_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                        (item['file_id'], item['user_id'], item['filename'], item['stored_name'],
-                         item['file_path'], item['file_size'], item['file_type'], item['folder_id']))
-            conn.execute("DELETE FROM trash WHERE id = ?", (tid,))
-            restored += 1
+        restored = len(_app.restore_trash_items(conn, session['user_id'], trash_ids))
         conn.commit()
         return _app.api_response(success=True, message=f'已恢复 {restored} 个项目')
     finally:
@@ -400,20 +294,7 @@ def api_trash_batch_delete():
 
     conn = _app.get_db()
     try:
-        deleted = 0
-        for tid in trash_ids:
-            item = conn.execute("SELECT * FROM trash WHERE id = ? AND user_id = ?",
-                               (tid, session['user_id'])).fetchone()
-            if not item:
-                continue
-            stored_name = item['stored_name'] or ''
-            if stored_name:
-                file_path = os.path.join(_app.app.config['UPLOAD_FOLDER'], stored_name)
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-            conn.execute("DELETE FROM trash WHERE id = ?", (tid,))
-            deleted += 1
-        conn.commit()
+        deleted = len(_app.purge_trash_items(conn, user_id=session['user_id'], trash_ids=trash_ids))
         return _app.api_response(success=True, message=f'已永久删除 {deleted} 个项目')
     finally:
         conn.close()
@@ -426,18 +307,7 @@ def api_trash_empty():
 
     conn = _app.get_db()
     try:
-        items = conn.execute("SELECT * FROM trash WHERE user_id = ?",
-                            (session['user_id'],)).fetchall()
-        deleted_count = 0
-        for item in items:
-            stored_name = item['stored_name'] or ''
-            if stored_name:
-                file_path = os.path.join(_app.app.config['UPLOAD_FOLDER'], stored_name)
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-            conn.execute("DELETE FROM trash WHERE id = ?", (item['id'],))
-            deleted_count += 1
-        conn.commit()
+        deleted_count = len(_app.purge_trash_items(conn, user_id=session['user_id']))
         return _app.api_response(success=True, message=f'已清空回收站，删除 {deleted_count} 个项目')
     finally:
         conn.close()
@@ -8,10 +8,13 @@ logger = logging.getLogger(__name__)
 class _LazyAppImports:
     def __getattr__(self, name):
         from app import (app as _flask_app, get_db, log_message,
-                        page_error_response, api_response)
+                        page_error_response, api_response,
+                        get_workspace_role, invalidate_workspace_roles)
         _mapping = {
             'app': _flask_app,
             'get_db': get_db,
+            'get_workspace_role': get_workspace_role,
+            'invalidate_workspace_roles': invalidate_workspace_roles,
             'log_message': log_message,
             'page_error_response': page_error_response,
             'api_response': api_response,
@@ -25,21 +28,7 @@ workspace_bp = Blueprint('workspace', __name__)
 
 
 def _get_workspace_role(workspace_id, user_id):
-    conn = _app.get_db()
-    try:
-        ws = conn.execute("SELECT owner_id FROM workspaces WHERE id = ?", (workspace_id,)).fetchone()
-        if not ws:
-            return None
-        if ws['owner_id'] == user_id:
-            return 'owner'
-        member = conn.execute(
-            "SELECT role FROM workspace_members WHERE workspace_id = ? AND user_id = ?",
-            (workspace_id, user_id)).fetchone()
-        if member:
-            return member['role']
-        return None
-    finally:
-        conn.close()
+    return _app.get_workspace_role(workspace_id, user_id)
 
 
 def _check_permission(workspace_id, user_id, required_roles):
@@ -62,15 +51,12 @@ def workspaces_list():
     conn = _app.get_db()
     try:
         owned = conn.execute(
-            """SELECT w.*, (SELECT COUNT(*) FROM workspace_members WHERE workspace_id = w.id) as member_count,
-                      (SELECT COUNT(*) FROM workspace_files WHERE workspace_id = w.id) as file_count
+            """SELECT w.*
                FROM workspaces w WHERE w.owner_id = ? ORDER BY w.updated_at DESC""",
             (user_id,)).fetchall()
 
         joined = conn.execute(
-            """SELECT w.*, wm.role as member_role,
-                      (SELECT COUNT(*) FROM workspace_members WHERE workspace_id = w.id) as member_count,
-                      (SELECT COUNT(*) FROM workspace_files WHERE workspace_id = w.id) as file_count
+            """SELECT w.*, wm.role as member_role
                FROM workspaces w JOIN workspace_members wm ON w.id = wm.workspace_id
                WHERE wm.user_id = ? ORDER BY w.updated_at DESC""",
             (user_id,)).fetchall()
@@ -139,16 +125,12 @@ def api_list_workspaces():
     conn = _app.get_db()
     try:
         owned = conn.execute(
-            """SELECT w.*, 'owner' as role,
-                      (SELECT COUNT(*) FROM workspace_members WHERE workspace_id = w.id) as member_count,
-                      (SELECT COUNT(*) FROM workspace_files WHERE workspace_id = w.id) as file_count
+            """SELECT w.*, 'owner' as role
                FROM workspaces w WHERE w.owner_id = ? ORDER BY w.updated_at DESC""",
             (user_id,)).fetchall()
 
         joined = conn.execute(
-            """SELECT w.*, wm.role,
-                      (SELECT COUNT(*) FROM workspace_members WHERE workspace_id = w.id) as member_count,
-                      (SELECT COUNT(*) FROM workspace_files WHERE workspace_id = w.id) as file_count
+            """SELECT w.*, wm.role
                FROM workspaces w JOIN workspace_members wm ON w.id = wm.workspace_id
                WHERE wm.user_id = ? AND w.owner_id != ? ORDER BY w.updated_at DESC""",
             (user_id, user_id)).fetchall()
@@ -195,6 +177,7 @@ def api_create_workspace():
             (member_id, ws_id, user_id))
 
         conn.commit()
+        _app.invalidate_workspace_roles(ws_id)
 
         logger.info(f"[Workspace] 工作空间创建成功: {name} (id={ws_id}, owner={user_id})")
 
@@ -288,6 +271,7 @@ def api_delete_workspace(workspace_id):
         conn.execute("DELETE FROM workspace_members WHERE workspace_id = ?", (workspace_id,))
         conn.execute("DELETE FROM workspaces WHERE id = ?", (workspace_id,))
         conn.commit()
+        _app.invalidate_workspace_roles(workspace_id)
 
         _app.log_message(log_type='operation', log_level='WARNING',
                         message=f'删除工作空间: {ws_name}',
@@ -367,6 +351,7 @@ def api_add_workspace_member(workspace_id):
                VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP, ?)""",
             (member_id, workspace_id, target_user['id'], new_role, permissions_json))
         conn.commit()
+        _app.invalidate_workspace_roles(workspace_id)
 
         _app.log_message(log_type='operation', log_level='INFO',
                         message=f'添加成员 {target_user["username"]} 到工作空间，角色: {new_role}',
@@ -418,6 +403,7 @@ def api_update_workspace_member(workspace_id, member_user_id):
             "UPDATE workspace_members SET role = ?, permissions_json = ? WHERE workspace_id = ? AND user_id = ?",
             (new_role, permissions_json, workspace_id, member_user_id))
         conn.commit()
+        _app.invalidate_workspace_roles(workspace_id)
 
         _app.log_message(log_type='operation', log_level='INFO',
                         message=f'更新成员角色: {member_user_id} -> {new_role}',
@@ -452,6 +438,7 @@ def api_remove_workspace_member(workspace_id, member_user_id):
             "DELETE FROM workspace_members WHERE workspace_id = ? AND user_id = ?",
             (workspace_id, member_user_id))
         conn.commit()
+        _app.invalidate_workspace_roles(workspace_id)
 
         if result.rowcount == 0:
             return _app.api_response(success=False, message='成员不存在', code=404)
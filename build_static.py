@@ -0,0 +1,119 @@
+"""
+静态资源构建脚本
+
+把 static/ 下的 CSS/JS 合并（static/bundles.json）、压缩，输出带内容哈希的文件名到 static/dist/，
+同时生成 .gz（以及安装了 brotli 时的 .br）预压缩副本和 manifest.json，供 url_for_static 使用。
+
+用法: python build_static.py
+"""
+import gzip
+import hashlib
+import json
+import re
+import shutil
+from pathlib import Path
+
+BASE_DIR = Path(__file__).parent
+STATIC_DIR = BASE_DIR / "static"
+DIST_DIR = STATIC_DIR / "dist"
+BUNDLES_FILE = STATIC_DIR / "bundles.json"
+
+ASSET_SUFFIXES = ('.css', '.js')
+# 必须保持固定 URL 的文件（Service Worker 作用域、PWA 清单）与运行期上传目录
+EXCLUDED = {'service-worker.js'}
+EXCLUDED_DIRS = {'dist', 'uploads', 'avatars'}
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+
+def minify_css(text):
+    """保守的 CSS 压缩：去注释、折叠空白、去掉分隔符两侧空格"""
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.S)
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r'\s*([{};,>])\s*', r'\1', text)
+    return text.replace(';}', '}').strip()
+
+
+def minify_js(text):
+    """JS 仅在安装了 rjsmin 时压缩，否则原样输出（不做无语法分析的改写）"""
+    if rjsmin is not None:
+        return rjsmin.jsmin(text)
+    return text
+
+
+def minify(name, text):
+    return minify_css(text) if name.endswith('.css') else minify_js(text)
+
+
+def iter_sources():
+    for path in sorted(STATIC_DIR.rglob('*')):
+        rel = path.relative_to(STATIC_DIR)
+        if (path.is_file() and path.suffix in ASSET_SUFFIXES and path.name not in EXCLUDED
+                and rel.parts[0] not in EXCLUDED_DIRS):
+            yield rel.as_posix(), path
+
+
+def write_asset(logical_name, content):
+    """写出 name.<hash>.ext 及其预压缩副本，返回相对 static/ 的路径"""
+    data = content.encode('utf-8')
+    digest = hashlib.sha256(data).hexdigest()[:10]
+    stem, dot, suffix = logical_name.rpartition('.')
+    target = DIST_DIR / f"{stem}.{digest}.{suffix}"
+    target.parent.mkdir(parents=True, exist_ok=True)
+    target.write_bytes(data)
+    target.with_name(target.name + '.gz').write_bytes(gzip.compress(data, 9, mtime=0))
+    if brotli is not None:
+        target.with_name(target.name + '.br').write_bytes(brotli.compress(data, quality=11))
+    return target.relative_to(STATIC_DIR).as_posix(), len(data)
+
+
+def build():
+    if DIST_DIR.exists():
+        shutil.rmtree(DIST_DIR)
+    DIST_DIR.mkdir(parents=True)
+
+    sources = dict(iter_sources())
+    manifest = {'files': {}, 'bundles': {}}
+    original_total = minified_total = 0
+
+    for name, path in sources.items():
+        text = path.read_text(encoding='utf-8')
+        output, size = write_asset(name, minify(name, text))
+        manifest['files'][name] = output
+        original_total += len(text.encode('utf-8'))
+        minified_total += size
+
+    bundles = json.loads(BUNDLES_FILE.read_text(encoding='utf-8')) if BUNDLES_FILE.exists() else {}
+    for bundle_name, members in bundles.items():
+        missing = [m for m in members if m not in sources]
+        if missing:
+            raise SystemExit(f"❌ 合并包 {bundle_name} 引用了不存在的文件: {', '.join(missing)}")
+        content = '\n'.join(minify(m, sources[m].read_text(encoding='utf-8')) for m in members)
+        output, _ = write_asset(f"bundles/{bundle_name}", content)
+        manifest['bundles'][bundle_name] = {'file': output, 'members': members}
+
+    manifest['version'] = hashlib.sha256(
+        json.dumps(manifest, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+    (DIST_DIR / 'manifest.json').write_text(
+        json.dumps(manifest, ensure_ascii=False, indent=2, sort_keys=True), encoding='utf-8')
+
+    print(f"✅ 已构建 {len(manifest['files'])} 个文件、{len(manifest['bundles'])} 个合并包 -> {DIST_DIR}")
+    if original_total:
+        print(f"   压缩前 {original_total / 1024:.1f} KB，压缩后 {minified_total / 1024:.1f} KB")
+    if brotli is None:
+        print("⚠️  未安装 brotli，仅生成 .gz 预压缩文件")
+    if rjsmin is None:
+        print("⚠️  未安装 rjsmin，JS 文件未压缩")
+    return manifest
+
+
+if __name__ == "__main__":
+    build()
@@ -5,6 +5,12 @@ import shutil
 import zipfile
 import threading
 import base64
+import sqlite3
+import struct
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from pathlib import Path
 from functools import wraps
@@ -13,6 +19,9 @@ try:
     from cryptography.fernet import Fernet
     from cryptography.hazmat.primitives import hashes
     from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.exceptions import InvalidTag
     CRYPTO_AVAILABLE = True
 except ImportError:
     CRYPTO_AVAILABLE = False
@@ -31,6 +40,23 @@ BACKUP_RETENTION_DAYS = int(os.getenv("BACKUP_RETENTION_DAYS", "30"))
 BACKUP_AUTO_ENABLED = os.getenv("BACKUP_AUTO_ENABLED", "true").lower() == "true"
 BACKUP_INTERVAL_HOURS = int(os.getenv("BACKUP_INTERVAL_HOURS", "24"))
 IP_ANONYMIZE_ENABLED = os.getenv("IP_ANONYMIZE_ENABLED", "true").lower() == "true"
+BACKUP_PAGES_PER_STEP = int(os.getenv("BACKUP_PAGES_PER_STEP", "256"))
+BACKUP_STEP_SLEEP = float(os.getenv("BACKUP_STEP_SLEEP", "0.005"))
+BACKUP_WAL_SHIPPING_ENABLED = os.getenv("BACKUP_WAL_SHIPPING_ENABLED", "false").lower() == "true"
+BACKUP_WAL_SHIP_MINUTES = int(os.getenv("BACKUP_WAL_SHIP_MINUTES", "5"))
+# Minimum spacing of WAL bases (raw DB copies taken when SQLite restarts the WAL)
+BACKUP_WAL_REBASE_MINUTES = int(os.getenv("BACKUP_WAL_REBASE_MINUTES", "60"))
+WAL_STATE_FILE = BACKUP_DIR / "wal_state.json"
+CHUNK_STORE_DIR = BACKUP_DIR / "chunks"
+BACKUP_HASH_WORKERS = int(os.getenv("BACKUP_HASH_WORKERS", str(min(8, os.cpu_count() or 2))))
+STREAM_SEGMENT_SIZE = int(os.getenv("BACKUP_STREAM_SEGMENT_KB", "1024")) * 1024
+STREAM_FORMAT = "aes-256-gcm-stream-v1"
+WAL_HEADER_SIZE = 32
+WAL_FRAME_HEADER_SIZE = 24
+
+# Serializes chunk-store writers (create_backup) with chunk GC: a backup in
+# progress stores chunks before its manifest exists to reference them
+_chunk_store_lock = threading.RLock()
 
 
 class DataEncryption:
@@ -51,17 +77,23 @@ class DataEncryption:
             return
         self._initialized = True
         self._fernet = None
+        self._key_bytes = None
         self._key_loaded = False
         if not CRYPTO_AVAILABLE:
             return
         key = ENCRYPTION_KEY_ENV
         if key:
             try:
-                self._fernet = Fernet(key.encode() if isinstance(key, str) else key)
-                self._key_loaded = True
+                self._load_key(key)
             except Exception:
                 pass
 
+    def _load_key(self, key):
+        key = key.encode() if isinstance(key, str) else key
+        self._fernet = Fernet(key)
+        self._key_bytes = key
+        self._key_loaded = True
+
     @property
     def available(self):
         return CRYPTO_AVAILABLE and self._key_loaded
@@ -78,8 +110,7 @@ class DataEncryption:
         key = self.generate_key()
         DATA_DIR.mkdir(parents=True, exist_ok=True)
         ENCRYPTION_KEY_FILE.write_text(key)
-        self._fernet = Fernet(key.encode())
-        self._key_loaded = True
+        self._load_key(key)
         return key
 
     def load_key_from_file(self):
@@ -87,8 +118,7 @@ class DataEncryption:
             return False
         try:
             key = ENCRYPTION_KEY_FILE.read_text().strip()
-            self._fernet = Fernet(key.encode())
-            self._key_loaded = True
+            self._load_key(key)
             return True
         except Exception:
             return False
@@ -100,13 +130,27 @@ class DataEncryption:
             return True
         if ENCRYPTION_KEY_ENV:
             try:
-                self._fernet = Fernet(ENCRYPTION_KEY_ENV.encode())
-                self._key_loaded = True
+                self._load_key(ENCRYPTION_KEY_ENV)
                 return True
             except Exception:
                 pass
         return False
 
+    def stream_key(self):
+        """AES-256-GCM key for the streaming backup format, derived from the Fernet key."""
+        if not self.available:
+            raise RuntimeError("Encryption key not configured")
+        return HKDF(
+            algorithm=hashes.SHA256(), length=32, salt=None, info=b"backup-stream-v1"
+        ).derive(self._key_bytes)
+
+    def encrypt_file(self, src_path, dst_path):
+        """Encrypt a file of any size with constant memory (see StreamEncryptWriter)."""
+        return encrypt_file(src_path, dst_path, key=self.stream_key())
+
+    def decrypt_file(self, src_path, dst_path):
+        return decrypt_file(src_path, dst_path, key=self.stream_key())
+
     def encrypt(self, plaintext):
         if not self.available or plaintext is None:
             return plaintext
@@ -172,6 +216,512 @@ SENSITIVE_USER_FIELDS = {"email"}
 SENSITIVE_LOG_FIELDS = {"ip_address"}
 
 
+# ---- Streaming authenticated encryption -------------------------------------
+#
+# Layout: header | record* where
+#   header = magic(4) | version(1) | segment_size(4) | nonce_prefix(8)
+#   record = ciphertext_len(4) | final(1) | AES-GCM(segment) incl. 16-byte tag
+# Segment i uses nonce = nonce_prefix | i (4 bytes) and is authenticated together
+# with the header, its index and the final flag, so reordering, truncation and
+# appended data are all detected on decryption.
+
+STREAM_MAGIC = b"DKSE"
+STREAM_VERSION = 1
+_STREAM_HEADER = struct.Struct(">4sBI8s")
+_STREAM_RECORD = struct.Struct(">IB")
+
+
+def _segment_aad(header, index, final):
+    return header + struct.pack(">QB", index, 1 if final else 0)
+
+
+def _segment_nonce(prefix, index):
+    return prefix + struct.pack(">I", index)
+
+
+class StreamEncryptWriter:
+    """Write-only file object producing the segmented AES-GCM stream format.
+
+    Memory use is bounded by ``segment_size * workers * 2``; batches of segments
+    are encrypted in parallel on a thread pool. Closing the writer emits the final
+    segment but leaves the underlying file open.
+    """
+
+    def __init__(self, fileobj, key, segment_size=STREAM_SEGMENT_SIZE, workers=BACKUP_HASH_WORKERS):
+        self._out = fileobj
+        self._aead = AESGCM(key)
+        self._segment_size = segment_size
+        self._prefix = os.urandom(8)
+        self._header = _STREAM_HEADER.pack(STREAM_MAGIC, STREAM_VERSION, segment_size, self._prefix)
+        self._buffer = bytearray()
+        self._pending = []
+        self._index = 0
+        self._batch = max(workers, 1) * 2
+        self._pool = ThreadPoolExecutor(max_workers=max(workers, 1))
+        self._closed = False
+        self.bytes_in = 0
+        self._out.write(self._header)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        self.bytes_in += len(data)
+        # Keep the tail in the buffer: the last segment must be flagged final on close
+        while len(self._buffer) > self._segment_size:
+            self._pending.append(bytes(self._buffer[:self._segment_size]))
+            del self._buffer[:self._segment_size]
+            if len(self._pending) >= self._batch:
+                self._flush_pending(final=False)
+        return len(data)
+
+    def flush(self):
+        self._out.flush()
+
+    def _encrypt_segment(self, args):
+        index, segment, final = args
+        return self._aead.encrypt(
+            _segment_nonce(self._prefix, index), segment, _segment_aad(self._header, index, final)
+        )
+
+    def _flush_pending(self, final):
+        jobs = []
+        for i, segment in enumerate(self._pending):
+            is_final = final and i == len(self._pending) - 1
+            jobs.append((self._index + i, segment, is_final))
+        for (_, _, is_final), ciphertext in zip(jobs, self._pool.map(self._encrypt_segment, jobs)):
+            self._out.write(_STREAM_RECORD.pack(len(ciphertext), 1 if is_final else 0))
+            self._out.write(ciphertext)
+        self._index += len(jobs)
+        self._pending = []
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._pending.append(bytes(self._buffer))
+        self._buffer = bytearray()
+        self._flush_pending(final=True)
+        self._pool.shutdown()
+        self._out.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def encrypt_stream(src, dst, key, segment_size=STREAM_SEGMENT_SIZE):
+    """Encrypt readable file object ``src`` into ``dst``; returns plaintext bytes."""
+    with StreamEncryptWriter(dst, key, segment_size=segment_size) as writer:
+        shutil.copyfileobj(src, writer, segment_size)
+    return writer.bytes_in
+
+
+def decrypt_stream(src, dst, key, workers=BACKUP_HASH_WORKERS):
+    """Decrypt the stream format from ``src`` into writable ``dst``; returns plaintext bytes.
+
+    Raises ValueError if the stream is malformed, truncated or fails authentication.
+    """
+    header = src.read(_STREAM_HEADER.size)
+    if len(header) != _STREAM_HEADER.size:
+        raise ValueError("Encrypted stream header truncated")
+    magic, version, segment_size, prefix = _STREAM_HEADER.unpack(header)
+    if magic != STREAM_MAGIC or version != STREAM_VERSION:
+        raise ValueError("Not an encrypted backup stream")
+
+    aead = AESGCM(key)
+    max_record = segment_size + 16
+    batch = max(workers, 1) * 2
+    index = 0
+    written = 0
+    seen_final = False
+
+    def _decrypt(args):
+        i, ciphertext, final = args
+        try:
+            return aead.decrypt(_segment_nonce(prefix, i), ciphertext, _segment_aad(header, i, final))
+        except InvalidTag:
+            raise ValueError(f"Encrypted stream authentication failed at segment {i}")
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        while not seen_final:
+            jobs = []
+            while len(jobs) < batch and not seen_final:
+                record = src.read(_STREAM_RECORD.size)
+                if len(record) != _STREAM_RECORD.size:
+                    raise ValueError("Encrypted stream truncated")
+                length, final = _STREAM_RECORD.unpack(record)
+                if length > max_record:
+                    raise ValueError("Encrypted stream record too large")
+                ciphertext = src.read(length)
+                if len(ciphertext) != length:
+                    raise ValueError("Encrypted stream truncated")
+                jobs.append((index, ciphertext, bool(final)))
+                seen_final = bool(final)
+                index += 1
+            for plaintext in pool.map(_decrypt, jobs):
+                dst.write(plaintext)
+                written += len(plaintext)
+    if src.read(1):
+        raise ValueError("Unexpected data after final segment")
+    return written
+
+
+def is_stream_encrypted(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(STREAM_MAGIC)) == STREAM_MAGIC
+    except OSError:
+        return False
+
+
+def encrypt_file(src_path, dst_path, key=None):
+    key = key or get_encryption().stream_key()
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        return encrypt_stream(src, dst, key)
+
+
+def decrypt_file(src_path, dst_path, key=None):
+    key = key or get_encryption().stream_key()
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        return decrypt_stream(src, dst, key)
+
+
+def _decrypt_to(path, dst):
+    """Decrypt an encrypted backup object (stream format or legacy Fernet blob) into ``dst``."""
+    if is_stream_encrypted(path):
+        with open(path, "rb") as src:
+            decrypt_stream(src, dst, get_encryption().stream_key())
+    else:
+        dst.write(get_encryption()._fernet.decrypt(Path(path).read_bytes()))
+
+
+class _HashingReader:
+    """Read-through wrapper that sha256-hashes everything read from ``fileobj``."""
+
+    def __init__(self, fileobj):
+        self._f = fileobj
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self.sha256.update(data)
+        return data
+
+
+class _HashingSink:
+    def __init__(self):
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.sha256.update(data)
+        return len(data)
+
+
+def snapshot_database(source_path, dest_path, pages=BACKUP_PAGES_PER_STEP, sleep=BACKUP_STEP_SLEEP):
+    """Consistent copy of a live SQLite database via the online backup API.
+
+    Pages are copied ``pages`` at a time and the source lock is released between
+    steps, so writers are only blocked for one step instead of the whole copy.
+    """
+    started = time.monotonic()
+    steps = [0]
+
+    def _on_progress(status, remaining, total):
+        steps[0] += 1
+
+    src = sqlite3.connect(str(source_path), timeout=30)
+    dest = sqlite3.connect(str(dest_path))
+    try:
+        src.backup(dest, pages=pages, progress=_on_progress, sleep=sleep)
+        page_size = dest.execute("PRAGMA page_size").fetchone()[0]
+        page_count = dest.execute("PRAGMA page_count").fetchone()[0]
+    finally:
+        dest.close()
+        src.close()
+    return {
+        "pages": page_count,
+        "bytes": page_count * page_size,
+        "steps": steps[0],
+        "duration_s": round(time.monotonic() - started, 3),
+    }
+
+
+def _read_wal_salt(wal_path):
+    """Salt of the current WAL generation; changes whenever SQLite restarts the WAL."""
+    try:
+        with open(wal_path, "rb") as f:
+            header = f.read(WAL_HEADER_SIZE)
+    except FileNotFoundError:
+        return None
+    if len(header) < WAL_HEADER_SIZE:
+        return None
+    return header[16:24].hex()
+
+
+def _wal_checksum(data, s0, s1, order):
+    """SQLite's cumulative WAL checksum over ``data``, continuing from (s0, s1)."""
+    words = struct.unpack(f"{order}{len(data) // 4}I", data)
+    for i in range(0, len(words), 2):
+        s0 = (s0 + words[i] + s1) & 0xFFFFFFFF
+        s1 = (s1 + words[i + 1] + s0) & 0xFFFFFFFF
+    return s0, s1
+
+
+def _wal_committed_end(wal_path, offset):
+    """End of the last valid commit frame of the current WAL generation after ``offset``.
+
+    Frames are walked while their salt matches the WAL header and their cumulative
+    checksum verifies. Stale frames from an earlier generation and the uncommitted
+    tail of an in-progress write are never counted. Returns ``offset`` when no new
+    commit exists, or None if ``offset`` is not a frame boundary of this WAL.
+    """
+    with open(wal_path, "rb") as f:
+        header = f.read(WAL_HEADER_SIZE)
+        if len(header) < WAL_HEADER_SIZE:
+            return None
+        magic, _version, page_size = struct.unpack(">III", header[:12])
+        if magic not in (0x377F0682, 0x377F0683):
+            return None
+        order = ">" if magic & 1 else "<"
+        salt = header[16:24]
+        frame_size = WAL_FRAME_HEADER_SIZE + (page_size if page_size != 1 else 65536)
+
+        if offset == 0:
+            checksum = _wal_checksum(header[:24], 0, 0, order)
+            if checksum != struct.unpack(">II", header[24:32]):
+                return None
+            pos = WAL_HEADER_SIZE
+        else:
+            if offset < WAL_HEADER_SIZE + frame_size or (offset - WAL_HEADER_SIZE) % frame_size:
+                return None
+            f.seek(offset - frame_size)
+            prev = f.read(WAL_FRAME_HEADER_SIZE)
+            if len(prev) < WAL_FRAME_HEADER_SIZE or prev[8:16] != salt:
+                return None
+            checksum = struct.unpack(">II", prev[16:24])
+            pos = offset
+
+        end = offset
+        f.seek(pos)
+        while True:
+            frame = f.read(frame_size)
+            if len(frame) < frame_size or frame[8:16] != salt:
+                break
+            checksum = _wal_checksum(frame[:8], *checksum, order)
+            checksum = _wal_checksum(frame[WAL_FRAME_HEADER_SIZE:], *checksum, order)
+            if checksum != struct.unpack(">II", frame[16:24]):
+                break
+            pos += frame_size
+            if struct.unpack(">I", frame[4:8])[0]:
+                end = pos
+    return end
+
+
+def _copy_shipped(src, dst_path, length=None, encrypted=False):
+    """Copy ``length`` bytes (or all) from the open file ``src`` into a shipped WAL object."""
+    remaining = length
+    copied = 0
+    with open(dst_path, "wb") as out:
+        writer = StreamEncryptWriter(out, get_encryption().stream_key()) if encrypted else out
+        while remaining is None or remaining > 0:
+            block = src.read(1024 * 1024 if remaining is None else min(remaining, 1024 * 1024))
+            if not block:
+                break
+            writer.write(block)
+            copied += len(block)
+            if remaining is not None:
+                remaining -= len(block)
+        if writer is not out:
+            writer.close()
+    return copied
+
+
+def _replay_wal_segments(backup_path, db_path):
+    """Roll a restored snapshot forward with the shipped WAL chain.
+
+    The newest WAL base, if any, replaces the snapshot and only segments shipped
+    after it are replayed. The work happens on a temporary copy next to ``db_path``
+    that is swapped in with os.replace, so the ``-wal``/``-shm`` files of
+    ``db_path`` (the live database on a default-location restore) are never touched.
+    """
+    wal_dir = Path(backup_path) / "wal"
+    shipped = sorted(wal_dir.iterdir()) if wal_dir.exists() else []
+    bases = [p for p in shipped if ".base" in p.name]
+    segments = [p for p in shipped if ".wal" in p.name]
+    base = bases[-1] if bases else None
+    if base is not None:
+        segments = [p for p in segments if p.name[:6] > base.name[:6]]
+    if base is None and not segments:
+        return 0
+
+    db_path = Path(db_path)
+    fd, tmp_name = tempfile.mkstemp(prefix=f"{db_path.name}.", suffix=".replay", dir=str(db_path.parent))
+    tmp_path = Path(tmp_name)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            source = base or db_path
+            if source.name.endswith(".enc"):
+                _decrypt_to(source, out)
+            else:
+                with open(source, "rb") as src:
+                    shutil.copyfileobj(src, out, 1024 * 1024)
+        if segments:
+            conn = sqlite3.connect(str(tmp_path))
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.close()
+            with open(f"{tmp_path}-wal", "wb") as out:
+                for seg in segments:
+                    if seg.name.endswith(".enc"):
+                        _decrypt_to(seg, out)
+                    else:
+                        with open(seg, "rb") as src:
+                            shutil.copyfileobj(src, out, 1024 * 1024)
+            conn = sqlite3.connect(str(tmp_path))
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            conn.close()
+        os.replace(tmp_path, db_path)
+    finally:
+        for leftover in (tmp_path, Path(f"{tmp_path}-wal"), Path(f"{tmp_path}-shm")):
+            if leftover.exists():
+                leftover.unlink()
+    return len(segments)
+
+
+def _iter_backup_dirs():
+    """Backup directories under BACKUP_DIR, excluding the shared chunk store."""
+    if not BACKUP_DIR.exists():
+        return []
+    return [d for d in BACKUP_DIR.iterdir() if d.is_dir() and d != CHUNK_STORE_DIR]
+
+
+def _load_manifest(backup_path):
+    try:
+        return json.loads((Path(backup_path) / "manifest.json").read_text(encoding="utf-8"))
+    except Exception:
+        return None
+
+
+def _sha256_file(path):
+    sha256_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256_hash.update(chunk)
+    return sha256_hash.hexdigest()
+
+
+def _chunk_path(chunk_name):
+    return CHUNK_STORE_DIR / chunk_name[:2] / chunk_name
+
+
+def _store_upload(src_path, rel_path, stat, known_sha, encrypted):
+    """Back up one upload into the chunk store; returns (manifest entry, bytes written).
+
+    Files whose (size, mtime) match the previous manifest reuse its hash and are
+    not read at all. New content is hashed while being copied and stored once
+    under its sha256, so identical files share one chunk.
+    """
+    suffix = ".enc" if encrypted else ""
+    entry = {"path": rel_path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if known_sha and _chunk_path(known_sha + suffix).exists():
+        entry.update(sha256=known_sha, chunk=known_sha + suffix)
+        return entry, 0
+
+    CHUNK_STORE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_path = CHUNK_STORE_DIR / f".tmp-{uuid.uuid4().hex}"
+    try:
+        if encrypted:
+            with open(src_path, "rb") as src, open(tmp_path, "wb") as dst:
+                reader = _HashingReader(src)
+                encrypt_stream(reader, dst, get_encryption().stream_key())
+            sha = reader.sha256.hexdigest()
+        else:
+            sha256_hash = hashlib.sha256()
+            with open(src_path, "rb") as src, open(tmp_path, "wb") as dst:
+                for chunk in iter(lambda: src.read(1024 * 1024), b""):
+                    sha256_hash.update(chunk)
+                    dst.write(chunk)
+            sha = sha256_hash.hexdigest()
+
+        dest = _chunk_path(sha + suffix)
+        written = 0
+        if tmp_path.exists() and not dest.exists():
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            written = tmp_path.stat().st_size
+            os.replace(str(tmp_path), str(dest))
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+    entry.update(sha256=sha, chunk=sha + suffix)
+    return entry, written
+
+
+def _verify_chunk(entry):
+    """Return an error string for a missing or corrupt upload chunk, else None."""
+    chunk_file = _chunk_path(entry["chunk"])
+    if not chunk_file.exists():
+        return f"Missing chunk: {entry['path']}"
+    if entry["chunk"].endswith(".enc"):
+        if not get_encryption().available:
+            return None
+        try:
+            sink = _HashingSink()
+            _decrypt_to(chunk_file, sink)
+            actual = sink.sha256.hexdigest()
+        except Exception:
+            return f"Undecryptable chunk: {entry['path']}"
+    else:
+        actual = _sha256_file(chunk_file)
+    if actual != entry["sha256"]:
+        return f"Hash mismatch: {entry['path']}"
+    return None
+
+
+def _restore_chunk(entry, dest_root):
+    dest_path = Path(dest_root) / entry["path"]
+    dest_path.parent.mkdir(parents=True, exist_ok=True)
+    chunk_file = _chunk_path(entry["chunk"])
+    if entry["chunk"].endswith(".enc"):
+        with open(dest_path, "wb") as out:
+            _decrypt_to(chunk_file, out)
+    else:
+        shutil.copyfile(str(chunk_file), str(dest_path))
+
+
+def _gc_chunks():
+    """Delete chunks no longer referenced by any remaining backup manifest."""
+    with _chunk_store_lock:
+        if not CHUNK_STORE_DIR.exists():
+            return {"chunks_removed": 0, "chunk_bytes_freed": 0}
+        referenced = set()
+        for bd in _iter_backup_dirs():
+            if not (bd / "manifest.json").exists():
+                # Not a chunk-store backup (e.g. written by backup.py); it references no chunks
+                continue
+            manifest = _load_manifest(bd)
+            if manifest is None:
+                # Corrupt manifest: keep everything rather than risk data loss
+                return {"chunks_removed": 0, "chunk_bytes_freed": 0}
+            referenced.update(e["chunk"] for e in manifest.get("uploads", []))
+        removed = 0
+        freed = 0
+        for prefix_dir in CHUNK_STORE_DIR.iterdir():
+            if not prefix_dir.is_dir():
+                continue
+            for chunk_file in prefix_dir.iterdir():
+                if chunk_file.name not in referenced:
+                    freed += chunk_file.stat().st_size
+                    chunk_file.unlink()
+                    removed += 1
+            if not any(prefix_dir.iterdir()):
+                prefix_dir.rmdir()
+        return {"chunks_removed": removed, "chunk_bytes_freed": freed}
+
+
 class BackupManager:
     """Enhanced backup system: encryption, rotation, integrity verification"""
 
@@ -180,21 +730,28 @@ class BackupManager:
 
     @staticmethod
     def create_backup(encrypt=True, description=""):
+        # Held until the manifest is written so GC never sees this backup's
+        # freshly stored chunks as unreferenced
+        with _chunk_store_lock:
+            return BackupManager._create_backup(encrypt, description)
+
+    @staticmethod
+    def _create_backup(encrypt, description):
         BACKUP_DIR.mkdir(parents=True, exist_ok=True)
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         backup_subdir = BACKUP_DIR / timestamp
         backup_subdir.mkdir(exist_ok=True)
 
+        started = time.monotonic()
+        encrypted = encrypt and get_encryption().available
         db_source = DB_FILE
+        db_snapshot = None
+        wal_salt = _read_wal_salt(f"{DB_FILE}-wal")
         if db_source.exists():
             dest_db = backup_subdir / "db.sqlite"
-            shutil.copy2(str(db_source), str(dest_db))
+            db_snapshot = snapshot_database(db_source, dest_db)
 
-        if UPLOAD_DIR.exists():
-            backup_upload = backup_subdir / "uploads"
-            if backup_upload.exists():
-                shutil.rmtree(str(backup_upload))
-            shutil.copytree(str(UPLOAD_DIR), str(backup_upload))
+        upload_entries, upload_stats = BackupManager._backup_uploads(encrypted)
 
         manifest = {
             "timestamp": timestamp,
@@ -204,6 +761,9 @@ class BackupManager:
             "files": [],
             "hashes": {},
             "encrypted": False,
+            "db_snapshot": db_snapshot,
+            "uploads": upload_entries,
+            "uploads_stats": upload_stats,
         }
 
         total_size = 0
@@ -220,41 +780,57 @@ class BackupManager:
                 manifest["files"].append({"path": rel_path, "size": size})
                 manifest["hashes"][rel_path] = sha256_hash.hexdigest()
 
+        total_size += upload_stats["new_bytes"]
         manifest["total_size"] = total_size
         manifest_path = backup_subdir / "manifest.json"
         manifest_path.write_text(json.dumps(manifest, indent=2, ensure_ascii=False), encoding="utf-8")
 
         if encrypt and get_encryption().available:
-            archive_path = Path(f"{str(backup_subdir)}.zip")
             enc_backup_dir = backup_subdir.parent / f"{timestamp}_enc"
             enc_backup_dir.mkdir(exist_ok=True)
-            with zipfile.ZipFile(str(archive_path), "w", zipfile.ZIP_DEFLATED) as zf:
+            # The zip is written straight into the encrypting stream: no plaintext
+            # archive on disk and memory bounded by the segment window
+            with open(enc_backup_dir / "backup_data.zip.enc", "wb") as out, \
+                    StreamEncryptWriter(out, get_encryption().stream_key()) as writer, \
+                    zipfile.ZipFile(writer, "w", zipfile.ZIP_DEFLATED) as zf:
                 for root, dirs, files in os.walk(backup_subdir):
                     for file in files:
                         full_path = os.path.join(root, file)
-                        arc_name = os.path.relpath(full_path, backup_subdir)
-                        with open(full_path, "rb") as f:
-                            data = f.read()
-                        zf.writestr(arc_name, get_encryption()._fernet.encrypt(data))
+                        zf.write(full_path, os.path.relpath(full_path, backup_subdir))
             enc_manifest = dict(manifest)
             enc_manifest["encrypted"] = True
+            enc_manifest["encryption"] = STREAM_FORMAT
             enc_manifest["original_dir"] = timestamp
             enc_manifest_path = enc_backup_dir / "manifest.json"
             enc_manifest_path.write_text(
                 json.dumps(enc_manifest, indent=2, ensure_ascii=False), encoding="utf-8"
             )
-            shutil.move(str(archive_path), str(enc_backup_dir / "backup_data.zip.enc"))
             shutil.rmtree(str(backup_subdir))
             final_dir = enc_backup_dir
         else:
             final_dir = backup_subdir
 
+        if BACKUP_WAL_SHIPPING_ENABLED and db_snapshot is not None:
+            # WAL frames are replayed from the start of the generation that was
+            # live when the snapshot began; a restart of the WAL rebases the chain (see ship_wal)
+            BACKUP_DIR.mkdir(parents=True, exist_ok=True)
+            WAL_STATE_FILE.write_text(json.dumps({
+                "backup": final_dir.name,
+                "salt": wal_salt,
+                "offset": 0,
+                "segments": 0,
+                "encrypted": encrypted,
+            }), encoding="utf-8")
+
+        duration = round(time.monotonic() - started, 3)
         log_entry = {
             "action": "backup_created",
             "timestamp": datetime.now().isoformat(),
             "directory": final_dir.name,
             "total_size_bytes": total_size,
-            "encrypted": encrypt and get_encryption().available,
+            "db_bytes_copied": db_snapshot["bytes"] if db_snapshot else 0,
+            "duration_s": duration,
+            "encrypted": encrypted,
             "description": description,
         }
         _write_privacy_log(log_entry)
@@ -262,8 +838,140 @@ class BackupManager:
         return {
             "path": final_dir,
             "size_mb": round(total_size / (1024 * 1024), 2),
-            "encrypted": encrypt and get_encryption().available,
-            "file_count": len(manifest["files"]),
+            "encrypted": encrypted,
+            "file_count": len(manifest["files"]) + len(upload_entries),
+            "uploads_new_files": upload_stats["new_files"],
+            "uploads_new_bytes": upload_stats["new_bytes"],
+            "db_bytes_copied": db_snapshot["bytes"] if db_snapshot else 0,
+            "db_snapshot_duration_s": db_snapshot["duration_s"] if db_snapshot else 0,
+            "duration_s": duration,
+        }
+
+    @staticmethod
+    def _backup_uploads(encrypted):
+        """Incrementally back up UPLOAD_DIR into the shared chunk store.
+
+        Unchanged files (same path, size and mtime as the newest previous manifest)
+        are referenced without being read; the rest are hashed and stored in
+        parallel across BACKUP_HASH_WORKERS threads.
+        """
+        stats = {"files": 0, "reused_files": 0, "new_files": 0, "new_bytes": 0, "logical_bytes": 0}
+        if not UPLOAD_DIR.exists():
+            return [], stats
+
+        previous = {}
+        newest = None
+        for bd in _iter_backup_dirs():
+            manifest = _load_manifest(bd)
+            if manifest and manifest.get("uploads") and (
+                newest is None or manifest.get("created_at", "") > newest.get("created_at", "")
+            ):
+                newest = manifest
+        if newest:
+            previous = {
+                (e["path"], e["size"], e["mtime_ns"]): e["sha256"] for e in newest["uploads"]
+            }
+
+        jobs = []
+        for dirpath, _, filenames in os.walk(UPLOAD_DIR):
+            for fname in filenames:
+                fp = os.path.join(dirpath, fname)
+                rel_path = os.path.relpath(fp, UPLOAD_DIR).replace("\\", "/")
+                st = os.stat(fp)
+                jobs.append((fp, rel_path, st, previous.get((rel_path, st.st_size, st.st_mtime_ns))))
+
+        entries = []
+        with ThreadPoolExecutor(max_workers=BACKUP_HASH_WORKERS) as pool:
+            futures = [pool.submit(_store_upload, fp, rel, st, sha, encrypted) for fp, rel, st, sha in jobs]
+            for future in futures:
+                entry, written = future.result()
+                entries.append(entry)
+                stats["files"] += 1
+                stats["logical_bytes"] += entry["size"]
+                if written:
+                    stats["new_files"] += 1
+                    stats["new_bytes"] += written
+                else:
+                    stats["reused_files"] += 1
+        return entries, stats
+
+    @staticmethod
+    def ship_wal():
+        """Copy WAL frames written since the last shipment next to the latest snapshot.
+
+        Only whole committed transactions are shipped: the high-water mark is the end
+        of the last commit frame with a valid checksum, never the raw WAL file size.
+        A read transaction is held while copying so SQLite cannot restart the WAL
+        underneath us. When the WAL generation has changed since the last shipment,
+        a WAL base (a raw copy of the database file) is taken instead of a full
+        backup, at most once per BACKUP_WAL_REBASE_MINUTES; until then shipping pauses.
+        """
+        if not WAL_STATE_FILE.exists():
+            return {"shipped": False, "reason": "no_snapshot"}
+        try:
+            state = json.loads(WAL_STATE_FILE.read_text(encoding="utf-8"))
+        except Exception:
+            return {"shipped": False, "reason": "invalid_state", "needs_snapshot": True}
+        backup_path = BACKUP_DIR / state["backup"]
+        if not backup_path.exists():
+            return {"shipped": False, "reason": "no_snapshot", "needs_snapshot": True}
+
+        started = time.monotonic()
+        wal_path = f"{DB_FILE}-wal"
+        encrypted = state.get("encrypted")
+        wal_dir = backup_path / "wal"
+        base_name = None
+        conn = sqlite3.connect(str(DB_FILE), timeout=30)
+        try:
+            conn.execute("BEGIN")
+            conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+            salt = _read_wal_salt(wal_path)
+            if salt is None:
+                return {"shipped": False, "reason": "no_wal"}
+            offset = state.get("offset", 0)
+            end = _wal_committed_end(wal_path, offset) if salt == state.get("salt") else None
+            if end is None:
+                # The WAL restarted (or our offset no longer lines up): frames may be
+                # lost, so rebase the chain on a copy of the database file. Under our
+                # read transaction a checkpoint can only write pages whose frames are
+                # shipped below from offset 0, so a torn read is overwritten on replay.
+                if time.time() - state.get("rebased_at", 0) < BACKUP_WAL_REBASE_MINUTES * 60:
+                    return {"shipped": False, "reason": "wal_reset", "rebase_deferred": True}
+                seq = state.get("segments", 0) + 1
+                wal_dir.mkdir(exist_ok=True)
+                base_path = wal_dir / (f"{seq:06d}.base.enc" if encrypted else f"{seq:06d}.base")
+                with open(DB_FILE, "rb") as src:
+                    _copy_shipped(src, base_path, encrypted=encrypted)
+                base_name = base_path.name
+                state.update(salt=salt, offset=0, segments=seq, rebased_at=time.time())
+                offset = 0
+                end = _wal_committed_end(wal_path, 0) or 0
+
+            length = 0
+            seg_path = None
+            if end > offset:
+                seq = state.get("segments", 0) + 1
+                wal_dir.mkdir(exist_ok=True)
+                seg_path = wal_dir / (f"{seq:06d}.wal.enc" if encrypted else f"{seq:06d}.wal")
+                with open(wal_path, "rb") as src:
+                    src.seek(offset)
+                    length = _copy_shipped(src, seg_path, end - offset, encrypted)
+                state["segments"] = seq
+        finally:
+            conn.rollback()
+            conn.close()
+
+        if seg_path is None and base_name is None:
+            return {"shipped": False, "reason": "no_changes"}
+        state["offset"] = offset + length
+        WAL_STATE_FILE.write_text(json.dumps(state), encoding="utf-8")
+        return {
+            "shipped": seg_path is not None,
+            "backup": state["backup"],
+            "segment": seg_path.name if seg_path else None,
+            "base": base_name,
+            "bytes": length,
+            "duration_s": round(time.monotonic() - started, 3),
         }
 
     @staticmethod
@@ -272,7 +980,7 @@ class BackupManager:
         if not BACKUP_DIR.exists():
             return results
         backups = sorted(
-            [d for d in BACKUP_DIR.iterdir() if d.is_dir()],
+            _iter_backup_dirs(),
             key=lambda x: x.stat().st_mtime,
             reverse=True,
         )[:limit]
@@ -292,7 +1000,7 @@ class BackupManager:
                     info["size_mb"] = round(m.get("total_size", 0) / (1024 * 1024), 2)
                     info["encrypted"] = m.get("encrypted", False)
                     info["description"] = m.get("description", "")
-                    info["file_count"] = len(m.get("files", []))
+                    info["file_count"] = len(m.get("files", [])) + len(m.get("uploads", []))
                 except Exception:
                     pass
             else:
@@ -318,31 +1026,45 @@ class BackupManager:
         except Exception:
             return {"valid": False, "error": "Invalid manifest JSON"}
 
-        errors = []
-        verified = 0
-        for file_info in manifest.get("files", []):
+        def _verify_file(file_info):
             fp = backup_path / file_info["path"]
             if not fp.exists():
-                errors.append(f"Missing file: {file_info['path']}")
-                continue
-            sha256_hash = hashlib.sha256()
-            with open(fp, "rb") as f:
-                for chunk in iter(lambda: f.read(8192), b""):
-                    sha256_hash.update(chunk)
-            current_hash = sha256_hash.hexdigest()
-            expected_hash = manifest["hashes"].get(file_info["path"], "")
-            if current_hash != expected_hash:
-                errors.append(f"Hash mismatch: {file_info['path']}")
-            else:
-                verified += 1
+                return f"Missing file: {file_info['path']}"
+            if _sha256_file(fp) != manifest["hashes"].get(file_info["path"], ""):
+                return f"Hash mismatch: {file_info['path']}"
+            return None
+
+        files = manifest.get("files", [])
+        uploads = manifest.get("uploads", [])
+        if manifest.get("encrypted"):
+            # Database and manifest files live inside the encrypted archive
+            archive_ok = (backup_path / "backup_data.zip.enc").exists()
+            file_results = [None if archive_ok else "Missing file: backup_data.zip.enc"]
+            files = []
+        else:
+            file_results = []
+        with ThreadPoolExecutor(max_workers=BACKUP_HASH_WORKERS) as pool:
+            results = file_results + list(pool.map(_verify_file, files)) + list(pool.map(_verify_chunk, uploads))
+        errors = [r for r in results if r]
 
         return {
             "valid": len(errors) == 0,
-            "verified_files": verified,
-            "total_files": len(manifest.get("files", [])),
+            "verified_files": len(results) - len(errors),
+            "total_files": len(results),
             "errors": errors,
         }
 
+    @staticmethod
+    def _restore_uploads(manifest, dest_upload):
+        """Rebuild an uploads directory from the chunk store in parallel."""
+        dest_upload = Path(dest_upload)
+        if dest_upload.exists():
+            shutil.rmtree(str(dest_upload))
+        dest_upload.mkdir(parents=True, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=BACKUP_HASH_WORKERS) as pool:
+            list(pool.map(lambda e: _restore_chunk(e, dest_upload), manifest["uploads"]))
+        return len(manifest["uploads"])
+
     @staticmethod
     def restore_backup(backup_dir_name, target_dir=None):
         backup_path = BACKUP_DIR / backup_dir_name
@@ -362,27 +1084,49 @@ class BackupManager:
             enc_zip = backup_path / "backup_data.zip.enc"
             if not enc_zip.exists():
                 return {"success": False, "error": "Encrypted backup file not found"}
-            restore_to = target_dir or DATA_DIR / "_restore_temp"
+            restore_to = Path(target_dir) if target_dir else DATA_DIR / "_restore_temp"
             restore_to.mkdir(parents=True, exist_ok=True)
-            with zipfile.ZipFile(str(enc_zip), "r") as zf:
-                for item in zf.namelist():
-                    data = zf.read(item)
-                    decrypted = get_encryption()._fernet.decrypt(data)
-                    dest_path = restore_to / item
-                    dest_path.parent.mkdir(parents=True, exist_ok=True)
-                    dest_path.write_bytes(decrypted)
-            return {"success": True, "restored_to": str(restore_to), "encrypted": True}
+            if manifest.get("encryption") == STREAM_FORMAT:
+                with tempfile.TemporaryFile(dir=str(restore_to)) as plain_zip:
+                    with open(enc_zip, "rb") as src:
+                        decrypt_stream(src, plain_zip, get_encryption().stream_key())
+                    plain_zip.seek(0)
+                    with zipfile.ZipFile(plain_zip, "r") as zf:
+                        zf.extractall(str(restore_to))
+            else:
+                # Legacy format: each zip entry is a Fernet token
+                with zipfile.ZipFile(str(enc_zip), "r") as zf:
+                    for item in zf.namelist():
+                        data = zf.read(item)
+                        decrypted = get_encryption()._fernet.decrypt(data)
+                        dest_path = restore_to / item
+                        dest_path.parent.mkdir(parents=True, exist_ok=True)
+                        dest_path.write_bytes(decrypted)
+            replayed = 0
+            if (restore_to / "db.sqlite").exists():
+                replayed = _replay_wal_segments(backup_path, restore_to / "db.sqlite")
+            if manifest.get("uploads"):
+                BackupManager._restore_uploads(manifest, restore_to / "uploads")
+            return {"success": True, "restored_to": str(restore_to), "encrypted": True,
+                    "wal_segments_replayed": replayed}
 
         db_backup = backup_path / "db.sqlite"
+        replayed = 0
         if db_backup.exists():
             if target_dir:
-                shutil.copy2(str(db_backup), str(Path(target_dir) / "db.sqlite"))
+                restored_db = Path(target_dir) / "db.sqlite"
             else:
                 DB_FILE.parent.mkdir(parents=True, exist_ok=True)
-                shutil.copy2(str(db_backup), str(DB_FILE))
+                restored_db = DB_FILE
+            shutil.copy2(str(db_backup), str(restored_db))
+            replayed = _replay_wal_segments(backup_path, restored_db)
 
         upload_backup = backup_path / "uploads"
-        if upload_backup.exists() and UPLOAD_DIR.exists():
+        if manifest.get("uploads"):
+            BackupManager._restore_uploads(
+                manifest, Path(target_dir) / "uploads" if target_dir else UPLOAD_DIR
+            )
+        elif upload_backup.exists() and UPLOAD_DIR.exists():
             if target_dir:
                 dest_upload = Path(target_dir) / "uploads"
             else:
@@ -395,10 +1139,12 @@ class BackupManager:
             "action": "backup_restored",
             "timestamp": datetime.now().isoformat(),
             "source_backup": backup_dir_name,
+            "wal_segments_replayed": replayed,
         }
         _write_privacy_log(log_entry)
 
-        return {"success": True, "restored_to": target_dir or "default location"}
+        return {"success": True, "restored_to": target_dir or "default location",
+                "wal_segments_replayed": replayed}
 
     @staticmethod
     def delete_backup(backup_dir_name):
@@ -406,13 +1152,14 @@ class BackupManager:
         if not backup_path.exists():
             return {"success": False, "error": "Backup not found"}
         shutil.rmtree(str(backup_path))
+        gc_result = _gc_chunks()
         log_entry = {
             "action": "backup_deleted",
             "timestamp": datetime.now().isoformat(),
             "deleted_backup": backup_dir_name,
         }
         _write_privacy_log(log_entry)
-        return {"success": True}
+        return {"success": True, **gc_result}
 
     @staticmethod
     def cleanup_old_backups(retention_days=BACKUP_RETENTION_DAYS):
@@ -421,18 +1168,21 @@ class BackupManager:
         cutoff = datetime.now() - timedelta(days=retention_days)
         cleaned = 0
         freed = 0
-        for bd in BACKUP_DIR.iterdir():
-            if bd.is_dir():
-                mtime = datetime.fromtimestamp(bd.stat().st_mtime)
-                if mtime < cutoff:
-                    freed += sum(
-                        os.path.getsize(os.path.join(dp, fn))
-                        for dp, dns, fns in os.walk(bd)
-                        for fn in fns
-                    )
-                    shutil.rmtree(str(bd))
-                    cleaned += 1
-        return {"cleaned": cleaned, "freed_bytes": freed, "freed_mb": round(freed / (1024 * 1024), 2)}
+        for bd in _iter_backup_dirs():
+            mtime = datetime.fromtimestamp(bd.stat().st_mtime)
+            if mtime < cutoff:
+                freed += sum(
+                    os.path.getsize(os.path.join(dp, fn))
+                    for dp, dns, fns in os.walk(bd)
+                    for fn in fns
+                )
+                shutil.rmtree(str(bd))
+                cleaned += 1
+        # Chunks are shared between backups; only drop those no retained manifest references
+        gc_result = _gc_chunks()
+        freed += gc_result["chunk_bytes_freed"]
+        return {"cleaned": cleaned, "freed_bytes": freed, "freed_mb": round(freed / (1024 * 1024), 2),
+                "chunks_removed": gc_result["chunks_removed"]}
 
     @staticmethod
     def start_auto_backup():
@@ -444,12 +1194,19 @@ class BackupManager:
         def _auto_backup_loop():
             stop = BackupManager._stop_event
             interval = max(BACKUP_INTERVAL_HOURS * 3600, 3600)
+            tick = max(BACKUP_WAL_SHIP_MINUTES * 60, 60) if BACKUP_WAL_SHIPPING_ENABLED else interval
+            next_full = time.monotonic() + interval
             while not stop.is_set():
-                stop.wait(interval)
+                stop.wait(tick)
                 if stop.is_set():
                     break
                 try:
-                    BackupManager.create_backup(description="Auto scheduled backup")
+                    needs_snapshot = time.monotonic() >= next_full
+                    if not needs_snapshot and BACKUP_WAL_SHIPPING_ENABLED:
+                        needs_snapshot = BackupManager.ship_wal().get("needs_snapshot", False)
+                    if needs_snapshot:
+                        BackupManager.create_backup(description="Auto scheduled backup")
+                        next_full = time.monotonic() + interval
                 except Exception:
                     pass
 
@@ -166,15 +166,15 @@ def get_file_tags(conn, file_id):
 def get_like_count(file_id):
     """获取文件点赞数"""
     conn = get_db()
-    count = conn.execute("SELECT COUNT(*) as cnt FROM likes WHERE file_id = ?", (file_id,)).fetchone()['cnt']
-    return count
+    row = conn.execute("SELECT like_count FROM files WHERE id = ?", (file_id,)).fetchone()
+    return (row['like_count'] or 0) if row else 0
 
 
 def get_favorite_count(file_id):
     """获取文件收藏数"""
     conn = get_db()
-    count = conn.execute("SELECT COUNT(*) as cnt FROM favorites WHERE file_id = ?", (file_id,)).fetchone()['cnt']
-    return count
+    row = conn.execute("SELECT favorite_count FROM files WHERE id = ?", (file_id,)).fetchone()
+    return (row['favorite_count'] or 0) if row else 0
 
 
 def is_liked(file_id, user_id):
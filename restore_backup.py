@@ -3,6 +3,9 @@
 
 import zipfile
 import os
+import tempfile
+
+from data_security import get_encryption, decrypt_file, is_stream_encrypted
 
 # 备份文件路径
 BACKUP_FILE = 'backup_20251227.zip'
@@ -14,18 +17,35 @@ if not os.path.exists(BACKUP_FILE):
     print(f"备份文件不存在: {BACKUP_FILE}")
     exit(1)
 
-# 打开备份文件
-with zipfile.ZipFile(BACKUP_FILE, 'r') as zip_ref:
-    # 查看备份文件中的内容
-    print("备份文件中的内容:")
-    for item in zip_ref.namelist():
-        print(f"  - {item}")
-    
-    # 检查是否包含app.py文件
-    if TARGET_FILE in zip_ref.namelist():
-        # 提取app.py文件
-        print(f"\n正在从备份文件中提取 {TARGET_FILE}...")
-        zip_ref.extract(TARGET_FILE, '.')
-        print(f"成功提取 {TARGET_FILE}")
-    else:
-        print(f"\n备份文件中不包含 {TARGET_FILE}")
+# 加密备份（流式AES-GCM格式）先分段解密到临时文件，内存占用与文件大小无关
+zip_path = BACKUP_FILE
+temp_zip = None
+if is_stream_encrypted(BACKUP_FILE):
+    if not get_encryption().ensure_key():
+        print("备份文件已加密，但未配置加密密钥")
+        exit(1)
+    fd, temp_zip = tempfile.mkstemp(suffix='.zip')
+    os.close(fd)
+    print("正在解密备份文件...")
+    decrypt_file(BACKUP_FILE, temp_zip)
+    zip_path = temp_zip
+
+try:
+    # 打开备份文件
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        # 查看备份文件中的内容
+        print("备份文件中的内容:")
+        for item in zip_ref.namelist():
+            print(f"  - {item}")
+
+        # 检查是否包含app.py文件
+        if TARGET_FILE in zip_ref.namelist():
+            # 提取app.py文件
+            print(f"\n正在从备份文件中提取 {TARGET_FILE}...")
+            zip_ref.extract(TARGET_FILE, '.')
+            print(f"成功提取 {TARGET_FILE}")
+        else:
+            print(f"\n备份文件中不包含 {TARGET_FILE}")
+finally:
+    if temp_zip and os.path.exists(temp_zip):
+        os.remove(temp_zip)
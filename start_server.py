@@ -192,7 +192,7 @@ def start_server():
     
     # 导入并运行应用
     try:
-        from app import app, init_db, cleanup_old_logs, cleanup_expired_trash
+        from app import app, init_db, cleanup_old_logs, cleanup_expired_trash, start_db_maintenance
         
         # 初始化数据库
         print("📊 初始化数据库...")
@@ -205,6 +205,9 @@ def start_server():
             cleanup_old_logs()
             cleanup_expired_trash()
         print("  ✅ 清理完成\n")
+
+        # 启动数据库后台维护（WAL检查点、增量回收、ANALYZE）
+        start_db_maintenance()
         
         # 启动Flask应用
         app.run(debug=True, host=HOST, port=PORT)
@@ -1,49 +1,47 @@
-// 缓存名称和版本 - 优化版本管理
-const CACHE_VERSION = 'v3';
-const CACHE_NAME = `yytoolssite-cache-${CACHE_VERSION}`;
-const STATIC_CACHE_NAME = `yytoolssite-static-${CACHE_VERSION}`;
-const DYNAMIC_CACHE_NAME = `yytoolssite-dynamic-${CACHE_VERSION}`;
-
-// 需要缓存的核心静态资源列表
-const CORE_ASSETS = [
-  '/',
-  '/static/manifest.json',
-  '/static/icons/icon-192x192.png',
-  '/static/icons/icon-512x512.png'
-];
-
-// 需要缓存的静态资源列表（带版本号的资源会自动缓存）
-const STATIC_RESOURCES = [
-  '/static/navbar.css',
-  '/static/hero.css',
-  '/static/unified.css',
-  '/static/style.css',
-  '/static/account.css',
-  '/static/ai.css',
-  '/static/auth.css',
-  '/static/blog.css',
-  '/static/detail.css',
-  '/static/file_detail.css',
-  '/static/upload.css',
-  '/static/user_center.css',
-  '/static/scripts/main.js',
-  '/static/scripts/folder_detail.js',
-  '/static/scripts/project_folders.js',
-  '/static/ai.js',
-  '/static/upload.js',
-  '/static/user_center.js',
-  'https://code.jquery.com/jquery-3.6.0.min.js'
-];
-
-// 安装事件 - 预缓存核心资源
+// 预缓存清单由 /sw.js 路由根据 static/dist/manifest.json 注入，构建版本变化即触发新 Worker 安装
+const PRECACHE_MANIFEST = self.__PRECACHE_MANIFEST || { version: 'dev', urls: [] };
+
+// 缓存名称 - 预缓存随构建版本更替，运行时缓存跨版本保留并按条数淘汰
+const CACHE_PREFIX = 'yytoolssite';
+const PRECACHE_NAME = `${CACHE_PREFIX}-precache-${PRECACHE_MANIFEST.version}`;
+const ASSET_CACHE_NAME = `${CACHE_PREFIX}-assets`;
+const THUMBNAIL_CACHE_NAME = `${CACHE_PREFIX}-thumbnails`;
+const STATIC_CACHE_NAME = `${CACHE_PREFIX}-static`;
+const API_CACHE_NAME = `${CACHE_PREFIX}-api`;
+
+// 各运行时缓存的最大条目数（超出后淘汰最久未使用的条目）
+const CACHE_LIMITS = {
+  [ASSET_CACHE_NAME]: 120,
+  [THUMBNAIL_CACHE_NAME]: 200,
+  [STATIC_CACHE_NAME]: 60,
+  [API_CACHE_NAME]: 50
+};
+
+// 列表类接口（路径精确匹配）：先返回缓存，再后台刷新（stale-while-revalidate）
+// 计数、未读数、交互状态等轮询接口不在此列，始终走网络
+const SWR_API_PATHS = new Set([
+  '/api/files',
+  '/api/my-files',
+  '/api/categories',
+  '/api/tags',
+  '/api/trash',
+  '/api/workspaces'
+]);
+
+// 访问这些页面时清空接口缓存，避免切换账号后看到上一个用户的数据
+const SESSION_RESET_PATHS = ['/logout', '/auth'];
+
+const OFFLINE_HTML = '<!DOCTYPE html><html lang="zh-CN"><head><meta charset="utf-8"><meta name="viewport" content="width=device-width,initial-scale=1"><title>离线</title></head><body style="font-family:sans-serif;text-align:center;padding:4rem 1rem;color:#64748b"><h1>网络不可用</h1><p>请检查网络连接后刷新页面</p></body></html>';
+const IMAGE_PLACEHOLDER = '<svg xmlns="http://www.w3.org/2000/svg" width="100" height="100" viewBox="0 0 100 100"><rect width="100" height="100" fill="#f8fafc"/><text x="50" y="50" font-size="12" text-anchor="middle" dy=".3em" fill="#64748b">图片加载失败</text></svg>';
+
+// 安装事件 - 预缓存构建清单中的资源
 self.addEventListener('install', (event) => {
   event.waitUntil(
-    caches.open(STATIC_CACHE_NAME)
+    caches.open(PRECACHE_NAME)
       .then((cache) => {
-        console.log('预缓存静态资源');
-        const allResources = [...CORE_ASSETS, ...STATIC_RESOURCES];
+        console.log('预缓存静态资源:', PRECACHE_MANIFEST.version);
         return Promise.allSettled(
-          allResources.map(url =>
+          PRECACHE_MANIFEST.urls.map(url =>
             cache.add(url).catch(err => {
               console.warn('缓存资源失败，跳过:', url, err.message);
             })
@@ -54,13 +52,12 @@ self.addEventListener('install', (event) => {
   self.skipWaiting();
 });
 
-// 激活事件 - 清理旧缓存并更新缓存
+// 激活事件 - 清理旧版本缓存并开启导航预加载
 self.addEventListener('activate', (event) => {
-  const cacheWhitelist = [STATIC_CACHE_NAME, DYNAMIC_CACHE_NAME];
-  
+  const cacheWhitelist = [PRECACHE_NAME, ...Object.keys(CACHE_LIMITS)];
+
   event.waitUntil(
     Promise.all([
-      // 清理旧缓存
       caches.keys().then((cacheNames) => {
         return Promise.all(
           cacheNames.map((cacheName) => {
@@ -71,138 +68,189 @@ self.addEventListener('activate', (event) => {
           })
         );
       }),
+      self.registration.navigationPreload
+        ? self.registration.navigationPreload.enable()
+        : Promise.resolve(),
       // 立即获取控制权
       self.clients.claim()
     ])
   );
 });
 
-// 网络请求事件 - 优化的缓存策略
+// 网络请求事件 - 按资源类型选择缓存策略
 self.addEventListener('fetch', (event) => {
   const request = event.request;
-  
-  // 忽略非GET请求
+  const url = new URL(request.url);
+
+  // 写操作会改变列表数据，清空接口缓存后交给浏览器处理
   if (request.method !== 'GET') {
+    if (url.origin === self.location.origin && url.pathname.startsWith('/api/')) {
+      event.waitUntil(caches.delete(API_CACHE_NAME));
+    }
     return;
   }
-  
-  // 对于HTML请求，使用网络优先策略，同时更新缓存
-  if (request.headers.get('accept')?.includes('text/html')) {
-    event.respondWith(
-      fetch(request)
-        .then((response) => {
-          if (!response || response.status !== 200 || response.type !== 'basic') {
-            return response;
-          }
-          
-          // 克隆响应，一份返回给浏览器，一份存入缓存
-          const responseToCache = response.clone();
-          
-          // 存入动态缓存
-          caches.open(DYNAMIC_CACHE_NAME)
-            .then((cache) => {
-              cache.put(request, responseToCache);
-            });
-          
-          return response;
-        })
-        .catch(() => {
-          // 如果网络请求失败，返回缓存中的页面
-          return caches.match(request)
-            .then((cachedResponse) => {
-              // 如果缓存中有对应页面，返回缓存
-              if (cachedResponse) {
-                return cachedResponse;
-              }
-              // 否则返回首页缓存
-              return caches.match('/');
-            });
-        })
-    );
-  } 
-  // 对于静态资源（CSS, JS, 图片等），使用缓存优先策略
-  else {
-    event.respondWith(
-      caches.match(request)
-        .then((cachedResponse) => {
-          // 如果缓存中存在资源，直接返回缓存
-          if (cachedResponse) {
-            // 后台更新缓存，确保资源是最新的
-            updateCache(request);
-            return cachedResponse;
-          }
-          
-          // 否则从网络获取
-          return fetch(request)
-            .then((response) => {
-              // 检查响应是否有效
-              if (!response || response.status !== 200 || response.type !== 'basic') {
-                return response;
-              }
-              
-              // 克隆响应，一份返回给浏览器，一份存入缓存
-              const responseToCache = response.clone();
-              
-              // 存入静态缓存
-              caches.open(STATIC_CACHE_NAME)
-                .then((cache) => {
-                  cache.put(request, responseToCache);
-                });
-              
-              return response;
-            })
-            .catch(() => {
-              // 如果是图片请求，返回默认图片占位符
-              if (request.headers.get('accept')?.includes('image')) {
-                return new Response(
-                  '<svg xmlns="http://www.w3.org/2000/svg" width="100" height="100" viewBox="0 0 100 100"><rect width="100" height="100" fill="#f8fafc"/><text x="50" y="50" font-size="12" text-anchor="middle" dy=".3em" fill="#64748b">图片加载失败</text></svg>',
-                  { headers: { 'Content-Type': 'image/svg+xml' } }
-                );
-              }
-              return null;
-            });
-        })
-    );
+
+  // 页面导航：使用导航预加载的响应，离线时返回提示页
+  if (request.mode === 'navigate') {
+    if (SESSION_RESET_PATHS.some(path => url.pathname.startsWith(path))) {
+      event.waitUntil(caches.delete(API_CACHE_NAME));
+    }
+    event.respondWith(networkWithPreload(event));
+    return;
+  }
+
+  // 带内容哈希的构建产物（含CDN上的副本）内容不变，缓存优先
+  if (url.pathname.startsWith('/static/dist/') && !url.pathname.endsWith('/manifest.json')) {
+    event.respondWith(cacheFirst(request, ASSET_CACHE_NAME));
+    return;
+  }
+
+  if (url.origin !== self.location.origin) {
+    return;
+  }
+
+  // 文件替换后会生成新的存储名，预览地址对应的图片内容不会变化
+  if (url.pathname.startsWith('/preview/') && request.destination === 'image') {
+    event.respondWith(cacheFirst(request, THUMBNAIL_CACHE_NAME, isImageResponse));
+    return;
+  }
+
+  if (url.pathname.startsWith('/static/')) {
+    event.respondWith(staleWhileRevalidate(event, STATIC_CACHE_NAME));
+    return;
+  }
+
+  if (SWR_API_PATHS.has(url.pathname)) {
+    event.respondWith(staleWhileRevalidate(event, API_CACHE_NAME));
   }
 });
 
-// 后台更新缓存函数
-async function updateCache(request) {
+function isCacheable(response) {
+  return response && response.status === 200 && (response.type === 'basic' || response.type === 'cors');
+}
+
+function isImageResponse(response) {
+  return isCacheable(response) && (response.headers.get('Content-Type') || '').startsWith('image/');
+}
+
+// 导航请求：优先使用浏览器并行发起的预加载响应
+async function networkWithPreload(event) {
+  try {
+    const preloaded = await event.preloadResponse;
+    if (preloaded) {
+      return preloaded;
+    }
+    return await fetch(event.request);
+  } catch (error) {
+    return new Response(OFFLINE_HTML, {
+      status: 503,
+      headers: { 'Content-Type': 'text/html; charset=utf-8' }
+    });
+  }
+}
+
+// 缓存优先：命中预缓存或运行时缓存直接返回，未命中时请求网络并写入缓存
+async function cacheFirst(request, cacheName, shouldCache = isCacheable) {
+  const cache = await caches.open(cacheName);
+  const cached = await cache.match(request);
+  if (cached) {
+    touchEntry(cache, request, cached.clone());
+    return cached;
+  }
+
+  const precached = await caches.match(request, { cacheName: PRECACHE_NAME });
+  if (precached) {
+    return precached;
+  }
+
   try {
     const response = await fetch(request);
-    if (response.status === 200 && response.type === 'basic') {
-      const responseToCache = response.clone();
-      const cache = await caches.open(STATIC_CACHE_NAME);
-      await cache.put(request, responseToCache);
+    if (shouldCache(response)) {
+      await cache.put(request, response.clone());
+      trimCache(cacheName);
     }
+    return response;
   } catch (error) {
-    // 忽略网络错误
-    console.log('后台更新缓存失败:', error);
+    if (request.destination === 'image') {
+      return new Response(IMAGE_PLACEHOLDER, { headers: { 'Content-Type': 'image/svg+xml' } });
+    }
+    return Response.error();
   }
 }
 
-// 定期清理动态缓存，只保留最近访问的资源
-self.addEventListener('message', (event) => {
-  if (event.data && event.data.type === 'CLEANUP_DYNAMIC_CACHE') {
-    cleanupDynamicCache();
+// 先返回缓存，同时在后台刷新；接口数据有变化时通知页面
+async function staleWhileRevalidate(event, cacheName) {
+  const request = event.request;
+  const cache = await caches.open(cacheName);
+  const cached = await cache.match(request);
+
+  const network = fetch(request)
+    .then(async (response) => {
+      if (isCacheable(response)) {
+        const changed = cached && cacheName === API_CACHE_NAME &&
+          (await cached.clone().text()) !== (await response.clone().text());
+        await cache.put(request, response.clone());
+        trimCache(cacheName);
+        if (changed) {
+          notifyClients({ type: 'API_CACHE_UPDATED', url: request.url });
+        }
+      }
+      return response;
+    });
+
+  if (cached) {
+    event.waitUntil(network.catch((error) => {
+      console.log('后台更新缓存失败:', error);
+    }));
+    return cached;
   }
-});
 
-// 清理动态缓存函数
-async function cleanupDynamicCache() {
-  const cache = await caches.open(DYNAMIC_CACHE_NAME);
+  try {
+    return await network;
+  } catch (error) {
+    return Response.error();
+  }
+}
+
+// 重新写入命中的条目，使其排到淘汰顺序的末尾
+function touchEntry(cache, request, response) {
+  cache.delete(request)
+    .then(() => cache.put(request, response))
+    .catch(() => {});
+}
+
+// 按写入顺序淘汰超出上限的旧条目
+async function trimCache(cacheName) {
+  const limit = CACHE_LIMITS[cacheName];
+  if (!limit) {
+    return;
+  }
+  const cache = await caches.open(cacheName);
   const requests = await cache.keys();
-  
-  // 只保留最近访问的20个资源
-  if (requests.length > 20) {
-    const requestsToDelete = requests.slice(0, requests.length - 20);
+  if (requests.length > limit) {
     await Promise.all(
-      requestsToDelete.map(request => cache.delete(request))
+      requests.slice(0, requests.length - limit).map(request => cache.delete(request))
     );
-    console.log('已清理动态缓存，保留最近20个资源');
   }
 }
 
+async function notifyClients(message) {
+  const clientList = await self.clients.matchAll({ type: 'window' });
+  clientList.forEach(client => client.postMessage(message));
+}
+
+// 页面可主动要求清理缓存（如退出登录时）
+self.addEventListener('message', (event) => {
+  if (!event.data) {
+    return;
+  }
+  if (event.data.type === 'CLEAR_API_CACHE') {
+    event.waitUntil(caches.delete(API_CACHE_NAME));
+  } else if (event.data.type === 'CLEANUP_DYNAMIC_CACHE') {
+    event.waitUntil(Promise.all(Object.keys(CACHE_LIMITS).map(trimCache)));
+  }
+});
+
 // 后台同步事件 - 用于离线时的数据同步
 self.addEventListener('sync', (event) => {
   if (event.tag === 'sync-data') {
@@ -230,7 +278,7 @@ self.addEventListener('push', (event) => {
         url: data.url || '/'
       }
     };
-    
+
     event.waitUntil(
       self.registration.showNotification(data.title, options)
     );
@@ -240,7 +288,7 @@ self.addEventListener('push', (event) => {
 // 通知点击事件 - 点击通知后打开对应页面
 self.addEventListener('notificationclick', (event) => {
   event.notification.close();
-  
+
   event.waitUntil(
     clients.matchAll({ type: 'window', includeUncontrolled: true }).then((clientList) => {
       // 如果已有打开的窗口，聚焦到该窗口
@@ -257,25 +305,20 @@ self.addEventListener('notificationclick', (event) => {
   );
 });
 
-// 周期性后台同步事件 - 用于定期更新缓存
+// 周期性后台同步事件 - 用于定期刷新预缓存
 self.addEventListener('periodicsync', (event) => {
   if (event.tag === 'update-cache') {
     event.waitUntil(updateStaticCache());
   }
 });
 
-// 更新静态缓存函数
+// 重新拉取预缓存中缺失的资源
 async function updateStaticCache() {
-  console.log('定期更新静态缓存');
   try {
-    const cache = await caches.open(STATIC_CACHE_NAME);
-    await Promise.allSettled(
-      STATIC_RESOURCES.map(url =>
-        cache.add(url).catch(err => {
-          console.warn('更新缓存失败，跳过:', url, err.message);
-        })
-      )
-    );
+    const cache = await caches.open(PRECACHE_NAME);
+    const cachedUrls = new Set((await cache.keys()).map(request => request.url));
+    const missing = PRECACHE_MANIFEST.urls.filter(url => !cachedUrls.has(new URL(url, self.location.origin).href));
+    await Promise.allSettled(missing.map(url => cache.add(url)));
     console.log('静态缓存更新完成');
   } catch (error) {
     console.error('静态缓存更新失败:', error);